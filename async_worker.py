@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""a worker that runs many jobs of the queue concurrently in one process.
+
+the jobs mostly wait on horizon and webhooks, so each runs in a thread while an event loop
+keeps dequeuing - up to WORKER_CONCURRENCY jobs at a time. failed jobs go to rq_error_handler,
+like with worker.py.
+"""
+import asyncio
+import signal
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from rq.defaults import DEFAULT_RESULT_TTL
+from rq.exceptions import DequeueTimeout
+from rq.job import Job, JobStatus
+from rq.queue import Queue
+from rq.registry import StartedJobRegistry
+
+# Preload libraries
+from payment import config
+from payment.statsd import statsd
+from payment.log import get as get_log
+from payment.redis_conn import redis_conn
+from payment.queue import q, promote
+from payment.retries import run_promoter
+from payment.blockchain import warm_up
+from worker import rq_error_handler
+
+
+log = get_log()
+DEQUEUE_TIMEOUT = 1  # seconds, how often to check for a stop request while the queue is empty
+
+
+def dequeue(burst=False) -> Job:
+    """return the next job, or None if the queue stayed empty."""
+    try:
+        result = Queue.dequeue_any([q], None if burst else DEQUEUE_TIMEOUT, connection=redis_conn)
+    except DequeueTimeout:
+        return None
+    return result[0] if result else None
+
+
+def perform(job: Job) -> bool:
+    """run a job in this thread, keeping its rq status like rq's worker does."""
+    registry = StartedJobRegistry(job.origin, connection=redis_conn)
+    pipe = redis_conn.pipeline()
+    registry.add(job, (job.timeout or Queue.DEFAULT_TIMEOUT) + 60, pipeline=pipe)
+    job.set_status(JobStatus.STARTED, pipeline=pipe)
+    pipe.execute()
+
+    try:
+        job.perform()
+    except Exception:
+        pipe = redis_conn.pipeline()
+        job.set_status(JobStatus.FAILED, pipeline=pipe)
+        registry.remove(job, pipeline=pipe)
+        pipe.execute()
+        rq_error_handler(job, *sys.exc_info())
+        return False
+
+    result_ttl = job.get_result_ttl(DEFAULT_RESULT_TTL)
+    pipe = redis_conn.pipeline()
+    if result_ttl != 0:
+        job.set_status(JobStatus.FINISHED, pipeline=pipe)
+        job.save(pipeline=pipe, include_meta=False)
+    job.cleanup(result_ttl, pipeline=pipe, remove_from_queue=False)
+    registry.remove(job, pipeline=pipe)
+    pipe.execute()
+    return True
+
+
+async def work(concurrency, burst=False):
+    """dequeue and run jobs until stopped by a signal, or until the queue is empty in burst mode."""
+    loop = asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(concurrency + 1)  # a thread to wait for jobs on
+    slots = asyncio.Semaphore(concurrency)
+    stop = asyncio.Event()
+    running = set()
+
+    if not burst:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        threading.Thread(target=run_promoter, args=(promote,), daemon=True).start()
+
+    async def run(job):
+        try:
+            await loop.run_in_executor(executor, perform, job)
+        except Exception:
+            log.exception('failed handling job', job_id=job.id, func_name=job.func_name)
+        finally:
+            slots.release()
+
+    log.info('async worker started', queue=q.name, concurrency=concurrency)
+    while not stop.is_set():
+        await slots.acquire()
+        job = await loop.run_in_executor(executor, dequeue, burst)
+        if job is None:
+            slots.release()
+            if burst:
+                break
+            continue
+        task = loop.create_task(run(job))
+        running.add(task)
+        task.add_done_callback(running.discard)
+        statsd.gauge('async_worker.running', len(running))
+
+    log.info('async worker stopping - waiting for running jobs', running=len(running))
+    if running:
+        await asyncio.wait(running)
+    executor.shutdown()
+
+
+if __name__ == '__main__':
+    warm_up()
+    asyncio.get_event_loop().run_until_complete(work(config.WORKER_CONCURRENCY))
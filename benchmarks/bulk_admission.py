@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""compare payments/sec admitted by POST /payments, one request per payment, against POST /payments/bulk.
+
+requests go through the flask app in process, and jobs are enqueued on a scratch queue that is emptied
+after every run - nothing is paid. runs against the configured redis:
+
+    . ./local.sh && . ./secrets/.secrets && python benchmarks/bulk_admission.py --payments 5000 --bulk-size 500
+"""
+import argparse
+import os
+import sys
+import time
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rq import Queue  # noqa
+from kin import Keypair  # noqa
+from payment import queue  # noqa
+from payment.app import app  # noqa
+from payment.models import PaymentState, PendingPayments  # noqa
+from payment.redis_conn import redis_conn  # noqa
+
+QUEUE_NAME = 'benchmark'
+APP_ID = 'bnch'
+
+
+def new_payments(count, recipient):
+    return [{'id': 'benchmark-%s' % uuid4().hex,
+             'app_id': APP_ID,
+             'amount': 1,
+             'recipient_address': recipient,
+             'callback': 'http://localhost/callback'}
+            for _ in range(count)]
+
+
+def cleanup(payments):
+    queue.q.empty()
+    redis_conn.delete(PendingPayments._key(APP_ID), *[PaymentState._key(p['id']) for p in payments])
+
+
+def bench_single(client, payments):
+    start = time.time()
+    for payment in payments:
+        assert client.post('/payments', json=payment).status_code == 201
+    return len(payments) / (time.time() - start)
+
+
+def bench_bulk(client, payments, bulk_size):
+    start = time.time()
+    for i in range(0, len(payments), bulk_size):
+        res = client.post('/payments/bulk', json=payments[i:i + bulk_size])
+        assert res.status_code == 201
+    return len(payments) / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--payments', type=int, default=5000)
+    parser.add_argument('--bulk-size', type=int, default=500)
+    args = parser.parse_args()
+
+    queue.q = Queue(QUEUE_NAME, connection=redis_conn)
+    client = app.test_client()
+    recipient = Keypair().public_address
+
+    payments = new_payments(args.payments, recipient)
+    try:
+        single = bench_single(client, payments)
+    finally:
+        cleanup(payments)
+
+    payments = new_payments(args.payments, recipient)
+    try:
+        bulk = bench_bulk(client, payments, args.bulk_size)
+    finally:
+        cleanup(payments)
+
+    print('POST /payments       %8.0f payments/sec' % single)
+    print('POST /payments/bulk  %8.0f payments/sec (%s per request)' % (bulk, args.bulk_size))
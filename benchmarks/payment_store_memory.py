@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""compare the redis memory of a payment stored as a json string (before the ledger) and packed by the ledger.
+
+stores --count random payments in both formats under scratch keys, and sums their MEMORY USAGE:
+
+    . ./local.sh && . ./secrets/.secrets && python benchmarks/payment_store_memory.py --count 10000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kin import Keypair  # noqa
+from payment import ledger  # noqa
+from payment.models import Payment  # noqa
+from payment.redis_conn import redis_conn  # noqa
+
+PREFIX = 'benchmark:payments'
+
+
+def random_payment(i, sender):
+    return Payment({'id': 'benchmark-payment-%s' % i,
+                    'app_id': random.choice(['kik', 'test', 'abcd']),
+                    'transaction_id': '%064x' % random.getrandbits(256),
+                    'recipient_address': Keypair().public_address,
+                    'sender_address': sender,
+                    'amount': random.randint(1, 10000),
+                    'timestamp': datetime.utcnow()})
+
+
+def memory_usage(keys):
+    pipe = redis_conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.execute_command('MEMORY', 'USAGE', key)
+    return sum(pipe.execute())
+
+
+def store(keys, values):
+    redis_conn.delete(*keys)
+    pipe = redis_conn.pipeline(transaction=False)
+    for key, value in zip(keys, values):
+        pipe.set(key, value, ex=3600)
+    pipe.execute()
+    try:
+        return memory_usage(keys)
+    finally:
+        redis_conn.delete(*keys)
+
+
+def index_usage(payments):
+    """memory of one index entry per payment, the ledger keeps 3 (time, app_id, recipient)."""
+    key = '%s:index' % PREFIX
+    redis_conn.delete(key)
+    pipe = redis_conn.pipeline(transaction=False)
+    for payment in payments:
+        pipe.zadd(key, ledger._to_ms(payment.timestamp) / 1000, payment.id)
+    pipe.execute()
+    try:
+        return memory_usage([key])
+    finally:
+        redis_conn.delete(key)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=10000)
+    args = parser.parse_args()
+
+    sender = Keypair().public_address
+    payments = [random_payment(i, sender) for i in range(args.count)]
+
+    json_bytes = store(['%s:json:%s' % (PREFIX, p.id) for p in payments],
+                       [json.dumps(p.to_primitive()) for p in payments])
+    packed_bytes = store(['%s:packed:%s' % (PREFIX, p.id) for p in payments],
+                         [ledger.pack(p) for p in payments])
+    index_bytes = index_usage(payments)
+
+    print('json string      %6.0f bytes/payment' % (json_bytes / args.count))
+    print('ledger, packed   %6.0f bytes/payment' % (packed_bytes / args.count))
+    print('ledger, indexes  %6.0f bytes/payment (time, app_id, recipient)' % (3 * index_bytes / args.count))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""measure how long every entry point takes to import, each in a fresh interpreter.
+
+watcher.py and callback_dispatcher.py start running on import, so their modules are timed instead.
+runs with the configured environment - a slow horizon shouldn't change the numbers:
+
+    . ./local.sh && . ./secrets/.secrets && python benchmarks/startup_time.py --runs 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = [
+    ('gunicorn payment.app:app', 'payment.app'),
+    ('worker.py', 'worker'),
+    ('async_worker.py', 'async_worker'),
+    ('watcher.py', 'payment.watcher'),
+    ('callback_dispatcher.py', 'payment.callbacks'),
+    ('create_channels.py', 'create_channels'),
+]
+TIME_IMPORT = 'import time; start = time.time(); import {module}; print(time.time() - start)'
+
+
+def import_time(module):
+    output = subprocess.check_output([sys.executable, '-c', TIME_IMPORT.format(module=module)], cwd=ROOT)
+    return float(output.decode().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    for name, module in ENTRY_POINTS:
+        times = [import_time(module) for _ in range(args.runs)]
+        print('%-26s median %6.3fs  max %6.3fs' % (name, statistics.median(times), max(times)))
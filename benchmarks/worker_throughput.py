@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""compare jobs/sec of worker.py forking a child per job against the preloaded, in-process worker pool.
+
+every job loads the sdk account of the root wallet, like a payment job does in get_sdk - a forked
+child loads it from horizon every time, a preloaded worker only once.
+runs against the configured redis and horizon, on a scratch queue:
+
+    . ./local.sh && . ./secrets/.secrets && python benchmarks/worker_throughput.py --jobs 200 --processes 4
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rq import Queue  # noqa
+from payment import config  # noqa
+from payment.blockchain import get_account  # noqa
+from payment.redis_conn import redis_conn  # noqa
+import worker  # noqa
+
+QUEUE_NAME = 'benchmark'
+
+
+def load_account():
+    get_account(config.STELLAR_BASE_SEED, 'bnch')
+
+
+def bench(jobs, processes, fork):
+    queue = Queue(QUEUE_NAME, connection=redis_conn)
+    queue.empty()
+    for _ in range(jobs):
+        queue.enqueue(load_account)
+
+    start = time.time()
+    worker.run(processes, fork=fork, queue_names=[QUEUE_NAME], burst=True)
+    return jobs / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    for name, fork in [('fork per job (worker.py)', True), ('preloaded pool', False)]:
+        rate = bench(args.jobs, args.processes, fork)
+        print('%-26s %d processes %8.1f jobs/sec' % (name, args.processes, rate))
@@ -0,0 +1,12 @@
+from payment.log import init as init_log
+log = init_log()
+
+import signal
+import threading
+
+from payment import config
+from payment.callbacks import CallbackDispatcher
+
+stop_event = threading.Event()
+signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+CallbackDispatcher(config.CALLBACK_CONCURRENCY, config.CALLBACK_HOST_CONCURRENCY).run(stop_event)
@@ -1,20 +1,106 @@
-from payment.channel_factory import generate_key, Blockchain
-from payment.blockchain import root_wallet
+"""create the channel accounts - many in every transaction, several transactions in parallel.
+
+channels that already exist are registered and skipped, so it can be re-run to resume after an interruption.
+the first batch is sent from the root wallet, the rest from the channels the first batch created.
+"""
+import argparse
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from payment import config
+from payment.blockchain import Blockchain, get_root_wallet, get_root_account
+from payment.channel_factory import generate_key, ChannelRegistry
 from payment.log import get as get_log
-from kin import KinErrors
 
 log = get_log()
 
-channel_id = 0
-while channel_id < 2000:
-    keys = generate_key(root_wallet, channel_id)
-    public_address = keys.address().decode()
-    try:
-        root_wallet.create_wallet(public_address)  # XXX this causes a race-condition
-        log.error('# created channel: %s: %s' % (channel_id, public_address))
-        channel_id += 1
-    except KinErrors.AccountExistsError:
-        log.error('# existing channel: %s: %s' % (channel_id, public_address))
-        channel_id += 1
-    except Exception as e:
-        log.error('# error with channel channel: %s: %s' % (channel_id, public_address))
+
+def get_missing_channels(channel_ids, executor):
+    """return the [(channel_id, address)] of channels that don't exist yet, registering the ones that do."""
+    def check(channel_id):
+        address = generate_key(get_root_wallet(), channel_id).address().decode()
+        if ChannelRegistry.is_ready(channel_id, address):
+            return channel_id, address, True
+        return channel_id, address, Blockchain.read_sdk.does_account_exists(address)
+
+    missing = []
+    for channel_id, address, exists in executor.map(check, channel_ids):
+        if exists:
+            ChannelRegistry.set_ready(channel_id, address)
+        else:
+            missing.append((channel_id, address))
+    return missing
+
+
+def create_batch(batch, source_seed=None):
+    """create a batch of channels in one transaction, sent from the root wallet or the given channel, and register them."""
+    addresses = [address for _, address in batch]
+    if source_seed is None:
+        get_root_wallet().create_wallets(addresses)
+    else:
+        Blockchain(get_root_account(), source_seed).create_wallets(addresses)
+    for channel_id, address in batch:
+        ChannelRegistry.set_ready(channel_id, address)
+    return batch
+
+
+def create_channels(count, batch_size, parallel):
+    """create channels 0..count-1. return the number of channels that failed."""
+    with ThreadPoolExecutor(parallel) as executor:
+        missing = get_missing_channels(range(count), executor)
+        log.info('# channels to create', existing=count - len(missing), missing=len(missing))
+        if not missing:
+            return 0
+
+        batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+        created = failed = 0
+
+        def report(batch, error=None):
+            nonlocal created, failed
+            if error:
+                failed += len(batch)
+                log.error('# failed creating channels', first=batch[0][0], last=batch[-1][0], error=str(error))
+            else:
+                created += len(batch)
+            log.info('# progress', created=created, failed=failed, total=len(missing))
+
+        try:
+            report(create_batch(batches[0]))
+        except Exception as e:
+            report(batches[0], e)
+            return failed + sum(len(batch) for batch in batches[1:])
+
+        # the rest are sent from the channels just created, one batch at a time each. not from channels of
+        # the pool - leasing a channel creates it when missing, and the batch it belongs to would then fail
+        sources = queue.Queue()
+        for channel_id, _ in batches[0]:
+            sources.put(generate_key(get_root_wallet(), channel_id).seed().decode())
+
+        def create_from_source(batch):
+            source_seed = sources.get()
+            try:
+                return create_batch(batch, source_seed)
+            finally:
+                sources.put(source_seed)
+
+        futures = {executor.submit(create_from_source, batch): batch for batch in batches[1:]}
+        for future in as_completed(futures):
+            try:
+                report(future.result())
+            except Exception as e:
+                report(futures[future], e)
+        return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=config.MAX_CHANNELS, help='number of channels')
+    parser.add_argument('--batch-size', type=int, default=Blockchain.MAX_OPS, help='channels per transaction')
+    parser.add_argument('--parallel', type=int, default=5, help='concurrent transactions')
+    args = parser.parse_args()
+
+    failed = create_channels(args.count, min(args.batch_size, Blockchain.MAX_OPS), args.parallel)
+    if failed:
+        log.error('# some channels were not created - run again to retry them', failed=failed)
+        sys.exit(1)
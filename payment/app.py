@@ -2,16 +2,48 @@ from . import config
 from .log import init as init_log
 
 log = init_log()
-from flask import Flask, request, jsonify
-from .transaction_flow import TransactionFlow
-from .errors import AlreadyExistsError, PaymentNotFoundError, ServiceNotFoundError
+import json
+from flask import Flask, Response, request, jsonify, stream_with_context
+from .transaction_flow import sync_payment_history
+from .errors import AlreadyExistsError, BaseError, PaymentNotFoundError, ServiceNotFoundError
 from .middleware import handle_errors
-from .models import Payment, WalletRequest, PaymentRequest, Service, WhitelistRequest, SubmitTransactionRequest
-from .queue import enqueue_create_wallet, enqueue_send_payment, enqueue_submit_tx
-from .blockchain import Blockchain, root_wallet
+from .models import Payment, PaymentHistory, PaymentState, PaymentStatusRequest, WalletRequest, PaymentRequest, Service, WhitelistRequest, SubmitTransactionRequest
+from .queue import enqueue_create_wallet, enqueue_create_wallets, enqueue_send_payment, enqueue_send_payments, enqueue_submit_tx
+from .blockchain import Blockchain
+from .utils import safe_int
 
 app = Flask(__name__)
 
+ACCEPTED = 'accepted'
+DUPLICATE = 'duplicate'
+INVALID = 'invalid'
+
+
+def parse_bulk(model_class) -> (list, list):
+    """validate a json array of requests in one pass.
+
+    return the per item results, with None for the valid items, and the valid requests with their index.
+    """
+    items = request.get_json()
+    if not isinstance(items, list):
+        raise BaseError('expected a json array')
+    if len(items) > config.BULK_MAX_ITEMS:
+        raise BaseError('too many items: %s > %s' % (len(items), config.BULK_MAX_ITEMS))
+
+    results, valid = [], []
+    for i, item in enumerate(items):
+        try:
+            model = model_class(item)
+            model.validate()
+        except Exception as e:
+            results.append({'id': item.get('id') if isinstance(item, dict) else None,
+                            'result': INVALID,
+                            'error': str(e)})
+        else:
+            results.append(None)
+            valid.append((i, model))
+    return results, valid
+
 
 @app.route('/wallets', methods=['POST'])
 @handle_errors
@@ -25,6 +57,36 @@ def create_wallet():
     return jsonify(), 202
 
 
+@app.route('/wallets/bulk', methods=['POST'])
+@handle_errors
+def create_wallets():
+    results, wallet_requests = parse_bulk(WalletRequest)
+    # wallet creation is idempotent - only skip the addresses repeated in the request
+    addresses = set()
+    to_create = []
+    for i, wallet_request in wallet_requests:
+        if wallet_request.wallet_address in addresses:
+            results[i] = {'id': wallet_request.id, 'result': DUPLICATE}
+            continue
+        addresses.add(wallet_request.wallet_address)
+        to_create.append(wallet_request)
+        results[i] = {'id': wallet_request.id, 'result': ACCEPTED}
+
+    enqueue_create_wallets(to_create)
+    return jsonify({'results': results}), 202
+
+
+@app.route('/wallets', methods=['GET'])
+@handle_errors
+def get_wallets():
+    addresses = [address for address in request.args.get('addresses', '').split(',') if address]
+    if len(addresses) > config.BULK_MAX_ITEMS:
+        raise BaseError('too many addresses: %s > %s' % (len(addresses), config.BULK_MAX_ITEMS))
+    wallets = Blockchain.get_wallets(addresses)
+    return jsonify({'wallets': {address: wallets[address].to_primitive() if address in wallets else None
+                                for address in addresses}})
+
+
 @app.route('/wallets/<wallet_address>', methods=['GET'])
 @handle_errors
 def get_wallet(wallet_address):
@@ -35,21 +97,68 @@ def get_wallet(wallet_address):
 @app.route('/wallets/<wallet_address>/payments', methods=['GET'])
 @handle_errors
 def get_wallet_payments(wallet_address):
-    payments = []
-    flow = TransactionFlow(cursor=0)
-    for tx in flow.get_address_transactions(wallet_address):
-        payment = Blockchain.try_parse_payment(tx)
-        if payment:
-            payments.append(payment.to_primitive())
+    # validated before streaming - an error can't be answered once the response started
+    cursor = request.args.get('cursor')
+    if cursor is not None and not cursor.isdigit():
+        raise BaseError('invalid cursor: %s' % cursor)
+    limit = request.args.get('limit')
+    if limit is not None:
+        limit = safe_int(limit, 0)
+        if limit <= 0:
+            raise BaseError('invalid limit: %s' % request.args.get('limit'))
+    sync_payment_history(wallet_address)
+
+    def generate():
+        """stream the payments without building the whole list in memory."""
+        yield '{"payments": ['
+        count, paging_token = 0, None
+        for paging_token, payment in PaymentHistory.iter(wallet_address, cursor, limit):
+            yield (',' if count else '') + payment
+            count += 1
+        next_cursor = paging_token if limit and count == limit else None
+        yield '], "next_cursor": %s}' % json.dumps(next_cursor)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+@app.route('/payments/export', methods=['GET'])
+@handle_errors
+def export_payments():
+    """stream the stored payments as json lines, optionally of an app or a recipient, between epoch seconds."""
+    payments = Payment.export(since=safe_int(request.args.get('since'), None),
+                              until=safe_int(request.args.get('until'), None),
+                              app_id=request.args.get('app_id'),
+                              recipient_address=request.args.get('recipient_address'))
+
+    def generate():
+        for payment in payments:
+            yield str(payment) + '\n'
 
-    return jsonify({'payments': payments})
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 @app.route('/payments/<payment_id>', methods=['GET'])
 @handle_errors
 def get_payment(payment_id):
-    payment = Payment.get(payment_id)
-    return jsonify(payment.to_primitive())
+    try:
+        payment = Payment.get(payment_id)
+    except PaymentNotFoundError:
+        # not paid yet - 202 with the state of a payment on its way
+        state = PaymentState.get(payment_id)
+        if not state:
+            raise
+        return jsonify(state), 202
+    data = payment.to_primitive()
+    data['state'] = PaymentState.CONFIRMED
+    return jsonify(data)
+
+
+@app.route('/payments/status', methods=['POST'])
+@handle_errors
+def get_payments_status():
+    body = PaymentStatusRequest(request.get_json())
+    body.validate()
+    return jsonify({'payments': Payment.get_states(body.ids)})
 
 
 @app.route('/payments', methods=['POST'])
@@ -57,16 +166,22 @@ def get_payment(payment_id):
 def pay():
     payment = PaymentRequest(request.get_json())
     payment.validate()
-    try:
-        Payment.get(payment.id)
+    if not enqueue_send_payment(payment):
         raise AlreadyExistsError('payment already exists')
-    except PaymentNotFoundError:
-        pass
-
-    enqueue_send_payment(payment)
     return jsonify(), 201
 
 
+@app.route('/payments/bulk', methods=['POST'])
+@handle_errors
+def pay_many():
+    results, payment_requests = parse_bulk(PaymentRequest)
+    admitted = enqueue_send_payments([payment for _, payment in payment_requests])
+    for (i, payment), ok in zip(payment_requests, admitted):
+        results[i] = {'id': payment.id, 'result': ACCEPTED if ok else DUPLICATE}
+    # created only if a payment was admitted - a bulk of rejected and duplicate payments created nothing
+    return jsonify({'results': results}), 201 if any(admitted) else 200
+
+
 @app.route('/services/<service_id>', methods=['PUT', 'DELETE'])
 @handle_errors
 def add_delete_service(service_id):
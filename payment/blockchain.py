@@ -1,26 +1,132 @@
 import contextlib
-from typing import List
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Generator, Tuple, Set
 from kin.errors import AccountExistsError
 
 from kin.errors import AccountNotFoundError
-from kin.transactions import SimplifiedTransaction
+from kin import KinErrors
+from kin.transactions import SimplifiedTransaction, build_memo
+from kin.blockchain.utils import is_valid_transaction_hash
 from kin import KinClient
 from kin.account import KinAccount
 from kin import Keypair
 from kin_base import Keypair as BaseKeypair
+from kin_base.memo import TextMemo
 
 from . import config
-from .models import Payment, Wallet, TransactionRecord
+from . import tx_cache
+from .horizon import get_transport
+from .models import Payment, Wallet, WalletCache, TransactionRecord, SequenceManager
 from .log import get as get_log
 from .errors import WalletNotFoundError
+from .utils import classproperty
 from .config import STELLAR_ENV
 
 log = get_log('rq.worker')
 
 
+lookup_pool = ThreadPoolExecutor(config.TX_PREFETCH_WORKERS)
+
+
+def get_operation_codes(e: Exception) -> List[str]:
+    """return the result code of every operation of a failed transaction, or None if unknown."""
+    # the sdk raises its own error while handling the horizon error, which carries the codes
+    horizon_error = e if isinstance(e, KinErrors.HorizonError) else e.__context__
+    try:
+        return list(horizon_error.extras.result_codes.operations)
+    except (AttributeError, TypeError):
+        return None
+
+
+# nothing here talks to horizon on import - the client, root account and fee are loaded on first use
+_lock = threading.RLock()
+_read_sdk = None
+_minimum_fee = None  # (fee, loaded at)
+_root_account = None
+_root_wallet = None
+
+
+def get_read_sdk() -> KinClient:
+    global _read_sdk
+    with _lock:
+        if _read_sdk is None:
+            _read_sdk = KinClient(STELLAR_ENV)
+            _read_sdk.horizon = get_transport()
+        return _read_sdk
+
+
+def new_account(seed: str, **kwargs) -> KinAccount:
+    """create an sdk account that talks to horizon over the shared transport."""
+    account = get_read_sdk().kin_account(seed, **kwargs)
+    account.horizon = get_transport()
+    return account
+
+
+def get_minimum_fee() -> int:
+    """the network minimum fee, reloaded every MINIMUM_FEE_REFRESH_SECS. the last known fee is kept if horizon fails."""
+    global _minimum_fee
+    if _minimum_fee and time.time() - _minimum_fee[1] < config.MINIMUM_FEE_REFRESH_SECS:
+        return _minimum_fee[0]
+    with _lock:
+        if not _minimum_fee or time.time() - _minimum_fee[1] >= config.MINIMUM_FEE_REFRESH_SECS:
+            try:
+                _minimum_fee = (get_read_sdk().get_minimum_fee(), time.time())
+            except Exception:
+                if not _minimum_fee:
+                    raise
+                log.exception('failed refreshing the minimum fee - keeping the last one', fee=_minimum_fee[0])
+                _minimum_fee = (_minimum_fee[0], time.time())
+        return _minimum_fee[0]
+
+
+def get_root_account() -> KinAccount:
+    """the account that funds all other channels and sub-funding-wallets."""
+    global _root_account
+    with _lock:
+        if _root_account is None:
+            _root_account = new_account(config.STELLAR_BASE_SEED, channel_secret_keys=[], app_id='kin')  # We need to choose an app_id
+        return _root_account
+
+
+def get_root_wallet() -> "Blockchain":
+    global _root_wallet
+    with _lock:
+        if _root_wallet is None:
+            root_account = get_root_account()
+            _root_wallet = Blockchain(root_account, channel=root_account.keypair.secret_seed)
+        return _root_wallet
+
+
+def reset():
+    """drop the loaded client, accounts and fee - they are loaded again on their next use."""
+    global _read_sdk, _minimum_fee, _root_account, _root_wallet
+    with _lock:
+        _read_sdk = _minimum_fee = _root_account = _root_wallet = None
+        _accounts.clear()
+
+
+def warm_up():
+    """load the root wallet and the fee now, before serving - in a parent process, for its forked children."""
+    get_root_wallet()
+    get_minimum_fee()
+
+
+def __getattr__(name):
+    # root_account and root_wallet used to be loaded on import
+    if name == 'root_account':
+        return get_root_account()
+    if name == 'root_wallet':
+        return get_root_wallet()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
 class Blockchain(object):
-    read_sdk = KinClient(STELLAR_ENV)
-    minimum_fee = read_sdk.get_minimum_fee()
+    MAX_OPS = 100  # operations per transaction
+    read_sdk = classproperty(lambda cls: get_read_sdk())
+    minimum_fee = classproperty(lambda cls: get_minimum_fee())
 
     def __init__(self, sdk: KinAccount, channel: str):
         self.write_sdk = sdk
@@ -47,30 +153,104 @@ class Blockchain(object):
         log.info('create wallet transaction', tx_id=tx_id)
         return tx_id
 
-    def pay_to(self, public_address: str, amount: int, payment_id: str) -> str:
-        """send kins to an address."""
+    def create_wallets(self, public_addresses: List[str]) -> str:
+        """create many wallets in one transaction. fails as a whole if any of them exists."""
+        assert 0 < len(public_addresses) <= self.MAX_OPS
+        log.info('creating wallets', count=len(public_addresses))
+        builder = self.write_sdk.get_transaction_builder(self.minimum_fee)
+        builder.add_text_memo(build_memo(self.write_sdk.app_id, None))
+        for public_address in public_addresses:
+            builder.append_create_account_op(public_address, '0', source=self.root_address)
+        tx_id = self._sign_and_send_tx(builder)
+        log.info('create wallets transaction', tx_id=tx_id, count=len(public_addresses))
+        return tx_id
+
+    def pay_to(self, public_address: str, amount: int, payment_id: str, on_submit=None) -> str:
+        """send kins to an address. on_submit is called right before the transaction is submitted."""
         log.info('sending kin to', address=public_address)
         # We use 'build_send_kin' instead of 'send_kin' since we have our method of managing seeds in redis
         builder = self.write_sdk.build_send_kin(public_address, amount, fee=self.minimum_fee, memo_text=payment_id)
-        return self._sign_and_send_tx(builder)
+        return self._sign_and_send_tx(builder, on_submit)
+
+    def pay_many(self, payments: List[Tuple[str, int]], memo_text: str, on_submit=None) -> str:
+        """send kins to many addresses in one transaction. payments are (public_address, amount) pairs."""
+        assert 0 < len(payments) <= self.MAX_OPS
+        log.info('sending kin to many', count=len(payments), memo_text=memo_text)
+        builder = self.write_sdk.get_transaction_builder(self.minimum_fee)
+        builder.add_text_memo(build_memo(self.write_sdk.app_id, memo_text))
+        for public_address, amount in payments:
+            builder.append_payment_op(public_address, str(amount), source=self.root_address)
+        return self._sign_and_send_tx(builder, on_submit)
 
     def submit_transaction(self, transaction):
-        builder = root_account.get_transaction_builder(0)
+        builder = get_root_account().get_transaction_builder(0)
         builder.import_from_xdr(transaction)
         builder.sign(self.write_sdk.keypair.secret_seed)
         return self.write_sdk.submit_transaction(builder)
 
     @staticmethod
     def get_wallet(public_address: str) -> Wallet:
-        try:
-            data = Blockchain.read_sdk.get_account_data(public_address)
-            return Wallet.from_blockchain(data)
-        except AccountNotFoundError:
+        wallet = Blockchain.get_wallets([public_address]).get(public_address)
+        if not wallet:
             raise WalletNotFoundError('wallet %s not found' % public_address)
+        return wallet
+
+    @staticmethod
+    def get_wallets(public_addresses: List[str]) -> Dict[str, Wallet]:
+        """get the wallets of the addresses that have one - from the cache, or concurrently from horizon."""
+        wallets = WalletCache.get_many(public_addresses)
+        missing = [address for address in public_addresses if address not in wallets]
+
+        def load(public_address):
+            try:
+                return Wallet.from_blockchain(Blockchain.read_sdk.get_account_data(public_address))
+            except AccountNotFoundError:
+                return None
+
+        # a single lookup runs inline - it may be called from a task of the lookup pool
+        loaded = [wallet for wallet in (lookup_pool.map(load, missing) if len(missing) > 1 else map(load, missing))
+                  if wallet]
+        WalletCache.save_many(loaded)
+        wallets.update((wallet.wallet_address, wallet) for wallet in loaded)
+        return wallets
+
+    @staticmethod
+    def get_existing_wallets(public_addresses: List[str]) -> Set[str]:
+        """return which of the addresses have a wallet, checking them concurrently."""
+        def exists(public_address):
+            try:
+                return Blockchain.read_sdk.does_account_exists(public_address)
+            except Exception:
+                log.info('failed checking wallet state', public_address=public_address)
+                return False
+
+        found = lookup_pool.map(exists, public_addresses)
+        return {public_address for public_address, exists in zip(public_addresses, found) if exists}
 
     @staticmethod
     def get_transaction_data(tx_id) -> SimplifiedTransaction:
-        return Blockchain.read_sdk.get_transaction_data(tx_id)
+        if not is_valid_transaction_hash(tx_id):
+            raise ValueError('invalid transaction hash: {}'.format(tx_id))
+        return tx_cache.get_transaction(tx_id, Blockchain._fetch_transaction)
+
+    @staticmethod
+    def get_embedded_transaction(tx_id) -> dict:
+        """the memo and close time of a transaction, as horizon embeds them in the records of its operations.
+
+        for transactions that can't be simplified, like a batch of payments.
+        """
+        raw_tx = tx_cache.get_raw_transaction(tx_id, Blockchain._fetch_transaction)
+        memo = raw_tx.tx.memo
+        if not isinstance(memo, TextMemo):
+            return {'memo_type': None, 'created_at': raw_tx.timestamp}
+        return {'memo_type': 'text', 'memo': memo.text.decode(), 'created_at': raw_tx.timestamp}
+
+    @staticmethod
+    def _fetch_transaction(tx_id) -> dict:
+        try:
+            return Blockchain.read_sdk.horizon.transaction(tx_id)
+        except Exception as e:
+            raise KinErrors.translate_error(e)
 
     @staticmethod
     def get_payment_data(tx_id) -> Payment:
@@ -87,53 +267,118 @@ class Blockchain(object):
         except Exception as e:
             log.exception('failed to parse payment', tx_data=tx_data)
 
+    @staticmethod
+    def try_parse_record_payment(record: TransactionRecord) -> Payment:
+        """try to parse payment from a record with its transaction embedded. return None when failed."""
+        try:
+            return Payment.from_record(record)
+        except Exception as e:
+            log.exception('failed to parse payment', record=record)
+
     @staticmethod
     def get_address_records(address, cursor, limit=100) -> List[TransactionRecord]:
+        """get the payment records of an address, with their transactions embedded."""
         log.debug('getting records from', address=address, cursor=cursor)
         reply = Blockchain.read_sdk.horizon.account_payments(
             address=address,
             params={'cursor': cursor,
                     'order': 'asc',
-                    'limit': limit})
+                    'limit': limit,
+                    'join': 'transactions'})
         records = [TransactionRecord(r, strict=False) for r in reply['_embedded']['records']]
         return records
 
     @staticmethod
     def get_all_records(cursor, limit=100) -> List[TransactionRecord]:
+        """get all payment records, with their transactions embedded."""
         log.debug('getting records from', cursor=cursor)
         reply = Blockchain.read_sdk.horizon.payments(
             params={'cursor': cursor,
                     'order': 'asc',
-                    'limit': limit})
+                    'limit': limit,
+                    'join': 'transactions'})
         records = [TransactionRecord(r, strict=False) for r in reply['_embedded']['records']]
         return records
 
+    @staticmethod
+    def stream_all_records(cursor) -> Generator[TransactionRecord, None, None]:
+        """yield payment records from the given cursor as horizon publishes them."""
+        log.debug('streaming records from', cursor=cursor)
+        events = Blockchain.read_sdk.horizon.payments(params={'cursor': cursor, 'join': 'transactions'}, sse=True)
+        for event in events:
+            if event.event != 'message':
+                continue
+            data = json.loads(event.data)
+            if not isinstance(data, dict):  # horizon opens every stream with a "hello" message
+                continue
+            yield TransactionRecord(data, strict=False)
+
     @staticmethod
     def get_last_cursor():
         reply = Blockchain.read_sdk.horizon.payments(params={'cursor': 'now', 'order': 'desc', 'limit': 1})
         return reply['_embedded']['records'][0]['paging_token']
 
-    def _sign_and_send_tx(self, builder) -> str:
-        builder.set_channel(self.channel)
+    def _sign_and_send_tx(self, builder, on_submit=None) -> str:
+        if self.channel == self.write_sdk.keypair.secret_seed:
+            # the root account isn't held exclusively by anyone - always load its sequence
+            builder.set_channel(self.channel)
+            return self._sign_and_submit(builder, on_submit)
+
+        # we hold the channel exclusively, so we know its sequence unless someone else used it
+        builder.keypair = BaseKeypair.from_seed(self.channel)
+        builder.address = self.channel_address
+        sequence = SequenceManager.get(self.channel_address)
+        if sequence is None:
+            builder.update_sequence()
+        else:
+            builder.sequence = str(sequence)
+
+        try:
+            tx_id = self._sign_and_submit(builder, on_submit)
+        except KinErrors.RequestError as e:
+            SequenceManager.forget(self.channel_address)
+            if e.error_code != KinErrors.TransactionResultCode.BAD_SEQUENCE:
+                raise
+            log.info('bad sequence - reloading', channel=self.channel_address, sequence=builder.sequence)
+            builder.update_sequence()
+            builder.tx = builder.te = None  # rebuild and sign again with the new sequence
+            tx_id = self._sign_and_submit(builder, on_submit)
+        except Exception:
+            # the transaction might have consumed the sequence
+            SequenceManager.forget(self.channel_address)
+            raise
+
+        SequenceManager.save(self.channel_address, int(builder.sequence) + 1)
+        return tx_id
+
+    def _sign_and_submit(self, builder, on_submit=None) -> str:
         builder.sign(self.channel)
         if self.channel != self.write_sdk.keypair.secret_seed:
             builder.sign(self.write_sdk.keypair.secret_seed)
+        if on_submit:
+            on_submit()
         tx_id = self.write_sdk.submit_transaction(builder)
         return tx_id
 
 
-# The wallet that funds all other channels and sub-funding-wallets
-root_account = Blockchain.read_sdk.kin_account(config.STELLAR_BASE_SEED, channel_secret_keys=[], app_id='kin')  # We need to choose an app_id
-root_wallet = Blockchain(root_account, channel=root_account.keypair.secret_seed)
+_accounts = {}  # (seed, app_id) => KinAccount, kept for the life of the process
+
+
+def get_account(seed: str, app_id: str) -> KinAccount:
+    """return a warm sdk account - loading it checks the account on horizon."""
+    account = _accounts.get((seed, app_id))
+    if account is None:
+        account = _accounts[(seed, app_id)] = new_account(seed, app_id=app_id)
+    return account
 
 
 @contextlib.contextmanager
 def get_sdk(seed: str, app_id: str) -> Blockchain:
     from .channel_factory import get_channel
 
-    sdk = Blockchain.read_sdk.kin_account(seed, app_id=app_id)
+    sdk = get_account(seed, app_id)
 
-    with get_channel(root_wallet) as channel:
+    with get_channel(get_root_wallet()) as channel:
         try:
             yield Blockchain(sdk, channel)
         finally:
@@ -0,0 +1,345 @@
+"""webhook callbacks, delivered apart from the payment jobs.
+
+callbacks are pushed to their own redis list and posted by callback_dispatcher.py, which keeps a
+keep-alive connection pool per host and sends to every host at most CALLBACK_HOST_CONCURRENCY at a time.
+as many posts may wait for a busy host - callbacks to a host that has more are handed back to the
+queue after HOST_BUSY_DELAY, so a slow host can't hold up the callbacks to the others.
+
+callbacks of services that opted into batching are collected per url, up to the service batch_size
+or batch_wait_ms, and posted together as a json array. the service answers with a json array of
+the same length, true for every callback it handled - the others are sent again. any other
+successful response acknowledges the whole batch.
+
+failed callbacks are retried later with a backoff, see retries.py - the dispatcher promotes them.
+
+a dispatcher moves every callback it takes to a processing list of its own, and removes it only once
+the callback was acknowledged or handed to the retries. a dispatcher beats every REPORT_INTERVAL from a
+thread of its own, and the callbacks of one that stopped beating for DISPATCHER_TIMEOUT are put back at
+the tail of the queue, next to be taken.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import config
+from .log import get as get_log
+from .redis_conn import redis_conn
+from .retries import RetryQueue, run_promoter
+from .statsd import statsd
+from .utils import retry
+
+log = get_log()
+QUEUE_KEY = 'callbacks:queue'  # pushed at the head, taken from the tail
+PROCESSING_KEY = 'callbacks:processing:%s'  # dispatcher id => callbacks it took
+DISPATCHERS_KEY = 'callbacks:dispatchers'  # dispatcher id => time of its last beat
+REPORT_INTERVAL = 1
+DISPATCHER_TIMEOUT = 60
+HOST_BUSY_DELAY = 1
+callback_retries = RetryQueue('callbacks', config.RETRY_MAX_ATTEMPTS)
+FLUSH_INTERVAL = 0.01
+# put the callbacks taken by dispatchers that stopped beating back at the tail of the queue, next to be taken
+# KEYS: queue, dispatchers zset
+# ARGV: beats before this time are dead, processing list key prefix
+RECOVER_SCRIPT = """
+local dead = redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[1])
+local count = 0
+for _, id in ipairs(dead) do
+    local processing = ARGV[2] .. id
+    local items = redis.call('lrange', processing, 0, -1)
+    if #items > 0 then
+        redis.call('rpush', KEYS[1], unpack(items))
+    end
+    count = count + #items
+    redis.call('del', processing)
+    redis.call('zrem', KEYS[2], id)
+end
+return count
+"""
+recover_script = redis_conn.register_script(RECOVER_SCRIPT)
+
+
+def enqueue_callback(callback: str, app_id: str, objekt: str, state: str, action: str, value: dict,
+                     batch_size: int = None, batch_wait_ms: int = None):
+    item = {
+        'callback': callback,
+        'app_id': app_id,
+        'object': objekt,
+        'state': state,
+        'action': action,
+        'value': value,
+    }
+    if batch_size and batch_size > 1:
+        item['batch_size'] = batch_size
+        item['batch_wait_ms'] = batch_wait_ms or 0
+    redis_conn.lpush(QUEUE_KEY, json.dumps(item))
+
+
+def _payload(item: dict) -> dict:
+    return {key: item[key] for key in ('object', 'state', 'action', 'value')}
+
+
+def _tags(item: dict) -> list:
+    return ['app_id:%s' % item['app_id'],
+            'object:%s' % item['object'],
+            'state:%s' % item['state'],
+            'action:%s' % item['action']]
+
+
+def promote_retries():
+    """move callbacks that are due for a retry back to the queue."""
+    items = callback_retries.pop_due()
+    if items:
+        redis_conn.lpush(QUEUE_KEY, *items)
+
+
+def recover(before: float = None) -> int:
+    """put the callbacks of dispatchers that stopped beating back to the queue. return how many."""
+    before = time.time() - DISPATCHER_TIMEOUT if before is None else before
+    return recover_script(keys=[QUEUE_KEY, DISPATCHERS_KEY], args=[before, PROCESSING_KEY % ''])
+
+
+def send_callback(session: requests.Session, callback: str, app_id: str, objekt: str, state: str, action: str, value: dict):
+    """post a callback, retrying on errors."""
+    @retry(5, 0.2)
+    def retry_callback(callback: str, payload: dict):
+        res = session.post(callback, json=payload, timeout=config.CALLBACK_TIMEOUT_SECS)
+        res.raise_for_status()
+        return res.json()
+
+    payload = {
+        'object': objekt,
+        'state': state,
+        'action': action,
+        'value': value,
+    }
+
+    tags = ['app_id:%s' % app_id,
+            'object:%s' % objekt,
+            'state:%s' % state,
+            'action:%s' % action]
+    start_t = time.time()
+    try:
+        response = retry_callback(callback, payload)
+        statsd.increment('callback.success', tags=tags)
+        log.info('callback response', response=response, payload=payload)
+    except Exception as e:
+        statsd.increment('callback.failed', tags=tags)
+        log.exception('callback failed', payload=payload)
+        raise
+    finally:
+        statsd.timing('callback.latency', time.time() - start_t, tags=tags)
+
+
+def send_batch_callback(session: requests.Session, callback: str, items: list) -> list:
+    """post many callbacks to the same url as one json array. return whether each was acknowledged."""
+    @retry(5, 0.2)
+    def retry_callback(callback: str, payloads: list):
+        res = session.post(callback, json=payloads, timeout=config.CALLBACK_TIMEOUT_SECS)
+        res.raise_for_status()
+        return res.json()
+
+    start_t = time.time()
+    try:
+        response = retry_callback(callback, [_payload(item) for item in items])
+        log.info('batch callback response', response=response, callback=callback, count=len(items))
+    except Exception:
+        log.exception('batch callback failed', callback=callback, count=len(items))
+        acks = [False] * len(items)
+    else:
+        if isinstance(response, list) and len(response) == len(items):
+            acks = [ack is True for ack in response]
+        else:
+            acks = [True] * len(items)
+
+    latency = time.time() - start_t
+    for item, ack in zip(items, acks):
+        statsd.increment('callback.success' if ack else 'callback.failed', tags=_tags(item))
+        statsd.timing('callback.latency', latency, tags=_tags(item))
+    statsd.histogram('callback.batch_size', len(items))
+    return acks
+
+
+class CallbackDispatcher:
+    """post queued callbacks in parallel, limiting the concurrent callbacks to each host."""
+
+    def __init__(self, concurrency, host_concurrency):
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.host_concurrency = host_concurrency
+        # posts being sent or waiting for a free connection - no more callbacks are taken while all are used
+        self.max_posts = concurrency * 2
+        self.posts = 0
+        self.lock = threading.Condition()
+        self.waiting = defaultdict(deque)  # host => lists of callbacks waiting for a free connection
+        self.in_flight = defaultdict(int)  # host => posts being sent
+        self.batches = {}  # url => (flush time, callbacks collected for a batched post)
+        self.sessions = {}  # host => session with a keep-alive connection pool
+        self.id = uuid.uuid4().hex
+        self.processing_key = PROCESSING_KEY % self.id
+
+    def _session(self, host) -> requests.Session:
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = self.sessions[host] = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.host_concurrency)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+            return session
+
+    def dispatch(self, item: dict):
+        if item.get('batch_size'):
+            self._collect(item)
+        else:
+            self._post([item])
+
+    def _collect(self, item: dict):
+        url = item['callback']
+        with self.lock:
+            flush_at, items = self.batches.setdefault(url, (time.time() + item['batch_wait_ms'] / 1000, []))
+            items.append(item)
+            full = len(items) >= item['batch_size']
+        if full:
+            self.flush(url)
+
+    def flush(self, url=None, due=False):
+        """post the batch collected for a url, or all batches (only the due ones if `due`)."""
+        with self.lock:
+            now = time.time()
+            urls = [url] if url else [url for url, (flush_at, _) in self.batches.items() if not due or flush_at <= now]
+            batches = [self.batches.pop(url)[1] for url in urls if url in self.batches]
+        for items in batches:
+            self._post(items)
+
+    def _post(self, items: list):
+        host = urlparse(items[0]['callback']).netloc
+        with self.lock:
+            busy = self.in_flight[host] >= self.host_concurrency
+            deferred = busy and len(self.waiting[host]) >= self.host_concurrency
+            if not deferred:
+                self.posts += 1
+                if busy:
+                    self.waiting[host].append(items)
+                else:
+                    self.in_flight[host] += 1
+        if deferred:
+            self._defer(host, items)
+        elif not busy:
+            self.executor.submit(self._send, host, items)
+
+    def _handled(self, raws: list):
+        """drop the raw queue items from the processing list - none when dispatched directly."""
+        pipe = redis_conn.pipeline()
+        for raw in raws:
+            if raw is not None:
+                pipe.lrem(self.processing_key, 1, raw)
+        pipe.execute()
+
+    def _defer(self, host, items: list):
+        """hand callbacks to a host with too many posts waiting back to the queue, without counting an attempt."""
+        statsd.increment('callback.host_busy', len(items), tags=['host:%s' % host])
+        raws = [item.pop('_raw', None) for item in items]
+        try:
+            for item in items:
+                callback_retries.defer(json.dumps(item), HOST_BUSY_DELAY)
+            self._handled(raws)
+        except Exception:
+            # left in the processing list, put back to the queue when the dispatcher stops
+            log.exception('failed deferring callbacks', host=host)
+
+    def _send(self, host, items: list):
+        raws = [item.pop('_raw', None) for item in items]
+        try:
+            session = self._session(host)
+            if items[0].get('batch_size'):
+                acks = send_batch_callback(session, items[0]['callback'], items)
+            else:
+                item = items[0]
+                try:
+                    send_callback(session, item['callback'], item['app_id'], objekt=item['object'],
+                                  state=item['state'], action=item['action'], value=item['value'])
+                    acks = [True]
+                except Exception:
+                    acks = [False]
+            for item, ack in zip(items, acks):
+                if not ack:
+                    item['attempt'] = item.get('attempt', 0) + 1
+                    callback_retries.schedule(json.dumps(item), item['attempt'])
+            self._handled(raws)
+        except Exception:
+            # left in the processing list, put back to the queue when the dispatcher stops
+            log.exception('failed sending callbacks', host=host)
+        finally:
+            with self.lock:
+                self.posts -= 1
+                self.lock.notify()
+                next_items = self.waiting[host].popleft() if self.waiting[host] else None
+                if next_items is None:
+                    self.in_flight[host] -= 1
+            if next_items is not None:
+                self.executor.submit(self._send, host, next_items)
+
+    def _flush_due(self, stop_event: threading.Event):
+        while not stop_event.is_set():
+            self.flush(due=True)
+            time.sleep(FLUSH_INTERVAL)
+
+    def _beat(self, stopped: threading.Event):
+        """keep this dispatcher alive for the others, and recover the callbacks of the stopped ones."""
+        while not stopped.is_set():
+            try:
+                redis_conn.zadd(DISPATCHERS_KEY, time.time(), self.id)
+                recovered = recover()
+                if recovered:
+                    log.info('recovered callbacks of stopped dispatchers', count=recovered)
+                statsd.gauge('callback.queue_size', redis_conn.llen(QUEUE_KEY))
+            except Exception:
+                log.exception('failed dispatcher beat')
+            stopped.wait(REPORT_INTERVAL)
+
+    def run(self, stop_event: threading.Event):
+        """dispatch queued callbacks until stopped, then wait for the ones taken."""
+        log.info('callback dispatcher started')
+        # beats until the callbacks taken were handled - a slow host may keep the dispatcher busy long after stopped
+        stopped = threading.Event()
+        beater = threading.Thread(target=self._beat, args=(stopped,), daemon=True)
+        beater.start()
+        flusher = threading.Thread(target=self._flush_due, args=(stop_event,), daemon=True)
+        flusher.start()
+        threading.Thread(target=run_promoter, args=(promote_retries, stop_event), daemon=True).start()
+        while not stop_event.is_set():
+            with self.lock:
+                if self.posts >= self.max_posts:
+                    self.lock.wait(1)
+                    continue
+            raw = redis_conn.brpoplpush(QUEUE_KEY, self.processing_key, timeout=1)
+            if not raw:
+                continue
+            item = json.loads(raw.decode('utf8'))
+            item['_raw'] = raw
+            self.dispatch(item)
+
+        log.info('callback dispatcher stopping')
+        flusher.join()
+        self.join()
+        stopped.set()
+        beater.join()
+        # whatever is left failed to be handled - put it back to the queue for the other dispatchers
+        redis_conn.zadd(DISPATCHERS_KEY, 0, self.id)
+        recover(before=0)
+
+    def join(self):
+        """send the collected batches, and wait for all dispatched callbacks to be sent."""
+        self.flush()
+        while True:
+            with self.lock:
+                if not any(self.in_flight.values()):
+                    break
+            time.sleep(0.01)
+        self.executor.shutdown()
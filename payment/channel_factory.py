@@ -1,10 +1,8 @@
 import contextlib
 import time
-from random import randint
 from hashlib import sha256
 from kin_base import Keypair
-from .errors import NoAvailableChannel
-from .utils import lock, safe_int
+from .channel_pool import ChannelPool
 from . import config
 from .statsd import statsd
 from .redis_conn import redis_conn
@@ -17,9 +15,9 @@ log = get_log()
 
 INITIAL_XLM_AMOUNT = 3
 DEFAULT_MAX_CHANNELS = config.MAX_CHANNELS
-MAX_LOCK_TRIES = 100
-SLEEP_BETWEEN_LOCKS = 0.01
 MEMO_INIT = 'kin-init_channel'
+# MAX_CHANNELS can be overridden at runtime by setting it in redis
+channel_pool = ChannelPool(redis_conn, DEFAULT_MAX_CHANNELS, lease_secs=config.CHANNEL_LEASE_SECS)
 
 
 def generate_key(root_wallet: Blockchain, idx):
@@ -31,24 +29,60 @@ def generate_key(root_wallet: Blockchain, idx):
 
 @contextlib.contextmanager
 def get_next_channel_id():
-    """get the next available channel_id from redis."""
-    max_channels = safe_int(redis_conn.get('MAX_CHANNELS'), DEFAULT_MAX_CHANNELS)
-    for i in range(MAX_LOCK_TRIES):
-        channel_id = randint(0, max_channels - 1)
-        with lock(redis_conn, 'channel:{}'.format(channel_id), blocking_timeout=0) as locked_succeeded:
-            if locked_succeeded:
-                start_t = time.time()
-                try:
-                    redis_conn.sadd('channel_locks', channel_id)
-                    statsd.gauge('channel_lock', redis_conn.scard('channel_locks'))
-                    yield channel_id
-                finally:
-                    statsd.timing('channel_lock_time', time.time() - start_t)
-                    redis_conn.srem('channel_locks', channel_id)
-                    statsd.gauge('channel_lock', redis_conn.scard('channel_locks'))
-                return  # end generator
-        time.sleep(SLEEP_BETWEEN_LOCKS)
-    raise NoAvailableChannel()
+    """lease the next available channel_id from the redis channel pool."""
+    channel_id, token = channel_pool.acquire(wait=config.CHANNEL_WAIT_SECS)
+    start_t = time.time()
+    try:
+        yield channel_id
+    finally:
+        statsd.timing('channel_lock_time', time.time() - start_t)
+        channel_pool.release(channel_id, token)
+
+
+class ChannelRegistry:
+    """channels known to be provisioned on the blockchain, by channel_id.
+
+    a channel is checked against horizon only when it isn't registered yet, or a submit showed its account is gone.
+    """
+    _ready = {}  # channel_id => address, this process' copy of the registry
+
+    @classmethod
+    def _key(cls):
+        return 'channels:ready'
+
+    @classmethod
+    def is_ready(cls, channel_id, address) -> bool:
+        if cls._ready.get(channel_id) == address:
+            return True
+        registered = redis_conn.hget(cls._key(), channel_id)
+        if registered and registered.decode('utf8') == address:
+            cls._ready[channel_id] = address
+            return True
+        return False
+
+    @classmethod
+    def set_ready(cls, channel_id, address):
+        redis_conn.hset(cls._key(), channel_id, address)
+        cls._ready[channel_id] = address
+
+    @classmethod
+    def get_addresses(cls):
+        """return the addresses of all registered channels."""
+        return [address.decode('utf8') for address in redis_conn.hvals(cls._key())]
+
+    @classmethod
+    def forget(cls, channel_id):
+        redis_conn.hdel(cls._key(), channel_id)
+        cls._ready.pop(channel_id, None)
+
+
+def is_missing_channel_error(e: Exception) -> bool:
+    """return whether the error shows the channel (the transaction source) doesn't exist."""
+    if isinstance(e, KinErrors.AccountNotFoundError):
+        return e.error_code == KinErrors.TransactionResultCode.NO_ACCOUNT
+    if isinstance(e, KinErrors.HorizonError):  # loading the channel sequence
+        return e.type == KinErrors.HorizonErrorType.NOT_FOUND
+    return False
 
 
 @contextlib.contextmanager
@@ -57,10 +91,18 @@ def get_channel(root_wallet: Blockchain):
     with get_next_channel_id() as channel_id:
         keys = generate_key(root_wallet, channel_id)
         public_address = keys.address().decode()
-        try:
-            root_wallet.create_wallet(public_address)  # XXX this causes a race-condition
-            log.info('# created channel: %s: %s' % (channel_id, public_address))
-        except KinErrors.AccountExistsError:
+        if not ChannelRegistry.is_ready(channel_id, public_address):
+            try:
+                root_wallet.create_wallet(public_address)  # XXX this causes a race-condition
+                log.info('# created channel: %s: %s' % (channel_id, public_address))
+            except KinErrors.AccountExistsError:
                 log.info('# existing channel: %s: %s' % (channel_id, public_address))
+            ChannelRegistry.set_ready(channel_id, public_address)
 
-        yield keys.seed().decode()
+        try:
+            yield keys.seed().decode()
+        except Exception as e:
+            if is_missing_channel_error(e):
+                log.error('# missing channel: %s: %s' % (channel_id, public_address))
+                ChannelRegistry.forget(channel_id)
+            raise
@@ -0,0 +1,132 @@
+"""A pool of channel ids kept as a free-list in redis.
+
+Acquiring a channel atomically pops it off the free-list and leases it until an expiry time.
+Releasing it pushes it back. Leases that expired (a worker that died while holding a channel)
+are reclaimed by the next acquire.
+"""
+import time
+from uuid import uuid4
+
+from .errors import NoAvailableChannel
+from .statsd import statsd
+
+
+# KEYS: free list, leases zset, lease tokens hash, pool size, max channels override
+# ARGV: now, lease secs, lease token, default max channels
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local max_channels = tonumber(redis.call('get', KEYS[5]) or ARGV[4]) or tonumber(ARGV[4])
+
+-- follow changes of MAX_CHANNELS
+local size = tonumber(redis.call('get', KEYS[4]) or '0')
+if size < max_channels then
+    for id = size, max_channels - 1 do
+        if not redis.call('zscore', KEYS[2], id) then
+            redis.call('rpush', KEYS[1], id)
+        end
+    end
+    redis.call('set', KEYS[4], max_channels)
+elseif size > max_channels then
+    for id = max_channels, size - 1 do
+        redis.call('lrem', KEYS[1], 0, id)
+    end
+    redis.call('set', KEYS[4], max_channels)
+end
+
+-- reclaim channels of expired leases
+for _, id in ipairs(redis.call('zrangebyscore', KEYS[2], '-inf', now)) do
+    redis.call('zrem', KEYS[2], id)
+    redis.call('hdel', KEYS[3], id)
+    if tonumber(id) < max_channels then
+        redis.call('rpush', KEYS[1], id)
+    end
+end
+
+local id = redis.call('lpop', KEYS[1])
+if id then
+    redis.call('zadd', KEYS[2], now + tonumber(ARGV[2]), id)
+    redis.call('hset', KEYS[3], id, ARGV[3])
+else
+    id = -1
+end
+return {tonumber(id), redis.call('llen', KEYS[1]), redis.call('zcard', KEYS[2])}
+"""
+
+# KEYS: free list, leases zset, lease tokens hash, pool size
+# ARGV: channel id, lease token
+RELEASE_SCRIPT = """
+if redis.call('hget', KEYS[3], ARGV[1]) == ARGV[2] then
+    redis.call('hdel', KEYS[3], ARGV[1])
+    redis.call('zrem', KEYS[2], ARGV[1])
+    if tonumber(ARGV[1]) < tonumber(redis.call('get', KEYS[4]) or '0') then
+        redis.call('lpush', KEYS[1], ARGV[1])
+    end
+end
+return {redis.call('llen', KEYS[1]), redis.call('zcard', KEYS[2])}
+"""
+
+
+class ChannelPool:
+    """channel ids 0..max_channels-1 shared by all workers through redis."""
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, redis_conn, max_channels, lease_secs, name='channels', max_channels_key='MAX_CHANNELS'):
+        self.redis_conn = redis_conn
+        self.max_channels = max_channels  # unless overridden in redis under max_channels_key
+        self.max_channels_key = max_channels_key
+        self.lease_secs = lease_secs
+        self.name = name
+        self.keys = ['%s:free' % name, '%s:leases' % name, '%s:tokens' % name, '%s:size' % name]
+        self._acquire = redis_conn.register_script(ACQUIRE_SCRIPT)
+        self._release = redis_conn.register_script(RELEASE_SCRIPT)
+
+    def _waiting_key(self):
+        return '%s:waiting' % self.name
+
+    def try_acquire(self):
+        """lease a free channel. return (channel_id, lease_token), or (None, None) when all channels are leased."""
+        token = uuid4().hex
+        channel_id, free, leased = self._acquire(keys=self.keys + [self.max_channels_key],
+                                                 args=[time.time(), self.lease_secs, token, self.max_channels])
+        self._report(free, leased)
+        if channel_id < 0:
+            return None, None
+        return channel_id, token
+
+    def acquire(self, wait=0):
+        """lease a free channel, waiting up to `wait` seconds for one to be released."""
+        channel_id, token = self.try_acquire()
+        if channel_id is not None or wait <= 0:
+            if channel_id is None:
+                raise NoAvailableChannel()
+            return channel_id, token
+
+        statsd.gauge('%s.waiting' % self.name, self.redis_conn.incr(self._waiting_key()))
+        try:
+            deadline = time.time() + wait
+            while time.time() < deadline:
+                time.sleep(self.POLL_INTERVAL)
+                channel_id, token = self.try_acquire()
+                if channel_id is not None:
+                    return channel_id, token
+        finally:
+            statsd.gauge('%s.waiting' % self.name, self.redis_conn.decr(self._waiting_key()))
+        raise NoAvailableChannel()
+
+    def release(self, channel_id, token):
+        """return a leased channel to the pool. a lease that already expired and was reclaimed is ignored."""
+        free, leased = self._release(keys=self.keys, args=[channel_id, token])
+        self._report(free, leased)
+
+    def metrics(self):
+        """return the number of free, leased and waiting channels."""
+        pipe = self.redis_conn.pipeline()
+        pipe.llen(self.keys[0])
+        pipe.zcard(self.keys[1])
+        pipe.get(self._waiting_key())
+        free, leased, waiting = pipe.execute()
+        return {'free': free, 'leased': leased, 'waiting': int(waiting or 0)}
+
+    def _report(self, free, leased):
+        statsd.gauge('%s.free' % self.name, free)
+        statsd.gauge('%s.leased' % self.name, leased)
@@ -6,11 +6,77 @@ from kin import Environment
 STELLAR_HORIZON_URL = os.environ['STELLAR_HORIZON_URL']
 STELLAR_NETWORK = os.environ['STELLAR_NETWORK']
 STELLAR_ENV = Environment('CUSTOM', STELLAR_HORIZON_URL, STELLAR_NETWORK)
+# horizon servers of the same network (comma separated) - requests go to the fastest one
+STELLAR_HORIZON_URLS = [url.strip() for url in os.environ.get('STELLAR_HORIZON_URLS', STELLAR_HORIZON_URL).split(',') if url.strip()]
+# keep-alive connections per horizon server, shared by the whole process
+HORIZON_POOL_SIZE = int(os.environ.get('HORIZON_POOL_SIZE', '50'))
+HORIZON_TIMEOUT_SECS = float(os.environ.get('HORIZON_TIMEOUT_SECS', '11'))
+# max horizon requests per second of a process, with bursts of up to HORIZON_RATE_BURST (0 for no limit)
+HORIZON_RATE_LIMIT = float(os.environ.get('HORIZON_RATE_LIMIT', '0'))
+HORIZON_RATE_BURST = int(os.environ.get('HORIZON_RATE_BURST', '100'))
+# a read of a transaction or ledger that takes longer than HORIZON_HEDGE_AFTER_MS is sent to the next fastest server too (0 to disable)
+HORIZON_HEDGE_AFTER_MS = int(os.environ.get('HORIZON_HEDGE_AFTER_MS', '300'))
 
+# a job of the queue is stopped after JOB_TIMEOUT_SECS
+JOB_TIMEOUT_SECS = int(os.environ.get('JOB_TIMEOUT_SECS', '180'))
 CHANNEL_SALT = os.environ.get('CHANNEL_SALT')
 MAX_CHANNELS = int(os.environ.get('MAX_CHANNELS', '1200'))
+# a channel lease expires after CHANNEL_LEASE_SECS, in case its worker died holding it.
+# a job may hold its channel until it times out - a lease that expired before would give the channel to two jobs
+CHANNEL_LEASE_SECS = int(os.environ.get('CHANNEL_LEASE_SECS', str(JOB_TIMEOUT_SECS + 60)))
+assert CHANNEL_LEASE_SECS > JOB_TIMEOUT_SECS, 'CHANNEL_LEASE_SECS must be longer than JOB_TIMEOUT_SECS'
+# how long to wait for a free channel before giving up
+CHANNEL_WAIT_SECS = float(os.environ.get('CHANNEL_WAIT_SECS', '1'))
 STELLAR_BASE_SEED = os.environ['STELLAR_BASE_SEED']
 
+# max concurrent horizon lookups of transaction details
+TX_PREFETCH_WORKERS = int(os.environ.get('TX_PREFETCH_WORKERS', '10'))
+# horizon transactions are cached in process (up to TX_CACHE_SIZE) and in redis for TX_CACHE_TTL_SECS,
+# and a transaction that wasn't found for TX_CACHE_NOT_FOUND_TTL_SECS (0 to not cache it)
+TX_CACHE_SIZE = int(os.environ.get('TX_CACHE_SIZE', '10000'))
+TX_CACHE_TTL_SECS = int(os.environ.get('TX_CACHE_TTL_SECS', str(24 * 60 * 60)))
+TX_CACHE_NOT_FOUND_TTL_SECS = int(os.environ.get('TX_CACHE_NOT_FOUND_TTL_SECS', '5'))
+# wallets read from horizon are cached for WALLET_CACHE_TTL_SECS (0 to disable), or until the watcher sees them pay or get paid
+WALLET_CACHE_TTL_SECS = int(os.environ.get('WALLET_CACHE_TTL_SECS', '30'))
+# the network minimum fee is reloaded from horizon every MINIMUM_FEE_REFRESH_SECS
+MINIMUM_FEE_REFRESH_SECS = int(os.environ.get('MINIMUM_FEE_REFRESH_SECS', '300'))
+# 'poll' the payments endpoint every beat, or 'stream' it as server sent events
+WATCHER_MODE = os.environ.get('WATCHER_MODE', 'poll').lower()
+# an address payment history is synced from horizon at most once every HISTORY_SYNC_SECS,
+# and dropped when it isn't read for HISTORY_TTL_SECS
+HISTORY_SYNC_SECS = int(os.environ.get('HISTORY_SYNC_SECS', '5'))
+HISTORY_TTL_SECS = int(os.environ.get('HISTORY_TTL_SECS', str(7 * 24 * 60 * 60)))
+
+# pending payments of an app are sent together, up to PAYMENT_BATCH_SIZE in a transaction, waiting at most
+# PAYMENT_BATCH_WAIT_MS for a batch to fill. a size of 1 disables batching. excluded apps always pay one by one.
+PAYMENT_BATCH_SIZE = int(os.environ.get('PAYMENT_BATCH_SIZE', '1'))
+PAYMENT_BATCH_WAIT_MS = int(os.environ.get('PAYMENT_BATCH_WAIT_MS', '200'))
+PAYMENT_BATCH_EXCLUDED_APPS = set(filter(None, os.environ.get('PAYMENT_BATCH_EXCLUDED_APPS', '').split(',')))
+# wallet creations of an app are batched the same way
+WALLET_BATCH_SIZE = int(os.environ.get('WALLET_BATCH_SIZE', '1'))
+WALLET_BATCH_WAIT_MS = int(os.environ.get('WALLET_BATCH_WAIT_MS', '200'))
+# jobs run at the same time by one async_worker.py process
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '50'))
+# worker.py processes (0 for one per cpu), and whether every job runs in a forked child or in the warm worker process
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', '1'))
+WORKER_FORK = os.environ.get('WORKER_FORK', 'true').lower() == 'true'
+# callbacks sent at the same time by callback_dispatcher.py, in total and to each host
+CALLBACK_CONCURRENCY = int(os.environ.get('CALLBACK_CONCURRENCY', '100'))
+CALLBACK_HOST_CONCURRENCY = int(os.environ.get('CALLBACK_HOST_CONCURRENCY', '10'))
+CALLBACK_TIMEOUT_SECS = float(os.environ.get('CALLBACK_TIMEOUT_SECS', '10'))
+# failed jobs and callbacks are retried after an exponential backoff with jitter, from RETRY_BASE_DELAY_SECS
+# up to RETRY_MAX_DELAY_SECS, and moved to a dead letter list after RETRY_MAX_ATTEMPTS retries
+RETRY_BASE_DELAY_SECS = float(os.environ.get('RETRY_BASE_DELAY_SECS', '1'))
+RETRY_MAX_DELAY_SECS = float(os.environ.get('RETRY_MAX_DELAY_SECS', '300'))
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', '10'))
+# the root wallet balance is reported at most once every BALANCE_REPORT_SECS, with the channel balances if enabled
+BALANCE_REPORT_SECS = int(os.environ.get('BALANCE_REPORT_SECS', '10'))
+REPORT_CHANNEL_BALANCES = os.environ.get('REPORT_CHANNEL_BALANCES', 'false').lower() == 'true'
+# payments sent are kept, with their indexes, for PAYMENT_RETENTION_SECS
+PAYMENT_RETENTION_SECS = int(os.environ.get('PAYMENT_RETENTION_SECS', str(30 * 24 * 60 * 60)))
+# the max payments or wallets in a single POST /payments/bulk or /wallets/bulk request
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', '1000'))
+
 REDIS = os.environ['APP_REDIS']
 APP_NAME = os.environ.get('APP_NAME', 'payment-service')
 
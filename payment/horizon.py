@@ -0,0 +1,254 @@
+"""the horizon transport shared by all sdk objects of a process.
+
+one keep-alive connection pool per horizon server, and a process wide token bucket that keeps the
+request rate under HORIZON_RATE_LIMIT and pauses when horizon says the limit was hit.
+
+servers of the same network may lag each other by a few ledgers, so submits and reads of mutable
+resources (accounts, lists) are pinned to one server - the fastest when pinned, until it fails - and
+an account is read from the server its last transaction was submitted to.
+
+reads of immutable resources (a transaction, operation or closed ledger) go to the server with the lowest
+recent latency. one that didn't answer within HORIZON_HEDGE_AFTER_MS, or failed or wasn't found before,
+is sent to the next fastest server as well, and the first found answer wins.
+a server that fails counts as slow as the timeout, until it answers fast again.
+
+busy replies (429, 5xx) are not retried by the connection pool - they reach the transport, which pauses
+the token bucket on a 429 and retries them itself. only connection errors are retried by the pool.
+
+a forked child process drops the connections and threads it inherited - its parent keeps using them.
+"""
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import List
+from urllib.parse import urlparse
+
+from kin.blockchain.horizon import DEFAULT_NUM_RETRIES, Horizon, check_horizon_reply
+from kin.config import SDK_USER_AGENT
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util import Retry
+
+from . import config
+from .log import get as get_log
+from .statsd import statsd
+
+log = get_log()
+LATENCY_WEIGHT = 0.2  # of the last request in the moving average latency of a server
+# the same on every server once there - a transaction, an operation or a ledger, and their sub resources
+IMMUTABLE_RESOURCE = re.compile(r'^/(transactions|operations|ledgers)/[^/?]+')
+
+
+class TokenBucket:
+    """allow `rate` requests a second on average, and bursts of up to `burst` - shared by all threads."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """wait for a token."""
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_secs = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            statsd.increment('horizon.throttled')
+            time.sleep(wait_secs)
+
+    def pause(self, secs):
+        """hold all requests for a while - horizon said we're over its limit."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + secs)
+            self.tokens = 0
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+
+
+class HorizonTransport(Horizon):
+    """a horizon client over many servers of the same network. used by KinClient and KinAccount."""
+
+    def __init__(self, horizon_uris: List[str], pool_size, request_timeout, rate_limiter: TokenBucket, hedge_after_ms=0,
+                 num_retries=DEFAULT_NUM_RETRIES):
+        super(HorizonTransport, self).__init__(horizon_uris[0], pool_size=pool_size, request_timeout=request_timeout,
+                                               num_retries=num_retries, user_agent=SDK_USER_AGENT)
+        self.horizon_uris = horizon_uris
+        self.rate_limiter = rate_limiter
+        self.hedge_after = hedge_after_ms / 1000
+        self.pool_size = pool_size
+        self.latency = {uri: 0.0 for uri in horizon_uris}  # moving average, seconds
+        self.pinned = None  # the server of the submits and mutable reads
+        self.lock = threading.Lock()
+        self.hedge_pool = ThreadPoolExecutor(pool_size) if len(horizon_uris) > 1 and hedge_after_ms else None
+        # replaces the adapter of the sdk, which retries busy replies without waiting for the token bucket
+        retry = Retry(total=self.num_retries, connect=self.num_retries, read=0, status=0, redirect=0,
+                      backoff_factor=self.backoff_factor, respect_retry_after_header=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def after_fork(self):
+        """open new connections and threads in a forked child - the inherited ones are its parent's."""
+        self._session.close()  # closes the child's copies of the sockets, the parent's stay open
+        self.lock = threading.Lock()
+        self.rate_limiter.after_fork()
+        if self.hedge_pool:
+            self.hedge_pool = ThreadPoolExecutor(self.pool_size)
+
+    def by_latency(self) -> List[str]:
+        """the servers, fastest first."""
+        if len(self.horizon_uris) == 1:
+            return [self.horizon_uri]
+        with self.lock:
+            return sorted(self.horizon_uris, key=self.latency.get)
+
+    def pinned_uri(self) -> str:
+        """the server of the submits and mutable reads - the fastest one, until it fails."""
+        if len(self.horizon_uris) == 1:
+            return self.horizon_uri
+        fastest = self.by_latency()[0]
+        with self.lock:
+            if self.pinned is None:
+                self.pinned = fastest
+            return self.pinned
+
+    def _record(self, uri, method, rel_url, latency, ok):
+        with self.lock:
+            sample = latency if ok else max(latency, self.request_timeout)
+            average = self.latency.get(uri, 0.0)
+            self.latency[uri] = average + LATENCY_WEIGHT * (sample - average)
+            if not ok and uri == self.pinned:
+                self.pinned = None
+        resource = rel_url.strip('/').split('/')[0] or 'root'
+        statsd.histogram('horizon.latency', latency, tags=['endpoint:%s' % urlparse(uri).netloc,
+                                                          'method:%s' % method,
+                                                          'resource:%s' % resource,
+                                                          'ok:%s' % ok])
+
+    def _request(self, uri, method, rel_url, **kwargs):
+        self.rate_limiter.acquire()
+        start = time.time()
+        ok = False
+        try:
+            reply = self._session.request(method, uri + rel_url, timeout=self.request_timeout, **kwargs)
+            ok = reply.status_code < 500
+        finally:
+            self._record(uri, method, rel_url, time.time() - start, ok)
+        if reply.status_code == 429:
+            self.rate_limiter.pause(float(reply.headers.get('Retry-After') or 1))
+        elif reply.headers.get('X-Ratelimit-Remaining') == '0':
+            self.rate_limiter.pause(float(reply.headers.get('X-Ratelimit-Reset') or 1))
+        return reply
+
+    def _get(self, uri, rel_url, params):
+        """get from a server, retrying busy replies."""
+        for attempt in range(self.num_retries + 1):
+            reply = self._request(uri, 'GET', rel_url, params=params)
+            if reply.status_code not in self.status_forcelist or attempt == self.num_retries:
+                break
+            log.warning('horizon busy - retrying', uri=uri, rel_url=rel_url, status=reply.status_code)
+            time.sleep(self.backoff_factor)
+        try:
+            return reply.json()
+        except ValueError:
+            raise Exception('invalid horizon reply: [{}] {}'.format(reply.status_code, reply.text))
+
+    def _hedged_get(self, rel_url, params):
+        """get an immutable resource from the fastest server, and from the next one too if it's slow or failed."""
+        uris = self.by_latency()
+        if not self.hedge_pool:
+            return self._get(uris[0], rel_url, params)
+
+        pending = {self.hedge_pool.submit(self._get, uris[0], rel_url, params)}
+        hedge_at = time.time() + self.hedge_after
+        hedged = False
+        not_found, error = None, None
+        while pending:
+            timeout = None if hedged else max(0, hedge_at - time.time())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    reply = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if reply.get('status') != 404:
+                    return reply
+                not_found = reply  # the other server may be ahead
+            if not hedged:
+                hedged = True
+                statsd.increment('horizon.hedged', tags=['resource:%s' % rel_url.strip('/').split('/')[0],
+                                                        'reason:%s' % ('slow' if not done else 'failed')])
+                pending.add(self.hedge_pool.submit(self._get, uris[1], rel_url, params))
+        if not_found is not None:
+            return not_found
+        raise error
+
+    def query(self, rel_url, params=None, sse=False):
+        if sse:
+            self.rate_limiter.acquire()
+            return self._query(self.pinned_uri() + rel_url, params, sse)
+        if IMMUTABLE_RESOURCE.match(rel_url):
+            return check_horizon_reply(self._hedged_get(rel_url, params))
+        return check_horizon_reply(self._get(self.pinned_uri(), rel_url, params))
+
+    def submit(self, te):
+        """submit a transaction to the pinned server, retrying on network errors and busy replies."""
+        for attempt in range(self.num_retries + 1):
+            uri = self.pinned_uri()
+            reply = None
+            try:
+                reply = self._request(uri, 'POST', '/transactions/', data={'tx': te})
+                if reply.status_code in self.status_forcelist and attempt < self.num_retries:
+                    log.warning('horizon busy - retrying submit', uri=uri, status=reply.status_code)
+                    time.sleep(self.backoff_factor)
+                    continue
+                return check_horizon_reply(reply.json())
+            except (RequestException, ValueError) as e:
+                log.warning('horizon submit failed', error=str(e), uri=uri,
+                            status=reply.status_code if reply is not None else None)
+                if reply is not None and reply.status_code not in self.status_forcelist:
+                    raise Exception('invalid horizon reply: [{}] {}'.format(reply.status_code, reply.text))
+                if attempt == self.num_retries:
+                    raise
+                time.sleep(self.backoff_factor)
+
+
+_lock = threading.Lock()
+_transport = None
+
+
+def get_transport() -> HorizonTransport:
+    """the transport of this process, created on first use."""
+    global _transport
+    with _lock:
+        if _transport is None:
+            _transport = HorizonTransport(config.STELLAR_HORIZON_URLS,
+                                          pool_size=config.HORIZON_POOL_SIZE,
+                                          request_timeout=config.HORIZON_TIMEOUT_SECS,
+                                          rate_limiter=TokenBucket(config.HORIZON_RATE_LIMIT, config.HORIZON_RATE_BURST),
+                                          hedge_after_ms=config.HORIZON_HEDGE_AFTER_MS)
+        return _transport
+
+
+def _after_fork():
+    global _lock
+    _lock = threading.Lock()
+    if _transport is not None:
+        _transport.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
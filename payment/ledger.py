@@ -0,0 +1,205 @@
+"""a compact, long lived store of the payments sent.
+
+every payment is packed into a short binary string under pay:<id>:
+    flags, app_id, amount, timestamp (ms) | sender | recipient | transaction id
+addresses are stored as their 32 raw key bytes and the transaction id as its 32 hash bytes. app ids,
+and any address or id that can't be decoded, are interned as small integers in a string table.
+
+payments are indexed by time, app_id and recipient in sorted sets scored by timestamp, and expire
+with their indexes after PAYMENT_RETENTION_SECS.
+"""
+import binascii
+import calendar
+import struct
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+from kin_base.utils import decode_check, encode_check
+
+from . import config
+from .redis_conn import redis_conn
+
+HEADER = struct.Struct('>BIqq')  # flags, app_id string, amount, timestamp in ms
+STRING_ID = struct.Struct('>I')
+RAW_SIZE = 32
+
+SENDER_INTERNED = 1
+RECIPIENT_INTERNED = 2
+TX_ID_INTERNED = 4
+
+# KEYS: string ids hash, strings hash, last id
+# ARGV: string
+INTERN_SCRIPT = """
+local id = redis.call('hget', KEYS[1], ARGV[1])
+if not id then
+    id = redis.call('incr', KEYS[3])
+    redis.call('hset', KEYS[1], ARGV[1], id)
+    redis.call('hset', KEYS[2], id, ARGV[1])
+end
+return tonumber(id)
+"""
+
+
+class StringTable:
+    """repeated strings interned as integers, cached in the process - entries never change."""
+    _ids = {}
+    _strings = {}
+    _intern = redis_conn.register_script(INTERN_SCRIPT)
+    KEYS = ['strings:ids', 'strings:values', 'strings:last_id']
+
+    @classmethod
+    def get_id(cls, string: str) -> int:
+        string_id = cls._ids.get(string)
+        if string_id is None:
+            string_id = cls._intern(keys=cls.KEYS, args=[string])
+            cls._ids[string] = string_id
+            cls._strings[string_id] = string
+        return string_id
+
+    @classmethod
+    def get_string(cls, string_id: int) -> str:
+        string = cls._strings.get(string_id)
+        if string is None:
+            string = redis_conn.hget(cls.KEYS[1], string_id).decode('utf8')
+            cls._strings[string_id] = string
+            cls._ids[string] = string_id
+        return string
+
+
+def _pack_field(value: Optional[str], decode) -> (bool, bytes):
+    """return whether the value was interned, and its bytes."""
+    try:
+        raw = decode(value)
+        if len(raw) == RAW_SIZE:
+            return False, raw
+    except Exception:
+        pass
+    return True, STRING_ID.pack(StringTable.get_id(value or ''))
+
+
+def _unpack_field(data: bytes, offset: int, interned: bool, encode) -> (Optional[str], int):
+    """return the value and the offset after it."""
+    if interned:
+        string = StringTable.get_string(STRING_ID.unpack_from(data, offset)[0])
+        return string or None, offset + STRING_ID.size
+    return encode(data[offset:offset + RAW_SIZE]), offset + RAW_SIZE
+
+
+def _decode_address(address):
+    return decode_check('account', address)
+
+
+def _encode_address(raw):
+    return encode_check('account', raw).decode()
+
+
+def _decode_tx_id(tx_id):
+    return binascii.unhexlify(tx_id)
+
+
+def _encode_tx_id(raw):
+    return binascii.hexlify(raw).decode()
+
+
+def _to_ms(timestamp: datetime) -> int:
+    return calendar.timegm(timestamp.utctimetuple()) * 1000 + timestamp.microsecond // 1000
+
+
+def pack(payment) -> bytes:
+    sender_interned, sender = _pack_field(payment.sender_address, _decode_address)
+    recipient_interned, recipient = _pack_field(payment.recipient_address, _decode_address)
+    tx_id_interned, tx_id = _pack_field(payment.transaction_id, _decode_tx_id)
+    flags = ((SENDER_INTERNED if sender_interned else 0) |
+             (RECIPIENT_INTERNED if recipient_interned else 0) |
+             (TX_ID_INTERNED if tx_id_interned else 0))
+    header = HEADER.pack(flags, StringTable.get_id(payment.app_id or ''), payment.amount or 0, _to_ms(payment.timestamp))
+    return header + sender + recipient + tx_id
+
+
+def unpack(payment_id: str, data: bytes) -> dict:
+    flags, app_id, amount, timestamp = HEADER.unpack_from(data)
+    offset = HEADER.size
+    sender, offset = _unpack_field(data, offset, flags & SENDER_INTERNED, _encode_address)
+    recipient, offset = _unpack_field(data, offset, flags & RECIPIENT_INTERNED, _encode_address)
+    tx_id, offset = _unpack_field(data, offset, flags & TX_ID_INTERNED, _encode_tx_id)
+    return {
+        'id': payment_id,
+        'app_id': StringTable.get_string(app_id) or None,
+        'transaction_id': tx_id,
+        'recipient_address': recipient,
+        'sender_address': sender,
+        'amount': amount,
+        'timestamp': datetime.utcfromtimestamp(timestamp / 1000),
+    }
+
+
+def _key(payment_id):
+    return 'pay:%s' % payment_id
+
+
+def _time_index():
+    return 'pay:index:time'
+
+
+def _app_index(app_id):
+    return 'pay:index:app:%s' % app_id
+
+
+def _recipient_index(address):
+    return 'pay:index:recipient:%s' % address
+
+
+def save(payment):
+    """store a payment with its indexes, dropping index entries older than the retention."""
+    retention = config.PAYMENT_RETENTION_SECS
+    score = _to_ms(payment.timestamp) / 1000
+    oldest = time.time() - retention
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.set(_key(payment.id), pack(payment), ex=retention)
+    for index in (_time_index(), _app_index(payment.app_id), _recipient_index(payment.recipient_address)):
+        pipe.zadd(index, score, payment.id)
+        pipe.zremrangebyscore(index, '-inf', oldest)
+    pipe.expire(_app_index(payment.app_id), retention)
+    pipe.expire(_recipient_index(payment.recipient_address), retention)
+    pipe.execute()
+
+
+def get(payment_id) -> Optional[dict]:
+    data = redis_conn.get(_key(payment_id))
+    return unpack(payment_id, data) if data else None
+
+
+def get_many(payment_ids: List[str]) -> Dict[str, dict]:
+    """get the stored payments of the given ids, with a single query."""
+    if not payment_ids:
+        return {}
+    return {payment_id: unpack(payment_id, data)
+            for payment_id, data in zip(payment_ids, redis_conn.mget([_key(i) for i in payment_ids]))
+            if data}
+
+
+def export(since=None, until=None, app_id=None, recipient_address=None, batch_size=1000) -> Iterator[dict]:
+    """yield the stored payments in time order, optionally of an app or a recipient, between epoch seconds."""
+    if recipient_address:
+        index = _recipient_index(recipient_address)
+    elif app_id:
+        index = _app_index(app_id)
+    else:
+        index = _time_index()
+    start = '-inf' if since is None else since
+    end = '+inf' if until is None else until
+
+    offset = 0
+    while True:
+        payment_ids = [i.decode('utf8') for i in redis_conn.zrangebyscore(index, start, end, offset, batch_size)]
+        if not payment_ids:
+            return
+        payments = get_many(payment_ids)
+        for payment_id in payment_ids:
+            payment = payments.get(payment_id)
+            if payment and (not app_id or payment['app_id'] == app_id):
+                yield payment
+        if len(payment_ids) < batch_size:
+            return
+        offset += batch_size
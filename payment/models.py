@@ -1,22 +1,67 @@
 import json
-from typing import Union, List, Dict
+import time
+from typing import Union, List, Dict, Set, Iterable, Iterator, Tuple
 from collections import namedtuple
+from uuid import uuid4
 from datetime import datetime
 from schematics import Model
-from schematics.types import StringType, IntType, DateTimeType, ListType
+from schematics.types import StringType, IntType, DateTimeType, ListType, BaseType
 from kin.transactions import NATIVE_ASSET_TYPE, SimplifiedTransaction
 from kin import decode_transaction
 from kin import KinErrors
 
 from .errors import PaymentNotFoundError, ParseError, TransactionMismatch
 
+from . import config
+from . import ledger
 from .redis_conn import redis_conn
+from .statsd import statsd
 from .log import get as get_logger
 
 log = get_logger()
 Memo = namedtuple('Memo', ['app_id', 'payment_id'])
 ADDRESS_EXP_SECS = 60 * 60  # one hour
 
+# move up to `count` of the oldest pending requests to a processing list, leased until the given time
+# KEYS: pending list, processing list, processing zset
+# ARGV: count, processing zset member, lease expiry
+TAKE_PENDING_SCRIPT = """
+local items = redis.call('lrange', KEYS[1], 0, ARGV[1] - 1)
+if #items == 0 then
+    return items
+end
+redis.call('ltrim', KEYS[1], #items, -1)
+redis.call('rpush', KEYS[2], unpack(items))
+redis.call('zadd', KEYS[3], ARGV[3], ARGV[2])
+return items
+"""
+# put the requests of a processing list back at the head of the pending list, in their order
+# KEYS: processing list, pending list, processing zset
+# ARGV: processing zset member
+RESTORE_PENDING_SCRIPT = """
+local items = redis.call('lrange', KEYS[1], 0, -1)
+for i = #items, 1, -1 do
+    redis.call('lpush', KEYS[2], items[i])
+end
+redis.call('del', KEYS[1])
+redis.call('zrem', KEYS[3], ARGV[1])
+return #items
+"""
+# remove all watches of a service from the watched addresses index, with any added while removing
+# KEYS: index zset, service zset, version
+REMOVE_SERVICE_WATCHES_SCRIPT = """
+local members = redis.call('zrange', KEYS[2], 0, -1)
+for i = 1, #members, 1000 do
+    redis.call('zrem', KEYS[1], unpack(members, i, math.min(i + 999, #members)))
+end
+redis.call('del', KEYS[2])
+redis.call('incr', KEYS[3])
+return #members
+"""
+take_pending_script = redis_conn.register_script(TAKE_PENDING_SCRIPT)
+restore_pending_script = redis_conn.register_script(RESTORE_PENDING_SCRIPT)
+remove_service_watches_script = redis_conn.register_script(REMOVE_SERVICE_WATCHES_SCRIPT)
+
 
 class ModelWithStr(Model):
     def __str__(self):
@@ -59,6 +104,10 @@ class PaymentRequest(ModelWithStr):
     callback = StringType(required=True)  # a webhook to call when a payment is complete
 
 
+class PaymentStatusRequest(ModelWithStr):
+    ids = ListType(StringType, required=True, min_size=1, max_size=1000)
+
+
 class WhitelistRequest(ModelWithStr):
     id = StringType(required=True)  # AKA order id
     sender_address = StringType(required=True)
@@ -99,9 +148,9 @@ class WhitelistRequest(ModelWithStr):
 
     def whitelist(self) -> str:
         """Sign and return a transaction to whitelist it"""
-        from .blockchain import root_account
-        return root_account.whitelist_transaction({'envelope': self.transaction,
-                                                  'network_id': self.network_id})
+        from .blockchain import get_root_account
+        return get_root_account().whitelist_transaction({'envelope': self.transaction,
+                                                         'network_id': self.network_id})
 
 
 class SubmitTransactionRequest(WhitelistRequest):
@@ -109,14 +158,13 @@ class SubmitTransactionRequest(WhitelistRequest):
 
 
 class Payment(ModelWithStr):
-    PAY_STORE_TIME = 500
     id = StringType()
     app_id = StringType()
     transaction_id = StringType()
     recipient_address = StringType()
     sender_address = StringType()
     amount = IntType()
-    timestamp = DateTimeType(default=datetime.utcnow())
+    timestamp = DateTimeType(default=datetime.utcnow)  # when the payment was made, not when the module was loaded
 
     @classmethod
     def from_payment_request(cls, request: Union[PaymentRequest, SubmitTransactionRequest], sender_address: str, tx_id: str):
@@ -131,9 +179,10 @@ class Payment(ModelWithStr):
 
     @classmethod
     def from_blockchain(cls, data: SimplifiedTransaction):
+        memo = cls.parse_memo(data.memo)
         p = Payment()
-        p.id = cls.parse_memo(data.memo).payment_id
-        p.app_id = cls.parse_memo(data.memo).app_id
+        p.id = cls.get_payment_id(memo, 0)  # a simplified transaction has a single operation
+        p.app_id = memo.app_id
         p.transaction_id = data.id
         p.sender_address = data.source
         p.recipient_address = data.operation.destination
@@ -141,6 +190,22 @@ class Payment(ModelWithStr):
         p.timestamp = datetime.strptime(data.timestamp, '%Y-%m-%dT%H:%M:%SZ')  # 2018-11-12T06:45:40Z
         return p
 
+    @classmethod
+    def from_record(cls, record: "TransactionRecord"):
+        """parse a payment operation record that has its transaction embedded."""
+        if record.transaction.get('memo_type') != 'text':
+            raise ParseError
+        memo = cls.parse_memo(record.transaction.get('memo'))
+        p = Payment()
+        p.id = cls.get_payment_id(memo, PaymentBatch.operation_index(record.paging_token))
+        p.app_id = memo.app_id
+        p.transaction_id = record.transaction_hash
+        p.sender_address = record.from_address
+        p.recipient_address = record.to_address
+        p.amount = int(float(record.amount))
+        p.timestamp = datetime.strptime(record.transaction['created_at'], '%Y-%m-%dT%H:%M:%SZ')  # 2018-11-12T06:45:40Z
+        return p
+
     @classmethod
     def parse_memo(cls, memo):
         try:
@@ -149,6 +214,13 @@ class Payment(ModelWithStr):
         except Exception:
             raise ParseError
 
+    @classmethod
+    def get_payment_id(cls, memo: Memo, op_index: int) -> str:
+        """the id of the payment of an operation - a batch memo is resolved to the payment its operation paid."""
+        if PaymentBatch.is_batch(memo.payment_id):
+            return PaymentBatch.get_payment_id(memo.payment_id, op_index) or memo.payment_id
+        return memo.payment_id
+
     @classmethod
     def create_memo(cls, app_id, payment_id):
         """serialize args to the memo string."""
@@ -156,25 +228,362 @@ class Payment(ModelWithStr):
 
     @classmethod
     def get(cls, payment_id):
-        data = redis_conn.get(cls._key(payment_id))
+        data = ledger.get(payment_id)
+        if data:
+            return Payment(data)
+        data = redis_conn.get(cls._key(payment_id))  # saved before the ledger
         if not data:
             raise PaymentNotFoundError('payment {} not found'.format(payment_id))
         return Payment(json.loads(data.decode('utf8')))
 
+    @classmethod
+    def get_states(cls, payment_ids: List[str]) -> List[dict]:
+        """get the state of many payments, with the payment itself for the confirmed ones."""
+        payments = ledger.get_many(payment_ids)
+        states = PaymentState.get_many([payment_id for payment_id in payment_ids if payment_id not in payments])
+        result = []
+        for payment_id in payment_ids:
+            if payment_id in payments:
+                result.append({'id': payment_id,
+                               'state': PaymentState.CONFIRMED,
+                               'payment': Payment(payments[payment_id]).to_primitive()})
+            else:
+                result.append(states[payment_id] or {'id': payment_id, 'state': None})
+        return result
+
+    @classmethod
+    def export(cls, since=None, until=None, app_id=None, recipient_address=None) -> Iterator["Payment"]:
+        """yield the stored payments in time order, optionally of an app or a recipient, between epoch seconds."""
+        for data in ledger.export(since, until, app_id, recipient_address):
+            yield Payment(data)
+
     @classmethod
     def _key(cls, id):
         return 'payment:{}'.format(id)
 
     def save(self):
-        redis_conn.set(self._key(self.id),
-                       json.dumps(self.to_primitive()),
-                       ex=self.PAY_STORE_TIME)
+        ledger.save(self)
+
+
+class PaymentBatch:
+    """payments sent together in one multi-operation transaction.
+
+    the transaction memo is '1-<app_id>-batch_<hex>' (a payment id can't fit), and the batch
+    keeps the payment ids in operation order - operation i of the transaction pays payment_ids[i].
+    """
+    MEMO_PREFIX = 'batch_'
+    STORE_TIME = 7 * 24 * 60 * 60
+
+    @classmethod
+    def new_id(cls):
+        return cls.MEMO_PREFIX + uuid4().hex[:12]
+
+    @classmethod
+    def is_batch(cls, payment_id):
+        return payment_id.startswith(cls.MEMO_PREFIX)
+
+    @classmethod
+    def _key(cls, batch_id):
+        return 'payment_batch:%s' % batch_id
+
+    @classmethod
+    def save(cls, batch_id, payment_ids: List[str]):
+        pipe = redis_conn.pipeline()
+        pipe.rpush(cls._key(batch_id), *payment_ids)
+        pipe.expire(cls._key(batch_id), cls.STORE_TIME)
+        pipe.execute()
+
+    @classmethod
+    def get_payment_ids(cls, batch_id) -> List[str]:
+        return [payment_id.decode('utf8') for payment_id in redis_conn.lrange(cls._key(batch_id), 0, -1)]
+
+    @classmethod
+    def get_payment_id(cls, batch_id, op_index) -> Union[str, None]:
+        """the id of the payment that an operation of the batch paid - None if the batch isn't known."""
+        payment_id = redis_conn.lindex(cls._key(batch_id), op_index)
+        return payment_id.decode('utf8') if payment_id else None
+
+    @staticmethod
+    def operation_index(paging_token) -> int:
+        """the index of an operation in its transaction: the low 12 bits of its id (the paging token), from 1."""
+        return (int(paging_token) & 0xfff) - 1
+
+
+class PaymentState:
+    """where a payment is on its way: queued -> channel_acquired -> submitted -> confirmed / failed.
+
+    a failed payment whose job is retried goes back to channel_acquired. every state change is one
+    pipelined hash write, kept for STORE_TIME - confirmed payments are in the ledger after that.
+    a payment may be sent again once failed, or once its state didn't change for longer than a job may run.
+    """
+    QUEUED = 'queued'
+    CHANNEL_ACQUIRED = 'channel_acquired'
+    SUBMITTED = 'submitted'
+    CONFIRMED = 'confirmed'
+    FAILED = 'failed'
+    IN_FLIGHT = (QUEUED, CHANNEL_ACQUIRED, SUBMITTED)
+    STORE_TIME = 24 * 60 * 60
+
+    @classmethod
+    def _key(cls, payment_id):
+        return 'payment_state:%s' % payment_id
+
+    @classmethod
+    def set(cls, payment_ids: Union[str, List[str]], state: str, reason: str = None, pipe=None):
+        """set the state of one or many payments, on the given pipeline if any."""
+        if isinstance(payment_ids, str):
+            payment_ids = [payment_ids]
+        values = {'state': state, 'updated_at': time.time(), 'reason': reason or ''}
+        _pipe = pipe or redis_conn.pipeline(transaction=False)
+        for payment_id in payment_ids:
+            _pipe.hmset(cls._key(payment_id), values)
+            _pipe.expire(cls._key(payment_id), cls.STORE_TIME)
+        if not pipe:
+            _pipe.execute()
+
+    @classmethod
+    def _parse(cls, payment_id, data) -> Union[dict, None]:
+        if not data:
+            return None
+        data = {k.decode('utf8'): v.decode('utf8') for k, v in data.items()}
+        return {'id': payment_id,
+                'state': data['state'],
+                'updated_at': datetime.utcfromtimestamp(float(data['updated_at'])).isoformat(),
+                'reason': data['reason'] or None}
+
+    @classmethod
+    def get(cls, payment_id) -> Union[dict, None]:
+        return cls._parse(payment_id, redis_conn.hgetall(cls._key(payment_id)))
+
+    @classmethod
+    def get_many(cls, payment_ids: List[str]) -> Dict[str, Union[dict, None]]:
+        """get the states of many payments with a single query - None for the unknown ones."""
+        pipe = redis_conn.pipeline(transaction=False)
+        for payment_id in payment_ids:
+            pipe.hgetall(cls._key(payment_id))
+        return {payment_id: cls._parse(payment_id, data) for payment_id, data in zip(payment_ids, pipe.execute())}
+
+
+class PendingRequests:
+    """requests of an app waiting to be handled in a batch.
+
+    a job takes the requests it handles into a processing list of its own, leased for LEASE_SECS. it puts
+    them back if it fails before handling them, and recover() puts back those of jobs that died holding them.
+    """
+    POLL_INTERVAL = 0.01
+    LEASE_SECS = 10 * 60  # longer than any job runs
+    NAME = None
+    MODEL = None
+
+    @classmethod
+    def _key(cls, app_id):
+        return '%s:pending:%s' % (cls.NAME, app_id)
+
+    @classmethod
+    def _processing_key(cls):
+        return '%s:processing' % cls.NAME
+
+    @classmethod
+    def _taken_key(cls, taken_id):
+        return '%s:processing:%s' % (cls.NAME, taken_id)
+
+    @classmethod
+    def _member(cls, app_id, taken_id):
+        return json.dumps([app_id, taken_id])
+
+    @classmethod
+    def item(cls, request: Union[PaymentRequest, WalletRequest]) -> str:
+        """serialize a pending request."""
+        return json.dumps({'queued_at': time.time(), 'request': request.to_primitive()})
+
+    @classmethod
+    def push(cls, request: Union[PaymentRequest, WalletRequest]):
+        redis_conn.rpush(cls._key(request.app_id), cls.item(request))
+
+    @classmethod
+    def wait(cls, app_id, size, wait_secs):
+        """wait until `size` requests are pending, or the oldest one waited `wait_secs`."""
+        while True:
+            pipe = redis_conn.pipeline()
+            pipe.llen(cls._key(app_id))
+            pipe.lindex(cls._key(app_id), 0)
+            count, oldest = pipe.execute()
+            if not oldest or count >= size:
+                return
+            remaining = json.loads(oldest.decode('utf8'))['queued_at'] + wait_secs - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, cls.POLL_INTERVAL))
+
+    @classmethod
+    def take(cls, app_id, size) -> Tuple[str, list]:
+        """atomically move up to `size` of the oldest pending requests to a processing list.
+
+        return the id of the processing list, to release or restore it with, and the requests.
+        """
+        taken_id = uuid4().hex
+        items = take_pending_script(keys=[cls._key(app_id), cls._taken_key(taken_id), cls._processing_key()],
+                                    args=[size, cls._member(app_id, taken_id), time.time() + cls.LEASE_SECS])
+        return taken_id, [cls.MODEL(json.loads(item.decode('utf8'))['request']) for item in items]
+
+    @classmethod
+    def release(cls, app_id, taken_id):
+        """drop a processing list - its requests were handled."""
+        pipe = redis_conn.pipeline()
+        pipe.delete(cls._taken_key(taken_id))
+        pipe.zrem(cls._processing_key(), cls._member(app_id, taken_id))
+        pipe.execute()
+
+    @classmethod
+    def restore(cls, app_id, taken_id) -> int:
+        """put the requests of a processing list back at the head of the pending requests. return their number."""
+        return restore_pending_script(keys=[cls._taken_key(taken_id), cls._key(app_id), cls._processing_key()],
+                                      args=[cls._member(app_id, taken_id)])
+
+    @classmethod
+    def recover(cls) -> Set[str]:
+        """put back the requests of jobs whose lease expired - they died holding them. return the apps of those."""
+        apps = set()
+        for member in redis_conn.zrangebyscore(cls._processing_key(), '-inf', time.time()):
+            app_id, taken_id = json.loads(member.decode('utf8'))
+            if cls.restore(app_id, taken_id):
+                log.info('recovered pending requests of a dead job', name=cls.NAME, app_id=app_id)
+                apps.add(app_id)
+        return apps
+
+
+class PendingPayments(PendingRequests):
+    NAME = 'payments'
+    MODEL = PaymentRequest
+
+
+class PendingWallets(PendingRequests):
+    NAME = 'wallets'
+    MODEL = WalletRequest
+
+
+class WatchedAddresses:
+    """index of the addresses watched by services, maintained incrementally by Service.
+
+    every watch is a member of one sorted set, scored by the time it expires at (permanent watches never do).
+    a version counter is bumped on every change, so readers reload the index only when it changed.
+    """
+    PERMANENT = float('inf')
+
+    @classmethod
+    def _key(cls):
+        return 'watchers'
+
+    @classmethod
+    def _service_key(cls, service_id):
+        return 'service:%s:watchers' % service_id
+
+    @classmethod
+    def _version_key(cls):
+        return 'watchers:version'
+
+    @classmethod
+    def _migrated_key(cls):
+        return 'watchers:migrated'
+
+    @classmethod
+    def _member(cls, service_id, address, payment_id=None):
+        return json.dumps([address, service_id, payment_id])
+
+    @classmethod
+    def add(cls, pipe, service_id, address, payment_id=None, expire_at=PERMANENT):
+        """add a watch to the index as part of the given pipeline."""
+        member = cls._member(service_id, address, payment_id)
+        pipe.zadd(cls._key(), expire_at, member)
+        pipe.zadd(cls._service_key(service_id), expire_at, member)
+        cls.bump_version(pipe)
+
+    @classmethod
+    def remove(cls, pipe, service_id, address, payment_id=None):
+        """remove a watch from the index as part of the given pipeline."""
+        member = cls._member(service_id, address, payment_id)
+        pipe.zrem(cls._key(), member)
+        pipe.zrem(cls._service_key(service_id), member)
+        cls.bump_version(pipe)
+
+    @classmethod
+    def remove_service(cls, pipe, service_id):
+        """remove all watches of a service as part of the given pipeline."""
+        remove_service_watches_script(keys=[cls._key(), cls._service_key(service_id), cls._version_key()],
+                                      client=pipe)
+
+    @classmethod
+    def bump_version(cls, pipe):
+        """tell the readers the index changed, as part of the given pipeline."""
+        pipe.incr(cls._version_key())
+
+    @classmethod
+    def _parse(cls, members_with_scores) -> Dict[str, Dict[str, float]]:
+        watchers = {}
+        for member, expire_at in members_with_scores:
+            address, service_id, payment_id = json.loads(member.decode('utf8'))
+            service_watches = watchers.setdefault(address, {})
+            service_watches[service_id] = max(expire_at, service_watches.get(service_id, 0))
+        return watchers
+
+    @classmethod
+    def get_all(cls) -> Dict[str, Dict[str, float]]:
+        """get a map of every watched address to the ids of the services watching it and when they stop."""
+        now = time.time()
+        pipe = redis_conn.pipeline()
+        pipe.zremrangebyscore(cls._key(), '-inf', now)
+        pipe.zrangebyscore(cls._key(), '(%s' % now, '+inf', withscores=True)
+        _, members = pipe.execute()
+        return cls._parse(members)
+
+    @classmethod
+    def get_service_addresses(cls, service_id) -> Set[str]:
+        """get the addresses a single service is watching."""
+        now = time.time()
+        pipe = redis_conn.pipeline()
+        pipe.zremrangebyscore(cls._service_key(service_id), '-inf', now)
+        pipe.zrangebyscore(cls._service_key(service_id), '(%s' % now, '+inf', withscores=True)
+        _, members = pipe.execute()
+        return set(cls._parse(members).keys())
+
+    @classmethod
+    def version(cls):
+        """return a token that changes whenever the index changes."""
+        version, migrated = redis_conn.mget(cls._version_key(), cls._migrated_key())
+        if not migrated:
+            cls._migrate()
+            version = redis_conn.get(cls._version_key())
+        return version
+
+    @classmethod
+    def _migrate(cls):
+        """index the watches that were saved before the index existed."""
+        log.info('indexing watched addresses')
+        pipe = redis_conn.pipeline()
+        for service in Service.get_all():
+            if not service:
+                continue
+            for address in service.wallet_addresses:
+                cls.add(pipe, service.service_id, address)
+        now = time.time()
+        for key in redis_conn.scan_iter('service:*:address:*'):
+            ttl = redis_conn.ttl(key)
+            if ttl is None or ttl <= 0:
+                continue
+            service_id, address = key.decode('utf8')[len('service:'):].rsplit(':address:', 1)
+            cls.add(pipe, service_id, address, expire_at=now + ttl)
+        cls.bump_version(pipe)
+        pipe.set(cls._migrated_key(), 1)
+        pipe.execute()
 
 
 class Service(ModelWithStr):
     callback = StringType(required=True)  # a webhook to call when a payment is complete
     service_id = StringType(required=True)
     wallet_addresses = ListType(StringType, required=True)  # permanent addresses
+    # opt into batched callbacks: up to batch_size payments, collected for up to batch_wait_ms, in one post
+    batch_size = IntType(min_value=1, max_value=100)
+    batch_wait_ms = IntType(min_value=0, max_value=60000)
 
     @classmethod
     def _key(cls, service_id):
@@ -191,61 +600,83 @@ class Service(ModelWithStr):
             return None
         return cls(json.loads(data.decode('utf8')))
 
+    @classmethod
+    def get_many(cls, service_ids) -> Dict[str, "Service"]:
+        """get a map of service_id to service for all given ids that exist, with a single query."""
+        service_ids = list(service_ids)
+        if not service_ids:
+            return {}
+        services = {}
+        for service_id, data in zip(service_ids, redis_conn.mget([cls._key(i) for i in service_ids])):
+            if data:
+                services[service_id] = cls(json.loads(data.decode('utf8')))
+        return services
+
     @classmethod
     def get_all(cls):
         return [cls.get(service_id.decode('utf8'))
                 for service_id
                 in redis_conn.smembers(cls._all_services_key())]  # XXX what type returns?
 
-    def _get_all_temp_watching_addresses(self):
-        def address_from_key(key):
-            try:
-                return key.decode('utf8').rsplit(':', 1)[-1]
-            except:
-                log.exception('failed address_from_key %s' % key)
-
-        # first get the time limited addresses
-        return set(address_from_key(key)
-                   for key
-                   in redis_conn.keys('service:%s:address:*' % self.service_id))
-
     def _get_all_watching_addresses(self):
         """return set of all watching addresses."""
-        return self._get_all_temp_watching_addresses() | set(self.wallet_addresses)
+        WatchedAddresses.version()  # make sure the index was built
+        return WatchedAddresses.get_service_addresses(self.service_id)
 
     @classmethod
     def get_all_watching_addresses(cls) -> Dict[str, List["Service"]]:
         """get all addresses watched by any service as map of address to list of services watching it."""
+        WatchedAddresses.version()  # make sure the index was built
+        watchers = WatchedAddresses.get_all()
+        return cls.from_watchers(watchers)
+
+    @classmethod
+    def from_watchers(cls, watchers: Dict[str, Iterable[str]], services: Dict[str, "Service"] = None) -> Dict[str, List["Service"]]:
+        """resolve a map of address to service ids into a map of address to services."""
+        if services is None:
+            services = cls.get_many(set(service_id for service_ids in watchers.values() for service_id in service_ids))
         addresses = {}
-        for service in cls.get_all():
-            service_addresses = service._get_all_watching_addresses()
-            for address in service_addresses:
-                if address not in addresses:
-                    addresses[address] = []
-                addresses[address].append(service)
+        for address, service_ids in watchers.items():
+            address_services = [services[service_id] for service_id in service_ids if service_id in services]
+            if address_services:
+                addresses[address] = address_services
 
         return addresses
 
     def save(self):
-        redis_conn.set(self._key(self.service_id), json.dumps(self.to_primitive()))
-        redis_conn.sadd(self._all_services_key(), self.service_id)
+        old_service = self.get(self.service_id)
+        old_addresses = set(old_service.wallet_addresses) if old_service else set()
+
+        pipe = redis_conn.pipeline()
+        pipe.set(self._key(self.service_id), json.dumps(self.to_primitive()))
+        pipe.sadd(self._all_services_key(), self.service_id)
+        for address in old_addresses - set(self.wallet_addresses):
+            WatchedAddresses.remove(pipe, self.service_id, address)
+        for address in set(self.wallet_addresses) - old_addresses:
+            WatchedAddresses.add(pipe, self.service_id, address)
+        WatchedAddresses.bump_version(pipe)  # the callback might have changed too
+        pipe.execute()
 
     def delete(self):
-        redis_conn.delete(self._key(self.service_id))
-        redis_conn.srem(self._all_services_key(), self.service_id)
-
-    def _address_payments_key(self, address):
-        return 'service:%s:address:%s' % (self.service_id, address)
+        pipe = redis_conn.pipeline()
+        pipe.delete(self._key(self.service_id))
+        pipe.srem(self._all_services_key(), self.service_id)
+        WatchedAddresses.remove_service(pipe, self.service_id)
+        pipe.execute()
 
     def watch_payment(self, address, payment_id):
         """start looking for payment_id on given address."""
-        # ignoring payment_id
-        key = self._address_payments_key(address)
-        redis_conn.set(key, address, ADDRESS_EXP_SECS)
+        if address in self.wallet_addresses:
+            return  # permanently watched anyway
+        pipe = redis_conn.pipeline()
+        WatchedAddresses.add(pipe, self.service_id, address, payment_id, time.time() + ADDRESS_EXP_SECS)
+        pipe.execute()
 
     def unwatch_payment(self, address, payment_id):
-        # ignoring payment_id
-        return
+        """stop looking for payment_id on given address. other payments on the address are still watched."""
+        pipe = redis_conn.pipeline()
+        WatchedAddresses.remove(pipe, self.service_id, address, payment_id)
+        pipe.execute()
 
 
 class TransactionRecord(ModelWithStr):
@@ -255,6 +686,140 @@ class TransactionRecord(ModelWithStr):
     asset_type = StringType()
     paging_token = StringType(required=True)
     type = StringType(required=True)
+    amount = StringType()
+    transaction = BaseType()  # the parent transaction, when horizon embedded it
+
+
+class PaymentHistory:
+    """locally stored payment history of an address, ordered by horizon paging token.
+
+    the history is synced incrementally from the stored cursor and expires when it isn't read for a while.
+    """
+    PAGE_SIZE = 100
+
+    @classmethod
+    def _key(cls, address):
+        return 'address:%s:payments' % address
+
+    @classmethod
+    def _data_key(cls, address):
+        return 'address:%s:payments:data' % address
+
+    @classmethod
+    def _state_key(cls, address):
+        return 'address:%s:payments:state' % address
+
+    @classmethod
+    def _member(cls, paging_token):
+        """paging tokens are padded so that their lexical order is their numeric order."""
+        return '%020d' % int(paging_token)
+
+    @classmethod
+    def add(cls, pipe, address, paging_token, payment: Payment):
+        """add a payment to the history of an address as part of the given pipeline."""
+        member = cls._member(paging_token)
+        pipe.zadd(cls._key(address), 0, member)
+        pipe.hset(cls._data_key(address), member, json.dumps(payment.to_primitive()))
+
+    @classmethod
+    def add_if_tracked(cls, address, paging_token, payment: Payment):
+        """add a payment to the history of an address, only if that history is already being kept."""
+        if redis_conn.exists(cls._state_key(address)):
+            pipe = redis_conn.pipeline()
+            cls.add(pipe, address, paging_token, payment)
+            pipe.execute()
+
+    @classmethod
+    def get_state(cls, address):
+        """return the horizon cursor the history was synced up to and when, or (None, None) if it isn't kept."""
+        cursor, synced_at = redis_conn.hmget(cls._state_key(address), 'cursor', 'synced_at')
+        if cursor is None:
+            return None, None
+        return cursor.decode('utf8'), float(synced_at)
+
+    @classmethod
+    def save_state(cls, pipe, address, cursor):
+        """save the sync cursor as part of the given pipeline, and keep the history for another HISTORY_TTL_SECS."""
+        pipe.hmset(cls._state_key(address), {'cursor': cursor, 'synced_at': time.time()})
+        for key in (cls._key(address), cls._data_key(address), cls._state_key(address)):
+            pipe.expire(key, config.HISTORY_TTL_SECS)
+
+    @classmethod
+    def iter(cls, address, cursor=None, limit=None) -> Iterator[Tuple[str, str]]:
+        """yield (paging_token, payment json) of the payments after the given cursor, reading a page at a time."""
+        start = '(%s' % cls._member(cursor) if cursor else '-'
+        count = 0
+        while limit is None or count < limit:
+            num = cls.PAGE_SIZE if limit is None else min(cls.PAGE_SIZE, limit - count)
+            members = redis_conn.zrangebylex(cls._key(address), start, '+', start=0, num=num)
+            if not members:
+                return
+            for member, data in zip(members, redis_conn.hmget(cls._data_key(address), members)):
+                yield str(int(member)), data.decode('utf8')
+            count += len(members)
+            start = b'(' + members[-1]
+
+
+class SequenceManager:
+    """the current sequence number of channel accounts, owned by the worker holding the channel."""
+    @classmethod
+    def save(cls, address, sequence):
+        redis_conn.hset(cls._key(), address, sequence)
+        return sequence
+
+    @classmethod
+    def get(cls, address):
+        sequence = redis_conn.hget(cls._key(), address)
+        return int(sequence) if sequence else None
+
+    @classmethod
+    def forget(cls, address):
+        redis_conn.hdel(cls._key(), address)
+
+    @classmethod
+    def _key(cls):
+        return 'channels:sequence'
+
+
+class WalletCache:
+    """kin balances of wallets read from horizon, kept for WALLET_CACHE_TTL_SECS.
+
+    the watcher drops the wallets of every payment it sees, so a cached balance is stale only
+    until the watcher catches up.
+    """
+    @classmethod
+    def _key(cls, address):
+        return 'wallet_cache:%s' % address
+
+    @classmethod
+    def save_many(cls, wallets: List[Wallet]):
+        if not config.WALLET_CACHE_TTL_SECS or not wallets:
+            return
+        pipe = redis_conn.pipeline(transaction=False)
+        for wallet in wallets:
+            balance = '' if wallet.kin_balance is None else str(wallet.kin_balance)
+            pipe.set(cls._key(wallet.wallet_address), balance, ex=config.WALLET_CACHE_TTL_SECS)
+        pipe.execute()
+
+    @classmethod
+    def get_many(cls, addresses: List[str]) -> Dict[str, Wallet]:
+        """get the cached wallets of the given addresses, with a single query."""
+        if not config.WALLET_CACHE_TTL_SECS or not addresses:
+            return {}
+        wallets = {}
+        for address, balance in zip(addresses, redis_conn.mget([cls._key(address) for address in addresses])):
+            if balance is not None:
+                wallets[address] = Wallet({'wallet_address': address,
+                                           'kin_balance': int(balance) if balance else None})
+        statsd.increment('wallet_cache.hit', len(wallets))
+        statsd.increment('wallet_cache.miss', len(addresses) - len(wallets))
+        return wallets
+
+    @classmethod
+    def invalidate(cls, addresses: Iterable[str]):
+        keys = [cls._key(address) for address in addresses if address]
+        if keys:
+            redis_conn.delete(*keys)
 
 
 class CursorManager:
@@ -1,19 +1,54 @@
-from typing import Union
+import contextlib
+import time
+from typing import Union, List, Tuple
 from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.utils import utcnow
 import requests
 
 from . import config
 from .errors import PaymentNotFoundError, PersistentError
 from .log import get as get_log
-from .models import Payment, PaymentRequest, WalletRequest, SubmitTransactionRequest
+from . import ledger
+from .models import Payment, PaymentRequest, PaymentState, WalletRequest, SubmitTransactionRequest, PaymentBatch, PendingPayments, PendingWallets
 from .utils import retry, lock
 from .redis_conn import redis_conn
 from .statsd import statsd
-from .blockchain import Blockchain, get_sdk, root_wallet
+from .blockchain import Blockchain, get_sdk, get_root_wallet, get_operation_codes, lookup_pool
+from .callbacks import enqueue_callback, send_callback
+from .retries import RetryQueue
 from kin import KinErrors
+from kin.blockchain.utils import is_valid_address
 
-q = Queue(connection=redis_conn, name='kin3')
+q = Queue(connection=redis_conn, name='kin3', default_timeout=config.JOB_TIMEOUT_SECS)
+session = requests.Session()
+job_retries = RetryQueue(q.name, config.RETRY_MAX_ATTEMPTS)
 log = get_log('rq.worker')
+
+# admit a payment: reserve its id, mark it queued and enqueue its job - unless it was paid or is on its way.
+# a payment whose state didn't change for longer than a job may run isn't on its way - its job died.
+# KEYS: payment state, ledger payment, legacy payment, job hash, queue, queues set, pending payments of the app
+# ARGV: state ttl, now, stale before, job id, pending payment (batched payments only), job hash fields and values...
+ADMIT_PAYMENT_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 1 or redis.call('exists', KEYS[3]) == 1 then
+    return 0
+end
+local state = redis.call('hmget', KEYS[1], 'state', 'updated_at')
+if state[1] and state[1] ~= 'failed' and tonumber(state[2]) > tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('hmset', KEYS[1], 'state', 'queued', 'updated_at', ARGV[2], 'reason', '')
+redis.call('expire', KEYS[1], ARGV[1])
+if ARGV[5] ~= '' then
+    redis.call('rpush', KEYS[7], ARGV[5])
+end
+redis.call('hmset', KEYS[4], unpack(ARGV, 6))
+redis.call('sadd', KEYS[6], KEYS[5])
+redis.call('rpush', KEYS[5], ARGV[4])
+return 1
+"""
+admit_payment_script = redis_conn.register_script(ADMIT_PAYMENT_SCRIPT)
 PERSISTENT_ERRORS = (
     KinErrors.AccountNotFoundError,
     KinErrors.AccountNotActivatedError,
@@ -23,12 +58,87 @@ PERSISTENT_ERRORS = (
 )
 
 
-def enqueue_send_payment(payment_request: PaymentRequest):
-    statsd.inc_count('transaction.enqueue',
-                     payment_request.amount,
-                     tags=['app_id:%s' % payment_request.app_id])
-    result = q.enqueue(pay_and_callback, payment_request.to_primitive())
-    log.info('enqueue result', result=result, payment_request=payment_request)
+def promote_retries():
+    """move jobs that are due for a retry back to the queue."""
+    for job_id in job_retries.pop_due():
+        try:
+            job = Job.fetch(job_id.decode('utf8'), connection=redis_conn)
+        except NoSuchJobError:
+            continue
+        q.enqueue_job(job)
+
+
+def recover_pending():
+    """put back the pending payments and wallets of jobs that died holding them, and enqueue jobs for them."""
+    for app_id in PendingPayments.recover():
+        q.enqueue(pay_batch_and_callback, app_id)
+    for app_id in PendingWallets.recover():
+        q.enqueue(create_wallets_batch_and_callback, app_id)
+
+
+def promote():
+    """move jobs due for a retry back to the queue, and recover the batches of dead jobs - run by the workers."""
+    promote_retries()
+    recover_pending()
+
+
+def enqueue_send_payment(payment_request: PaymentRequest) -> bool:
+    """admit a payment in one round trip. return False if it was already paid or is on its way."""
+    return enqueue_send_payments([payment_request])[0]
+
+
+def enqueue_send_payments(payment_requests: List[PaymentRequest]) -> List[bool]:
+    """admit many payments in one pipelined round trip. return whether each was admitted."""
+    pipe = redis_conn.pipeline(transaction=False)
+    jobs = [_admit_payment(pipe, payment_request) for payment_request in payment_requests]
+    results = pipe.execute()
+
+    for payment_request, job, admitted in zip(payment_requests, jobs, results):
+        if not admitted:
+            log.info('payment already exists - not enqueued', payment_id=payment_request.id)
+            continue
+        statsd.inc_count('transaction.enqueue',
+                         payment_request.amount,
+                         tags=['app_id:%s' % payment_request.app_id])
+        log.info('enqueue result', result=job, payment_request=payment_request)
+    return [bool(admitted) for admitted in results]
+
+
+def _admit_payment(pipe, payment_request: PaymentRequest) -> Job:
+    if is_batched(payment_request.app_id):
+        job = _create_job(pay_batch_and_callback, payment_request.app_id)
+        pending = PendingPayments.item(payment_request)
+    else:
+        job = _create_job(pay_and_callback, payment_request.to_primitive())
+        pending = ''
+
+    fields = [value for field in job.to_dict().items() for value in field]
+    now = time.time()
+    admit_payment_script(
+        keys=[PaymentState._key(payment_request.id),
+              ledger._key(payment_request.id),
+              Payment._key(payment_request.id),
+              job.key,
+              q.key,
+              q.redis_queues_keys,
+              PendingPayments._key(payment_request.app_id)],
+        args=[PaymentState.STORE_TIME, now, now - job.timeout, job.id, pending] + fields,
+        client=pipe)
+    return job
+
+
+def _create_job(func, *args) -> Job:
+    """create a job of our queue, as q.enqueue would, without saving it."""
+    job = Job.create(func, args=args, connection=redis_conn, status=JobStatus.QUEUED,
+                     timeout=q._default_timeout, origin=q.name)
+    job.enqueued_at = utcnow()
+    if job.timeout is None:
+        job.timeout = q.DEFAULT_TIMEOUT
+    return job
+
+
+def is_batched(app_id):
+    return config.PAYMENT_BATCH_SIZE > 1 and app_id not in config.PAYMENT_BATCH_EXCLUDED_APPS
 
 
 def enqueue_submit_tx(submit_request: SubmitTransactionRequest):
@@ -40,42 +150,60 @@ def enqueue_submit_tx(submit_request: SubmitTransactionRequest):
 
 
 def enqueue_create_wallet(wallet_request: WalletRequest):
-    statsd.increment('wallet_creation.enqueue',
-                     tags=['app_id:%s' % wallet_request.app_id])
-
-    result = q.enqueue(create_wallet_and_callback, wallet_request.to_primitive())
-    log.info('enqueue result', result=result, wallet_request=wallet_request)
+    enqueue_create_wallets([wallet_request])
+
+
+def enqueue_create_wallets(wallet_requests: List[WalletRequest]):
+    """enqueue many wallet creations in one pipelined round trip."""
+    pipe = redis_conn.pipeline(transaction=False)
+    for wallet_request in wallet_requests:
+        statsd.increment('wallet_creation.enqueue',
+                         tags=['app_id:%s' % wallet_request.app_id])
+        if config.WALLET_BATCH_SIZE > 1:
+            pipe.rpush(PendingWallets._key(wallet_request.app_id), PendingWallets.item(wallet_request))
+            job = _create_job(create_wallets_batch_and_callback, wallet_request.app_id)
+        else:
+            job = _create_job(create_wallet_and_callback, wallet_request.to_primitive())
+        q.enqueue_job(job, pipeline=pipe)
+        log.info('enqueue result', result=job, wallet_request=wallet_request)
+    pipe.execute()
 
 
-def __enqueue_callback(callback: str, app_id: str, objekt: str, state: str, action: str, value: dict):
+def __enqueue_callback(callback: str, app_id: str, objekt: str, state: str, action: str, value: dict,
+                       batch_size: int = None, batch_wait_ms: int = None):
     statsd.increment('callback.enqueue',
                      tags=['app_id:%s' % app_id,
                            'object:%s' % objekt,
                            'state:%s' % state,
                            'action:%s' % action])
 
-    result = q.enqueue(call_callback,
-                       callback,
-                       app_id,
-                       objekt=objekt,
-                       state=state,
-                       action=action,
-                       value=value)
-    log.info('enqueue result', result=result, value=value)
+    # callbacks have their own queue, sent by the callback dispatcher
+    enqueue_callback(callback, app_id, objekt=objekt, state=state, action=action, value=value,
+                     batch_size=batch_size, batch_wait_ms=batch_wait_ms)
+    log.info('enqueued callback', callback=callback, value=value)
 
 
 def enqueue_report_wallet_balance(root_wallet_address):
-    q.enqueue(report_balance, root_wallet_address, [])
+    """report the balance, at most once every BALANCE_REPORT_SECS no matter how many transactions ask for it."""
+    if not redis_conn.set('balance_report:%s' % root_wallet_address, 1, nx=True, ex=config.BALANCE_REPORT_SECS):
+        return
+    channel_addresses = []
+    if config.REPORT_CHANNEL_BALANCES:
+        from .channel_factory import ChannelRegistry
+        channel_addresses = ChannelRegistry.get_addresses()
+    q.enqueue(report_balance, root_wallet_address, channel_addresses)
 
 
-def enqueue_payment_callback(callback: str, value: Payment, action: str):
+def enqueue_payment_callback(callback: str, value: Payment, action: str, batch_size: int = None, batch_wait_ms: int = None):
     __enqueue_callback(
         callback=callback,
         app_id=value.app_id,
         objekt='payment',
         state='success',
         action=action,
-        value=value.to_primitive())
+        value=value.to_primitive(),
+        batch_size=batch_size,
+        batch_wait_ms=batch_wait_ms)
 
 
 def enqueue_payment_failed_callback(request: Union[PaymentRequest, SubmitTransactionRequest], reason: str):
@@ -109,31 +237,8 @@ def enqueue_wallet_failed_callback(request: WalletRequest, reason: str):
 
 
 def call_callback(callback: str, app_id: str, objekt: str, state: str, action: str, value: dict):
-    @retry(5, 0.2)
-    def retry_callback(callback: str, payload: dict):
-        res = requests.post(callback, json=payload)
-        res.raise_for_status()
-        return res.json()
-
-    payload = {
-        'object': objekt,
-        'state': state,
-        'action': action,
-        'value': value,
-    }
-
-    tags = ['app_id:%s' % app_id,
-            'object:%s' % objekt,
-            'state:%s' % state,
-            'action:%s' % action]
-    try:
-        response = retry_callback(callback, payload)
-        statsd.increment('callback.success', tags=tags)
-        log.info('callback response', response=response, payload=payload)
-    except Exception as e:
-        statsd.increment('callback.failed', tags=tags)
-        log.exception('callback failed', payload=payload)
-        raise
+    """callback job - callbacks are now sent by the callback dispatcher, this serves jobs queued before."""
+    send_callback(session, callback, app_id, objekt=objekt, state=state, action=action, value=value)
 
 
 def pay_and_callback(payment_request: dict):
@@ -144,19 +249,114 @@ def pay_and_callback(payment_request: dict):
         try:
             payment = pay(payment_request)
         except Exception as e:
+            PaymentState.set(payment_request.id, PaymentState.FAILED, str(e))
             enqueue_payment_failed_callback(payment_request, str(e))
             raise  # crash the job
         else:
             enqueue_payment_callback(payment_request.callback, payment, 'send')
 
 
+def pay_batch_and_callback(app_id: str):
+    """pay the pending payments of an app in one transaction, and callback for each of them.
+
+    every pending payment enqueues this job - a job that finds nothing pending was beaten to it by another.
+    the payments taken stay in a processing list until handled: a job that fails before paying puts them
+    back for its retry, and recover_pending puts back those of a job that died.
+    """
+    size = min(config.PAYMENT_BATCH_SIZE, Blockchain.MAX_OPS)
+    PendingPayments.wait(app_id, size, config.PAYMENT_BATCH_WAIT_MS / 1000)
+    taken_id, payment_requests = PendingPayments.take(app_id, size)
+    if not payment_requests:
+        return
+    log.info('pay_batch_and_callback received', app_id=app_id, payment_ids=[r.id for r in payment_requests])
+
+    paid = False
+    try:
+        with contextlib.ExitStack() as locks:
+            to_pay = {}
+            for payment_request in payment_requests:
+                if payment_request.id in to_pay:
+                    continue
+                if not is_valid_address(payment_request.recipient_address) or (payment_request.amount or 0) <= 0:
+                    # let it fail by itself
+                    q.enqueue(pay_and_callback, payment_request.to_primitive())
+                    continue
+                if not locks.enter_context(lock(redis_conn, 'payment:{}'.format(payment_request.id), blocking_timeout=0)):
+                    # someone else is paying it - its own job waits for them
+                    q.enqueue(pay_and_callback, payment_request.to_primitive())
+                    continue
+                try:
+                    payment = Payment.get(payment_request.id)
+                    log.info('payment is already complete - not double spending', payment=payment)
+                    enqueue_payment_callback(payment_request.callback, payment, 'send')
+                except PaymentNotFoundError:
+                    to_pay[payment_request.id] = payment_request
+
+            if to_pay:
+                try:
+                    tx_id, sender_address = pay_batch(app_id, list(to_pay.values()))
+                except Exception:
+                    # pay one by one: if the transaction was rejected as a whole only the bad payments fail,
+                    # and on other errors every payment is retried by its own job
+                    log.info('batch failed - paying one by one', app_id=app_id, payment_ids=list(to_pay))
+                    PaymentState.set(list(to_pay), PaymentState.QUEUED)
+                    for payment_request in to_pay.values():
+                        q.enqueue(pay_and_callback, payment_request.to_primitive())
+                else:
+                    paid = True
+                    for payment_request in to_pay.values():
+                        payment = Payment.from_payment_request(payment_request, sender_address, tx_id)
+                        payment.save()
+                        enqueue_payment_callback(payment_request.callback, payment, 'send')
+                    PaymentState.set(list(to_pay), PaymentState.CONFIRMED)
+    except Exception:
+        if paid:
+            PendingPayments.release(app_id, taken_id)  # never pay them twice
+        else:
+            PendingPayments.restore(app_id, taken_id)  # for the retry of this job
+        raise  # crash the job
+    PendingPayments.release(app_id, taken_id)
+
+
+def pay_batch(app_id: str, payment_requests: List[PaymentRequest]) -> Tuple[str, str]:
+    """pay all payment requests in one transaction. return the transaction id and the sender address."""
+    batch_id = PaymentBatch.new_id()
+    log.info('trying to pay batch', batch_id=batch_id, payment_ids=[r.id for r in payment_requests])
+
+    payment_ids = [r.id for r in payment_requests]
+    try:
+        with get_sdk(config.STELLAR_BASE_SEED, app_id) as blockchain:
+            PaymentState.set(payment_ids, PaymentState.CHANNEL_ACQUIRED)
+            tx_id = blockchain.pay_many(
+                [(r.recipient_address, r.amount) for r in payment_requests],
+                batch_id,
+                on_submit=lambda: PaymentState.set(payment_ids, PaymentState.SUBMITTED))
+            enqueue_report_wallet_balance(blockchain.root_address)
+
+        log.info('paid batch transaction', tx_id=tx_id, batch_id=batch_id)
+        statsd.inc_count('transaction.paid',
+                         sum(r.amount for r in payment_requests),
+                         tags=['app_id:%s' % app_id])
+        statsd.histogram('transaction.batch_size', len(payment_requests), tags=['app_id:%s' % app_id])
+    except PERSISTENT_ERRORS as e:
+        raise PersistentError(e)
+    except Exception as e:
+        statsd.increment('transaction.failed',
+                         tags=['app_id:%s' % app_id])
+        log.exception('failed to pay batch transaction', batch_id=batch_id)
+        raise
+
+    PaymentBatch.save(batch_id, payment_ids)
+    return tx_id, blockchain.root_address
+
+
 def submit_tx_callback(submit_request: dict):
     """Submit a given transaction to the blockchain."""
     log.info('submit_tx_callback received', submit_request=submit_request)
     submit_request = SubmitTransactionRequest(submit_request)
 
     try:
-        tx_id = root_wallet.submit_transaction(submit_request.transaction)
+        tx_id = get_root_wallet().submit_transaction(submit_request.transaction)
     except PERSISTENT_ERRORS as e:
         raise PersistentError(e)
     except Exception as e:
@@ -180,9 +380,7 @@ def create_wallet_and_callback(wallet_request: dict):
             enqueue_report_wallet_balance(blockchain.root_address)
 
     except KinErrors.AccountExistsError:
-        statsd.increment('wallet.exists', tags=['app_id:%s' % wallet_request.app_id])
-        enqueue_wallet_failed_callback(wallet_request, "account exists")
-        log.info('wallet already exists - ok', public_address=wallet_request.wallet_address)
+        wallet_exists_callback(wallet_request)
 
     except Exception as e:
         statsd.increment('wallet.failed', tags=['app_id:%s' % wallet_request.app_id])
@@ -195,6 +393,73 @@ def create_wallet_and_callback(wallet_request: dict):
         enqueue_wallet_callback(wallet_request)
 
 
+def wallet_exists_callback(wallet_request: WalletRequest):
+    statsd.increment('wallet.exists', tags=['app_id:%s' % wallet_request.app_id])
+    enqueue_wallet_failed_callback(wallet_request, "account exists")
+    log.info('wallet already exists - ok', public_address=wallet_request.wallet_address)
+
+
+def create_wallets_batch_and_callback(app_id: str):
+    """create the pending wallets of an app in one transaction, and callback for each of them.
+
+    every pending wallet enqueues this job - a job that finds nothing pending was beaten to it by another.
+    """
+    size = min(config.WALLET_BATCH_SIZE, Blockchain.MAX_OPS)
+    PendingWallets.wait(app_id, size, config.WALLET_BATCH_WAIT_MS / 1000)
+    taken_id, wallet_requests = PendingWallets.take(app_id, size)
+    if not wallet_requests:
+        return
+    log.info('create_wallets_batch_and_callback received', app_id=app_id, wallet_ids=[r.id for r in wallet_requests])
+    try:
+        _create_wallets_batch(app_id, wallet_requests)
+    except Exception:
+        PendingWallets.restore(app_id, taken_id)  # for the retry of this job - creating a wallet is idempotent
+        raise  # crash the job
+    PendingWallets.release(app_id, taken_id)
+
+
+def _create_wallets_batch(app_id: str, wallet_requests: List[WalletRequest]):
+    to_create = {}  # address => requests
+    for wallet_request in wallet_requests:
+        to_create.setdefault(wallet_request.wallet_address, []).append(wallet_request)
+
+    def exists(addresses):
+        for address in addresses:
+            for wallet_request in to_create.pop(address):
+                wallet_exists_callback(wallet_request)
+
+    exists(Blockchain.get_existing_wallets(list(to_create)))
+
+    while to_create:
+        addresses = list(to_create)
+        try:
+            with get_sdk(config.STELLAR_BASE_SEED, app_id) as blockchain:
+                blockchain.create_wallets(addresses)
+                enqueue_report_wallet_balance(blockchain.root_address)
+        except KinErrors.AccountExistsError as e:
+            # created since we checked - drop the existing ones and try the rest again
+            codes = get_operation_codes(e) or []
+            existing = [address for address, code in zip(addresses, codes)
+                        if code == KinErrors.CreateAccountResultCode.ACCOUNT_EXISTS]
+            if not existing:
+                break
+            exists(existing)
+        except Exception:
+            log.exception('failed to create wallets batch - creating one by one', app_id=app_id)
+            break
+        else:
+            statsd.histogram('wallet_creation.batch_size', len(addresses), tags=['app_id:%s' % app_id])
+            for address in addresses:
+                for wallet_request in to_create.pop(address):
+                    statsd.increment('wallet.created', tags=['app_id:%s' % app_id])
+                    enqueue_wallet_callback(wallet_request)
+
+    # the batch failed - create every wallet by its own job, which retries and reports its own error
+    for address_requests in to_create.values():
+        for wallet_request in address_requests:
+            q.enqueue(create_wallet_and_callback, wallet_request.to_primitive())
+
+
 def pay(payment_request: PaymentRequest):
     """pays only if not already paid."""
     try:
@@ -209,10 +474,12 @@ def pay(payment_request: PaymentRequest):
     # XXX retry on retry-able errors
     try:
         with get_sdk(config.STELLAR_BASE_SEED, payment_request.app_id) as blockchain:
+            PaymentState.set(payment_request.id, PaymentState.CHANNEL_ACQUIRED)
             tx_id = blockchain.pay_to(
                 payment_request.recipient_address,
                 payment_request.amount,
-                payment_request.id)
+                payment_request.id,
+                on_submit=lambda: PaymentState.set(payment_request.id, PaymentState.SUBMITTED))
             enqueue_report_wallet_balance(blockchain.root_address)
 
         log.info('paid transaction', tx_id=tx_id, payment_id=payment_request.id)
@@ -229,6 +496,7 @@ def pay(payment_request: PaymentRequest):
 
     payment = Payment.from_payment_request(payment_request, blockchain.root_address, tx_id)
     payment.save()
+    PaymentState.set(payment_request.id, PaymentState.CONFIRMED)
 
     log.info('payment complete - submit back to callback payment.callback', payment=payment)
 
@@ -236,10 +504,24 @@ def pay(payment_request: PaymentRequest):
 
 
 def report_balance(root_address, channel_addresses=[]):
-    """report root wallet balance metrics to statsd."""
+    """report root wallet and channel balance metrics to statsd."""
     try:
         wallet = Blockchain.get_wallet(root_address)
         statsd.gauge('root_wallet.kin_balance', wallet.kin_balance,
                      tags=['address:%s' % root_address])
     except Exception:
         pass  # don't fail
+
+    def get_balance(address):
+        try:
+            return Blockchain.get_wallet(address).kin_balance
+        except Exception:
+            return None  # don't fail
+
+    balances = {address: balance
+                for address, balance in zip(channel_addresses, lookup_pool.map(get_balance, channel_addresses))
+                if balance is not None}
+    for address, balance in balances.items():
+        statsd.gauge('channel.kin_balance', balance, tags=['address:%s' % address])
+    if balances:
+        statsd.gauge('channels.min_kin_balance', min(balances.values()))
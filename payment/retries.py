@@ -0,0 +1,87 @@
+"""delayed retries.
+
+failed work waits in a sorted set scored by its due time, with exponential backoff and jitter between
+attempts, until a promoter moves it back to its queue. work that failed more than its max attempts
+is moved to a dead letter list instead.
+
+promoters run in the processes that consume the queues - the workers and the callback dispatcher -
+so retries keep flowing as long as anything consumes them. promoting is atomic, any number may run.
+"""
+import random
+import threading
+import time
+from typing import Callable, List
+
+from . import config
+from .log import get as get_log
+from .redis_conn import redis_conn
+from .statsd import statsd
+
+log = get_log()
+PROMOTE_INTERVAL = 0.1
+
+
+# KEYS: scheduled zset
+# ARGV: now, max items
+POP_DUE_SCRIPT = """
+local items = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #items > 0 then
+    redis.call('zrem', KEYS[1], unpack(items))
+end
+return items
+"""
+
+
+def backoff(attempt, base=None, cap=None) -> float:
+    """seconds to wait before the given retry attempt (1 based) - exponential, capped, with jitter."""
+    base = config.RETRY_BASE_DELAY_SECS if base is None else base
+    cap = config.RETRY_MAX_DELAY_SECS if cap is None else cap
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RetryQueue:
+    """failed members (job ids, serialized callbacks) waiting for their next attempt."""
+
+    def __init__(self, name, max_attempts):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.scheduled_key = '%s:retries' % name
+        self.dead_key = '%s:dead' % name
+        self._pop_due = redis_conn.register_script(POP_DUE_SCRIPT)
+
+    def schedule(self, member, attempt) -> bool:
+        """schedule a retry of a member that failed `attempt` times. return False if it was dead lettered."""
+        if attempt > self.max_attempts:
+            redis_conn.rpush(self.dead_key, member)
+            statsd.increment('%s.dead_lettered' % self.name)
+            return False
+        redis_conn.zadd(self.scheduled_key, time.time() + backoff(attempt), member)
+        statsd.increment('%s.retry_scheduled' % self.name)
+        return True
+
+    def defer(self, member, delay):
+        """put a member back to its queue after `delay` seconds, without counting an attempt."""
+        redis_conn.zadd(self.scheduled_key, time.time() + delay, member)
+
+    def pop_due(self, limit=100) -> List[bytes]:
+        """take out members whose retry is due."""
+        return self._pop_due(keys=[self.scheduled_key], args=[time.time(), limit])
+
+    def metrics(self):
+        """return the number of scheduled and dead lettered members."""
+        pipe = redis_conn.pipeline()
+        pipe.zcard(self.scheduled_key)
+        pipe.llen(self.dead_key)
+        scheduled, dead = pipe.execute()
+        return {'retries': scheduled, 'dead': dead}
+
+
+def run_promoter(promote: Callable[[], None], stop_event: threading.Event = None):
+    """call the given function, which moves due retries back to their queue, every PROMOTE_INTERVAL until stopped."""
+    while stop_event is None or not stop_event.is_set():
+        try:
+            promote()
+        except Exception:
+            log.exception('failed promoting retries')
+        time.sleep(PROMOTE_INTERVAL)
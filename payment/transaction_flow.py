@@ -1,12 +1,19 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
 from .blockchain import Blockchain
 from .log import get as get_log
-from typing import Callable, List, Generator
-from .models import TransactionRecord
+from typing import Callable, List, Generator, Optional, Tuple
+from .models import TransactionRecord, Payment, PaymentHistory, WalletCache
+from .redis_conn import redis_conn
+from .utils import lock
+from . import config
 from kin.transactions import NATIVE_ASSET_TYPE
 from kin import KinErrors
 
 
 log = get_log()
+# shared between all flows of the process - bounds the number of concurrent horizon lookups
+prefetch_pool = ThreadPoolExecutor(max_workers=config.TX_PREFETCH_WORKERS)
 
 
 class TransactionFlow():
@@ -14,35 +21,114 @@ class TransactionFlow():
     def __init__(self, cursor):
         self.cursor = cursor
 
-    def _yield_transactions(self, get_records: Callable[[str], List[TransactionRecord]]) -> Generator[TransactionRecord, None, None]:
-        """yield transactions from the given function."""
+    @staticmethod
+    def is_kin_payment(record: TransactionRecord) -> bool:
+        return record.type == 'payment' and record.asset_type == NATIVE_ASSET_TYPE
+
+    @staticmethod
+    def get_watched_address(record: TransactionRecord, addresses):
+        """return the watched address that a kin payment record involves, or None."""
+        if not TransactionFlow.is_kin_payment(record):
+            return None
+        if record.to_address in addresses:
+            return record.to_address
+        if record.from_address in addresses:
+            return record.from_address
+
+    @staticmethod
+    def invalidate_wallets(records: List[TransactionRecord]):
+        """drop the cached wallets that the given kin payment records changed."""
+        WalletCache.invalidate({address for record in records for address in (record.from_address, record.to_address)})
+
+    @staticmethod
+    def get_record_payment(record: TransactionRecord, future: Future = None) -> Optional[Payment]:
+        """parse the payment of a record. return None when it isn't a payment of ours.
+
+        the transaction is fetched from horizon (or taken from the given future) only when it wasn't embedded.
+        the payment of a batch transaction gets the id of the payment its operation paid.
+        """
+        if record.transaction:
+            return Blockchain.try_parse_record_payment(record)
+        try:
+            tx = future.result() if future else Blockchain.get_transaction_data(record.transaction_hash)
+        except KinErrors.CantSimplifyError:
+            # a transaction of many operations, like a batch of payments - parse the record with its transaction
+            try:
+                record.transaction = Blockchain.get_embedded_transaction(record.transaction_hash)
+            except Exception as e:
+                log.warning('warning: while getting record', error=str(e), record=record)
+                return None
+            return Blockchain.try_parse_record_payment(record)
+        return Blockchain.try_parse_payment(tx)
+
+    def _yield_pages(self, get_records: Callable[[str], List[TransactionRecord]]) -> Generator[List[TransactionRecord], None, None]:
+        """yield the kin payment records of every page from the given function.
+
+        the cursor is advanced to the end of a page only after the page was consumed.
+        """
         records = get_records(self.cursor)
         while records:
-            for record in records:
-                if (record.type == 'payment'
-                        and record.asset_type == NATIVE_ASSET_TYPE):
-                    yield record
-                self.cursor = record.paging_token
+            yield [record for record in records if self.is_kin_payment(record)]
+            self.cursor = records[-1].paging_token
             records = get_records(self.cursor)
 
-    def get_address_transactions(self, address):
-        """get KIN payment transactions for given address."""
+    def _yield_payments(self, records: List[TransactionRecord]) -> Generator[Tuple[TransactionRecord, Optional[Payment]], None, None]:
+        """yield (record, payment) for the given records in order.
+
+        transactions that horizon didn't embed are fetched concurrently.
+        """
+        futures = [None if record.transaction
+                   else prefetch_pool.submit(Blockchain.get_transaction_data, record.transaction_hash)
+                   for record in records]
+        for record, future in zip(records, futures):
+            yield record, self.get_record_payment(record, future)
+
+    def get_address_payments(self, address):
+        """get KIN payments of given address, as (payment, paging_token)."""
         def get_address_records(cursor):
             return Blockchain.get_address_records(address, cursor, 100)
 
-        for record in self._yield_transactions(get_address_records):
-            yield Blockchain.get_transaction_data(record.transaction_hash)
+        for records in self._yield_pages(get_address_records):
+            for record, payment in self._yield_payments(records):
+                if payment:
+                    yield payment, record.paging_token
 
-    def get_transactions(self, addresses):
+    def get_payments(self, addresses):
+        """get KIN payments involving any of the given addresses, as (address, payment, paging_token)."""
         def get_all_records(cursor):
             return Blockchain.get_all_records(cursor, 100)
 
-        for record in self._yield_transactions(get_all_records):
-            try:
-                if record.to_address in addresses:
-                    yield record.to_address, Blockchain.get_transaction_data(record.transaction_hash), record.paging_token
-                elif record.from_address in addresses:
-                    yield record.from_address, Blockchain.get_transaction_data(record.transaction_hash), record.paging_token
-            except KinErrors.CantSimplifyError as e:
-                # We dont expect any transaction that cant be simplified
-                log.warning('warning: while getting record', error=str(e), record=record)
+        for records in self._yield_pages(get_all_records):
+            self.invalidate_wallets(records)
+            matches = {record.paging_token: self.get_watched_address(record, addresses) for record in records}
+            # results are consumed in paging_token order, no matter which lookup finished first
+            for record, payment in self._yield_payments([record for record in records if matches[record.paging_token]]):
+                if payment:
+                    yield matches[record.paging_token], payment, record.paging_token
+
+
+def sync_payment_history(address):
+    """bring the stored payment history of an address up to date with horizon.
+
+    the first sync backfills the whole history, later ones continue from the stored cursor.
+    """
+    with lock(redis_conn, 'history:{}'.format(address), blocking_timeout=120) as is_locked:
+        if not is_locked:
+            # still synced by someone else - serve what is stored rather than sync it twice
+            log.warning('payment history sync is taking long - not syncing', address=address)
+            return
+        cursor, synced_at = PaymentHistory.get_state(address)
+        if synced_at and time.time() - synced_at < config.HISTORY_SYNC_SECS:
+            return
+
+        log.info('syncing payment history', address=address, cursor=cursor)
+        flow = TransactionFlow(cursor or 0)
+        pipe = redis_conn.pipeline()
+        for i, (payment, paging_token) in enumerate(flow.get_address_payments(address), 1):
+            PaymentHistory.add(pipe, address, paging_token, payment)
+            if i % PaymentHistory.PAGE_SIZE == 0:
+                # flow.cursor is behind every payment added so far - safe to resume from after a failure
+                PaymentHistory.save_state(pipe, address, flow.cursor)
+                pipe.execute()
+        PaymentHistory.save_state(pipe, address, flow.cursor)
+        pipe.execute()
@@ -0,0 +1,126 @@
+"""a read-through cache of horizon transactions - they never change once in a ledger.
+
+lookups go to an in-process LRU, then to redis, then to horizon. redis keeps a transaction under
+tx:<hash> as its close time (4 bytes) followed by the raw envelope xdr, and an empty string for a
+transaction that wasn't found, which is kept for TX_CACHE_NOT_FOUND_TTL_SECS only.
+"""
+import base64
+import calendar
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from kin import KinErrors
+from kin.transactions import RawTransaction, SimplifiedTransaction
+
+from . import config
+from .redis_conn import redis_conn
+from .statsd import statsd
+
+CREATED_AT = struct.Struct('>I')
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'  # 2018-11-12T06:45:40Z
+NOT_FOUND = b''
+
+
+class LRUCache:
+    """a thread safe, size bounded map that drops the least recently used entries."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key => (expires_at or None, value)
+
+    def get(self, key):
+        """return the value of a key, or None if missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        evicted = 0
+        with self.lock:
+            self.entries[key] = (time.time() + ttl if ttl else None, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            statsd.increment('tx_cache.eviction', evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local_cache = LRUCache(config.TX_CACHE_SIZE)
+
+
+def _key(tx_hash):
+    return 'tx:%s' % tx_hash
+
+
+def pack(data: dict) -> bytes:
+    """pack the fields of a horizon transaction response that RawTransaction needs."""
+    created_at = calendar.timegm(time.strptime(data['created_at'], TIME_FORMAT))
+    return CREATED_AT.pack(created_at) + base64.b64decode(data['envelope_xdr'])
+
+
+def unpack(tx_hash, value: bytes) -> dict:
+    created_at, = CREATED_AT.unpack_from(value)
+    return {'hash': tx_hash,
+            'created_at': time.strftime(TIME_FORMAT, time.gmtime(created_at)),
+            'envelope_xdr': base64.b64encode(value[CREATED_AT.size:]).decode()}
+
+
+def _raw(tx_hash, value: bytes) -> RawTransaction:
+    if value == NOT_FOUND:
+        raise KinErrors.ResourceNotFoundError()
+    return RawTransaction(unpack(tx_hash, value))
+
+
+def _simplify(tx_hash, value: bytes) -> SimplifiedTransaction:
+    return SimplifiedTransaction(_raw(tx_hash, value))
+
+
+def get_transaction(tx_hash: str, fetch: Callable[[str], dict]) -> SimplifiedTransaction:
+    """get a simplified transaction, fetching its horizon response with `fetch` only if it isn't cached."""
+    return _simplify(tx_hash, _get(tx_hash, fetch))
+
+
+def get_raw_transaction(tx_hash: str, fetch: Callable[[str], dict]) -> RawTransaction:
+    """get a transaction as is - for the ones that can't be simplified, like those of many operations."""
+    return _raw(tx_hash, _get(tx_hash, fetch))
+
+
+def _get(tx_hash: str, fetch: Callable[[str], dict]) -> bytes:
+    value = local_cache.get(tx_hash)
+    if value is not None:
+        statsd.increment('tx_cache.hit', tags=['tier:local'])
+        return value
+
+    value = redis_conn.get(_key(tx_hash))
+    if value is not None:
+        statsd.increment('tx_cache.hit', tags=['tier:redis'])
+    else:
+        statsd.increment('tx_cache.miss')
+        try:
+            value = pack(fetch(tx_hash))
+            ttl = config.TX_CACHE_TTL_SECS
+        except KinErrors.ResourceNotFoundError:
+            if not config.TX_CACHE_NOT_FOUND_TTL_SECS:
+                raise
+            value = NOT_FOUND
+            ttl = config.TX_CACHE_NOT_FOUND_TTL_SECS
+        redis_conn.set(_key(tx_hash), value, ex=ttl)
+
+    local_cache.set(tx_hash, value, config.TX_CACHE_NOT_FOUND_TTL_SECS if value == NOT_FOUND else None)
+    return value
@@ -1,4 +1,5 @@
 import contextlib
+import random
 import time
 from functools import wraps
 import redis
@@ -19,8 +20,8 @@ def lock(redis_conn, key, blocking_timeout=None):
             logging.error("failed to release lock %s" % key)
 
 
-def retry(times, delay=0.3, ignore=[]):
-    """retry on errors that aren't ignored."""
+def retry(times, delay=0.3, ignore=[], backoff=2, max_delay=5):
+    """retry on errors that aren't ignored, waiting `delay` times `backoff` more after every attempt (with jitter)."""
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
@@ -34,11 +35,21 @@ def retry(times, delay=0.3, ignore=[]):
                     if i == times - 1:
                         raise
                     else:
-                        time.sleep(delay)
+                        wait = min(delay * backoff ** i, max_delay)
+                        time.sleep(wait / 2 + random.uniform(0, wait / 2))
         return wrapper
     return decorator
 
 
+class classproperty:
+    """a read only property of a class, computed on every access."""
+    def __init__(self, getter):
+        self.getter = getter
+
+    def __get__(self, obj, owner):
+        return self.getter(owner)
+
+
 def safe_int(string, default):
     try:
         return int(string)
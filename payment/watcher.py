@@ -2,10 +2,11 @@ import threading
 import time
 import typing
 
+from . import config
 from .blockchain import Blockchain
 from .queue import enqueue_payment_callback
 from .log import get as get_log
-from .models import Service, CursorManager, Payment
+from .models import Service, CursorManager, Payment, PaymentHistory, WatchedAddresses
 from .transaction_flow import TransactionFlow
 from .utils import retry
 from .statsd import statsd
@@ -16,6 +17,46 @@ log = get_log()
 SEC_BETWEEN_RUNS = 1
 
 
+class WatchedAddressesCache:
+    """in-memory copy of the watched addresses index.
+
+    the index is reloaded only when its version changes, and temporary watches are dropped locally as they expire.
+    """
+    def __init__(self):
+        self.version = None
+        self.watchers = {}  # address => {service_id: expire_at}
+        self.services = {}  # service_id => Service
+        self.addresses = {}  # address => [list of services]
+        self.next_expiry = 0
+
+    def get(self) -> typing.Dict[str, typing.List[Service]]:
+        """get all addresses watched by any service as map of address to list of services watching it."""
+        version = WatchedAddresses.version()
+        if version is None or version != self.version:
+            self.watchers = WatchedAddresses.get_all()
+            self.services = Service.get_many(set(service_id
+                                                 for service_ids in self.watchers.values()
+                                                 for service_id in service_ids))
+            self.version = version
+            self.next_expiry = 0
+            statsd.increment('watchers_cache.reload')
+
+        now = time.time()
+        if now >= self.next_expiry:
+            watchers = {address: [service_id for service_id, expire_at in service_ids.items() if expire_at > now]
+                        for address, service_ids in self.watchers.items()}
+            self.addresses = Service.from_watchers(watchers, self.services)
+            self.next_expiry = min((expire_at
+                                    for service_ids in self.watchers.values()
+                                    for expire_at in service_ids.values()
+                                    if expire_at > now),
+                                   default=WatchedAddresses.PERMANENT)
+        return self.addresses
+
+
+watched_addresses = WatchedAddressesCache()
+
+
 def get_last_cursor():
     cursor = CursorManager.get()
     if not cursor:
@@ -38,7 +79,27 @@ def on_payment(address: str, services: typing.List[Service], payment: Payment):
                            'address:%s' % address])
 
     for service in services:
-        enqueue_payment_callback(service.callback, payment, 'receive')
+        enqueue_payment_callback(service.callback, payment, 'receive',
+                                 batch_size=service.batch_size, batch_wait_ms=service.batch_wait_ms)
+
+
+def beat():
+    """poll the blockchain once from the last saved cursor. return the new cursor."""
+    # dict(address => [list of services])
+    addresses_callbacks = watched_addresses.get()
+
+    cursor = get_last_cursor()
+    log.debug('got last cursor %s' % cursor)
+    flow = TransactionFlow(cursor)
+    for address, payment, paging_token in flow.get_payments(addresses_callbacks.keys()):
+        log.info('found transaction for address', address=address)
+        on_payment(address, addresses_callbacks[address], payment)
+        PaymentHistory.add_if_tracked(address, paging_token, payment)
+        cursor = CursorManager.save(paging_token)
+    log.debug('save last cursor %s' % flow.cursor)
+    # flow.cursor is the last block observed - it might not be a kin payment, 
+    # so the previous .save inside the loop doesnt guarantee avoidance of reprocessing
+    return CursorManager.save(flow.cursor)
 
 
 def worker(stop_event):
@@ -48,28 +109,76 @@ def worker(stop_event):
         time.sleep(SEC_BETWEEN_RUNS)
         start_t = time.time()
         try:
-            # dict(address => [list of services])
-            addresses_callbacks = Service.get_all_watching_addresses()
-
-            cursor = get_last_cursor()
-            log.debug('got last cursor %s' % cursor)
-            flow = TransactionFlow(cursor)
-            for address, tx, paging_token in flow.get_transactions(addresses_callbacks.keys()):
-                log.info('found transaction for address', address=address)
-                payment = Blockchain.try_parse_payment(tx)
-                if payment:
-                    on_payment(address, addresses_callbacks[address], payment)
-                cursor = CursorManager.save(paging_token)
-            log.debug('save last cursor %s' % flow.cursor)
-            # flow.cursor is the last block observed - it might not be a kin payment, 
-            # so the previous .save inside the loop doesnt guarantee avoidance of reprocessing
-            cursor = CursorManager.save(flow.cursor)
+            cursor = beat()
         except Exception as e:
             statsd.increment('watcher_beat.failed', tags=['error:%s' % e])
             log.exception('failed watcher iteration')
         statsd.timing('watcher_beat', time.time() - start_t)
         statsd.gauge('watcher_beat.cursor', cursor)
         report_queue_size()
+        report_channel_pool()
+
+
+def stream(stop_event):
+    """follow the payments stream from the last saved cursor until stopped or disconnected."""
+    cursor = get_last_cursor()
+    addresses_callbacks = watched_addresses.get()
+    refresh_t = save_t = time.time()
+    log.info('streaming payments', cursor=cursor)
+    for record in Blockchain.stream_all_records(cursor):
+        if stop_event is not None and stop_event.is_set():
+            return
+        now = time.time()
+        if now - refresh_t >= SEC_BETWEEN_RUNS:
+            addresses_callbacks = watched_addresses.get()
+            refresh_t = now
+
+        if TransactionFlow.is_kin_payment(record):
+            TransactionFlow.invalidate_wallets([record])
+        address = TransactionFlow.get_watched_address(record, addresses_callbacks)
+        if address:
+            log.info('found transaction for address', address=address)
+            payment = TransactionFlow.get_record_payment(record)
+            if payment:
+                on_payment(address, addresses_callbacks[address], payment)
+                PaymentHistory.add_if_tracked(address, record.paging_token, payment)
+
+        # checkpoint every handled payment, and the stream position once a beat
+        if address or now - save_t >= SEC_BETWEEN_RUNS:
+            cursor = CursorManager.save(record.paging_token)
+            statsd.gauge('watcher_beat.cursor', cursor)
+        if now - save_t >= SEC_BETWEEN_RUNS:
+            save_t = now
+            report_queue_size()
+            report_channel_pool()
+
+
+def stream_worker(stop_event):
+    """Stream blockchain payments and apply callback on watched address. run until stopped.
+
+    when the stream breaks, a polling beat catches up from the saved cursor before reconnecting.
+    """
+    while stop_event is None or not stop_event.is_set():
+        try:
+            stream(stop_event)
+        except Exception as e:
+            statsd.increment('watcher_stream.failed', tags=['error:%s' % e])
+            log.exception('watcher stream disconnected')
+
+        time.sleep(SEC_BETWEEN_RUNS)
+        try:
+            beat()
+        except Exception as e:
+            statsd.increment('watcher_beat.failed', tags=['error:%s' % e])
+            log.exception('failed watcher iteration')
+
+
+def run(stop_event):
+    """run the watcher in the configured mode."""
+    if config.WATCHER_MODE == 'stream':
+        stream_worker(stop_event)
+    else:
+        worker(stop_event)
 
 
 def report_queue_size():
@@ -83,6 +192,20 @@ def report_queue_size():
         states = Counter([i.get_state() for i in ws])
         for state, num in states.items():
             statsd.gauge('queue_workers', num, tags=['state:%s' % state])
+        from .queue import job_retries
+        from .callbacks import callback_retries
+        for retry_queue in (job_retries, callback_retries):
+            for name, value in retry_queue.metrics().items():
+                statsd.gauge('%s.%s' % (retry_queue.name, name), value)
+    except:
+        pass
+
+
+def report_channel_pool():
+    try:
+        from .channel_factory import channel_pool
+        for name, value in channel_pool.metrics().items():
+            statsd.gauge('%s.%s' % (channel_pool.name, name), value)
     except:
         pass
 
@@ -90,7 +213,7 @@ def report_queue_size():
 def init():
     """start a thread to watch the blockchain."""
     log.info('starting watcher service')
-    t = threading.Thread(target=worker, args=(stop_event, ))
+    t = threading.Thread(target=run, args=(stop_event, ))
     t.daemon = True
     t.start()
 
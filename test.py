@@ -8,7 +8,7 @@ from payment import config
 config.MAX_CHANNELS = 3
 
 from payment.channel_factory import get_next_channel_id, generate_key
-from payment.blockchain import root_wallet
+from payment.blockchain import get_root_wallet
 from payment.redis_conn import redis_conn
 from payment.utils import lock, safe_int
 from payment.models import Payment, PaymentRequest, Service
@@ -31,8 +31,8 @@ def test_lock():
 
 
 def test_generate_keys():
-    keys1 = [generate_key(root_wallet, i).address() for i in range(20)]
-    keys2 = [generate_key(root_wallet, i).address() for i in range(20)]
+    keys1 = [generate_key(get_root_wallet(), i).address() for i in range(20)]
+    keys2 = [generate_key(get_root_wallet(), i).address() for i in range(20)]
 
     assert keys1 == keys2
 
@@ -48,6 +48,669 @@ def test_channel_rotate():
                 assert ch1 != ch2 != ch0
 
 
+def test_channel_pool():
+    from payment.channel_pool import ChannelPool
+    from payment.errors import NoAvailableChannel
+    name = 'test_channels:%s' % random.random()
+    pool = ChannelPool(redis_conn, max_channels=2, lease_secs=1, name=name, max_channels_key='%s:max' % name)
+
+    ch0, token0 = pool.acquire()
+    ch1, token1 = pool.acquire()
+    assert {ch0, ch1} == {0, 1}
+    assert pool.metrics() == {'free': 0, 'leased': 2, 'waiting': 0}
+    with pytest.raises(NoAvailableChannel):
+        pool.acquire()
+
+    pool.release(ch0, token0)
+    assert pool.acquire(wait=0.5)[0] == ch0
+
+    # the lease of a crashed worker expires and the channel is reclaimed
+    time.sleep(1.1)
+    reclaimed, _ = pool.acquire()
+    pool.release(ch1, token1)  # stale lease - ignored
+    assert pool.metrics()['leased'] == 1
+
+    # the pool follows a runtime change of the max channels
+    redis_conn.set('%s:max' % name, 3)
+    assert pool.acquire()[0] not in (reclaimed, None)
+
+
+def test_channel_registry():
+    from kin import Keypair
+    from payment.channel_factory import get_channel, ChannelRegistry
+    redis_conn.delete(ChannelRegistry._key())
+    ChannelRegistry._ready.clear()
+
+    seeds = set()
+    with mock.patch.object(get_root_wallet(), 'create_wallet') as create_wallet:
+        for _ in range(5):
+            with get_channel(get_root_wallet()) as seed:
+                seeds.add(seed)
+        assert create_wallet.call_count == len(seeds)  # checked against horizon only the first time
+
+        with pytest.raises(KinErrors.AccountNotFoundError):
+            with get_channel(get_root_wallet()) as seed:
+                raise KinErrors.AccountNotFoundError(error_code=KinErrors.TransactionResultCode.NO_ACCOUNT)
+        assert Keypair.address_from_seed(seed) not in ChannelRegistry._ready.values()
+
+
+def test_channel_sequence_cache():
+    from kin import Keypair
+    from payment.blockchain import Blockchain
+    from payment.models import SequenceManager
+    channel = Keypair().secret_seed
+    bc = Blockchain(get_root_wallet().write_sdk, channel)
+    SequenceManager.save(bc.channel_address, 10)
+
+    builder = mock.Mock(sequence=None)
+    builder.update_sequence.side_effect = lambda: setattr(builder, 'sequence', '20')
+    with mock.patch.object(bc.write_sdk, 'submit_transaction') as submit:
+        submit.side_effect = ['tx1', KinErrors.RequestError(error_code='tx_bad_seq'), 'tx2']
+        assert bc._sign_and_send_tx(builder) == 'tx1'
+        assert not builder.update_sequence.called  # sequence came from the cache
+        assert SequenceManager.get(bc.channel_address) == 11
+
+        assert bc._sign_and_send_tx(builder) == 'tx2'
+        assert builder.update_sequence.call_count == 1  # resynced on bad sequence
+        assert SequenceManager.get(bc.channel_address) == 21
+
+
+def test_create_wallets_in_one_transaction():
+    addresses = [generate_key(get_root_wallet(), i).address().decode() for i in range(3)]
+    with mock.patch.object(get_root_wallet(), '_sign_and_send_tx', return_value='tx') as send:
+        assert get_root_wallet().create_wallets(addresses) == 'tx'
+    builder = send.call_args[0][0]
+    assert [op.destination for op in builder.ops] == addresses
+
+
+def test_pay_batch():
+    from kin import Keypair
+    from rq import Queue
+    from payment.queue import pay_batch_and_callback, pay_and_callback, recover_pending
+    from payment.models import PaymentBatch, PendingPayments
+    test_q = Queue('test_pay_batch', connection=redis_conn)
+    test_q.empty()
+    app_id = 'bat%s' % random.randint(0, 9)
+    redis_conn.delete(PendingPayments._key(app_id))
+
+    def push_requests():
+        requests = [PaymentRequest({'id': 'batched-%s-%s' % (time.time(), i), 'app_id': app_id, 'amount': 10,
+                                    'recipient_address': Keypair().public_address,
+                                    'callback': 'http://localhost/callback'})
+                    for i in range(3)]
+        for r in requests:
+            PendingPayments.push(r)
+        return requests
+
+    sdk = mock.MagicMock()
+    blockchain = sdk.__enter__.return_value
+    blockchain.root_address = 'sender'
+    blockchain.pay_many.side_effect = ['tx', Exception('horizon timeout')]
+    with mock.patch.object(config, 'PAYMENT_BATCH_SIZE', 3), \
+            mock.patch('payment.queue.q', test_q), \
+            mock.patch('payment.queue.get_sdk', return_value=sdk), \
+            mock.patch('payment.queue.enqueue_report_wallet_balance'), \
+            mock.patch('payment.queue.enqueue_payment_failed_callback') as failed, \
+            mock.patch('payment.queue.enqueue_payment_callback') as callback:
+        requests = push_requests()
+        pay_batch_and_callback(app_id)
+        pay_batch_and_callback(app_id)  # nothing left to pay
+        assert blockchain.pay_many.call_count == 1
+        payments, batch_id = blockchain.pay_many.call_args[0]
+        assert payments == [(r.recipient_address, r.amount) for r in requests]
+        assert PaymentBatch.get_payment_ids(batch_id) == [r.id for r in requests]
+        assert callback.call_count == 3
+        assert all(Payment.get(r.id).transaction_id == 'tx' for r in requests)
+
+        # a failed transaction is paid one by one, each payment by its own job
+        requests = push_requests()
+        pay_batch_and_callback(app_id)
+        assert [job.func for job in test_q.jobs] == [pay_and_callback] * 3
+        assert [job.args[0]['id'] for job in test_q.jobs] == [r.id for r in requests]
+        assert not failed.called
+
+        # a job that fails before paying puts the payments back
+        requests = push_requests()
+        with mock.patch('payment.queue.Payment.get', side_effect=ConnectionError):
+            with pytest.raises(ConnectionError):
+                pay_batch_and_callback(app_id)
+        assert [r.id for r in PendingPayments.take(app_id, 3)[1]] == [r.id for r in requests]
+
+        # and those of a job that died are put back once its lease is over
+        with mock.patch('time.time', return_value=time.time() + PendingPayments.LEASE_SECS + 1):
+            recover_pending()
+        assert redis_conn.llen(PendingPayments._key(app_id)) == 3
+        assert test_q.jobs[-1].func == pay_batch_and_callback
+
+
+def test_create_wallets_batch():
+    from payment.queue import create_wallets_batch_and_callback
+    from payment.models import PendingWallets, WalletRequest
+    app_id = 'wal%s' % random.randint(0, 9)
+    redis_conn.delete(PendingWallets._key(app_id))
+    addresses = [generate_key(get_root_wallet(), i).address().decode() for i in range(3)]
+    for i, address in enumerate(addresses):
+        PendingWallets.push(WalletRequest({'id': str(i), 'app_id': app_id, 'wallet_address': address,
+                                           'callback': 'http://localhost/callback'}))
+
+    exists = KinErrors.AccountExistsError(error_code='op_already_exists')
+    exists.__context__ = mock.Mock(**{'extras.result_codes.operations': ['op_success', 'op_already_exists']})
+    sdk = mock.MagicMock()
+    create = sdk.__enter__.return_value.create_wallets
+    create.side_effect = [exists, 'tx']
+    with mock.patch.object(config, 'WALLET_BATCH_SIZE', 3), \
+            mock.patch('payment.blockchain.Blockchain.get_existing_wallets', return_value={addresses[0]}), \
+            mock.patch('payment.queue.get_sdk', return_value=sdk), \
+            mock.patch('payment.queue.enqueue_wallet_callback') as created, \
+            mock.patch('payment.queue.enqueue_wallet_failed_callback') as failed:
+        create_wallets_batch_and_callback(app_id)
+
+    assert create.call_args_list[0][0][0] == addresses[1:]
+    assert create.call_args_list[1][0][0] == addresses[1:2]  # resubmitted without the one that exists
+    assert [c[0][0].id for c in created.call_args_list] == ['1']
+    assert [c[0][0].id for c in failed.call_args_list] == ['0', '2']
+
+
+def test_async_worker():
+    import asyncio
+    from rq import Queue
+    from rq.job import JobStatus
+    import async_worker
+    test_q = Queue('test-async', connection=redis_conn)
+    test_q.empty()
+    jobs = [test_q.enqueue(safe_int, str(i), 0) for i in range(5)] + [test_q.enqueue(safe_int, None, None)]
+    jobs.append(test_q.enqueue(time.sleep, 'not a number'))
+
+    with mock.patch.object(async_worker, 'q', test_q), \
+            mock.patch.object(async_worker, 'rq_error_handler') as error_handler:
+        asyncio.get_event_loop().run_until_complete(async_worker.work(3, burst=True))
+
+    assert [job.result for job in jobs[:5]] == list(range(5))
+    assert all(job.get_status() == JobStatus.FINISHED for job in jobs[:6])
+    assert error_handler.call_count == 1
+    assert error_handler.call_args[0][0].id == jobs[-1].id
+
+
+def test_get_account_is_cached():
+    from payment.blockchain import get_account
+    assert get_account(config.STELLAR_BASE_SEED, 'test') is get_account(config.STELLAR_BASE_SEED, 'test')
+    assert get_account(config.STELLAR_BASE_SEED, 'test') is not get_account(config.STELLAR_BASE_SEED, 'tst2')
+
+
+def test_callback_dispatcher_host_concurrency():
+    import json
+    import threading
+    from payment import callbacks
+    active, peak = {}, {}
+    counter_lock = threading.Lock()
+    redis_conn.delete(callbacks.callback_retries.scheduled_key)
+
+    def send(session, callback, app_id, **kwargs):
+        with counter_lock:
+            active[callback] = active.get(callback, 0) + 1
+            peak[callback] = max(peak.get(callback, 0), active[callback])
+        time.sleep(0.05)
+        with counter_lock:
+            active[callback] -= 1
+
+    dispatcher = callbacks.CallbackDispatcher(concurrency=10, host_concurrency=2)
+    with mock.patch.object(callbacks, 'send_callback', side_effect=send) as sent:
+        for i in range(12):
+            dispatcher.dispatch({'callback': 'http://host-%s/callback' % (i % 2), 'app_id': 'test', 'object': 'payment',
+                                 'state': 'success', 'action': 'send', 'value': {'id': str(i)}})
+        dispatcher.join()
+
+    # 2 posts to each host at a time, 2 more waiting - the rest go back to the queue, without counting an attempt
+    assert sent.call_count == 8
+    assert peak == {'http://host-0/callback': 2, 'http://host-1/callback': 2}
+    assert len(dispatcher.sessions) == 2
+    deferred = [json.loads(i.decode('utf8'))
+                for i in redis_conn.zrange(callbacks.callback_retries.scheduled_key, 0, -1)]
+    assert sorted(i['value']['id'] for i in deferred) == ['10', '11', '8', '9']
+    assert not any('attempt' in i for i in deferred)
+
+
+def test_callback_dispatcher_batches():
+    import json
+    from payment import callbacks
+    dispatcher = callbacks.CallbackDispatcher(concurrency=2, host_concurrency=1)
+    redis_conn.delete(callbacks.callback_retries.scheduled_key)
+
+    def item(i):
+        return {'callback': 'http://batched/callback', 'app_id': 'test', 'object': 'payment', 'state': 'success',
+                'action': 'receive', 'value': {'id': str(i)}, 'batch_size': 3, 'batch_wait_ms': 60000}
+
+    with mock.patch.object(callbacks, 'send_batch_callback', return_value=[True, False, True]) as send:
+        for i in range(4):
+            dispatcher.dispatch(item(i))
+        dispatcher.join()  # flushes the partial batch
+
+    batches = [[i['value']['id'] for i in call[0][2]] for call in send.call_args_list]
+    assert batches == [['0', '1', '2'], ['3']]
+    retries = redis_conn.zrange(callbacks.callback_retries.scheduled_key, 0, -1)
+    assert [json.loads(i.decode('utf8'))['value']['id'] for i in retries] == ['1']
+
+
+def test_callback_dispatcher_processing_list():
+    import json
+    import threading
+    from payment import callbacks
+    redis_conn.delete(callbacks.QUEUE_KEY, callbacks.DISPATCHERS_KEY, callbacks.callback_retries.scheduled_key)
+
+    def item(i):
+        return {'callback': 'http://host/callback', 'app_id': 'test', 'object': 'payment', 'state': 'success',
+                'action': 'send', 'value': {'id': str(i)}}
+
+    # callbacks taken by a dispatcher that died are put back, ahead of the queued ones
+    callbacks.enqueue_callback('http://host/callback', 'test', 'payment', 'success', 'send', {'id': '1'})
+    redis_conn.rpush(callbacks.PROCESSING_KEY % 'dead', json.dumps(item(0)))
+    redis_conn.zadd(callbacks.DISPATCHERS_KEY, time.time() - callbacks.DISPATCHER_TIMEOUT - 1, 'dead')
+    assert callbacks.recover() == 1
+    assert not redis_conn.exists(callbacks.PROCESSING_KEY % 'dead')
+
+    stop_event = threading.Event()
+    sent_ids = []
+
+    def send(session, callback, app_id, value, **kwargs):
+        sent_ids.append(value['id'])
+        if len(sent_ids) == 2:
+            stop_event.set()
+        if value['id'] == '1':
+            raise Exception('callback failed')
+
+    dispatcher = callbacks.CallbackDispatcher(concurrency=1, host_concurrency=1)
+    with mock.patch.object(callbacks, 'send_callback', side_effect=send), \
+            mock.patch.object(callbacks, 'promote_retries'):
+        dispatcher.run(stop_event)
+
+    assert sent_ids == ['0', '1']
+    # handled callbacks are dropped from the processing list - the failed one is only kept by the retries
+    assert not redis_conn.exists(dispatcher.processing_key)
+    assert not redis_conn.zscore(callbacks.DISPATCHERS_KEY, dispatcher.id)
+    assert redis_conn.llen(callbacks.QUEUE_KEY) == 0
+    retries = redis_conn.zrange(callbacks.callback_retries.scheduled_key, 0, -1)
+    assert [json.loads(i.decode('utf8'))['value']['id'] for i in retries] == ['1']
+
+
+def test_callback_dispatcher_beats_while_busy():
+    import threading
+    from payment import callbacks
+    redis_conn.delete(callbacks.QUEUE_KEY, callbacks.DISPATCHERS_KEY)
+    for i in range(3):
+        callbacks.enqueue_callback('http://slow/callback', 'test', 'payment', 'success', 'send', {'id': str(i)})
+    stop_event, release = threading.Event(), threading.Event()
+
+    dispatcher = callbacks.CallbackDispatcher(concurrency=1, host_concurrency=1)
+    with mock.patch.object(callbacks, 'send_callback', side_effect=lambda *args, **kwargs: release.wait(5)), \
+            mock.patch.object(callbacks, 'promote_retries'):
+        t = threading.Thread(target=dispatcher.run, args=(stop_event,))
+        t.start()
+        time.sleep(callbacks.REPORT_INTERVAL * 2.5)
+        # every post is taken by a slow host - no more callbacks are taken, but the dispatcher still beats
+        assert dispatcher.posts == dispatcher.max_posts
+        assert redis_conn.llen(callbacks.QUEUE_KEY) == 1
+        assert time.time() - redis_conn.zscore(callbacks.DISPATCHERS_KEY, dispatcher.id) < callbacks.REPORT_INTERVAL + 0.5
+        stop_event.set()
+        release.set()
+        t.join()
+    redis_conn.delete(callbacks.QUEUE_KEY)
+
+
+def test_retry_promoters():
+    import threading
+    from payment import callbacks
+    from payment.retries import run_promoter
+    stop_event = threading.Event()
+    calls = []
+
+    def promote():
+        calls.append(1)
+        if len(calls) == 1:
+            raise Exception('redis is down')
+        if len(calls) == 3:
+            stop_event.set()
+
+    # keeps promoting after a failure, until stopped
+    run_promoter(promote, stop_event)
+    assert len(calls) == 3
+
+    # the dispatcher promotes the callback retries while it runs
+    redis_conn.delete(callbacks.QUEUE_KEY)
+    stop_event = threading.Event()
+    with mock.patch.object(callbacks, 'promote_retries', side_effect=stop_event.set) as promote_callbacks:
+        callbacks.CallbackDispatcher(concurrency=1, host_concurrency=1).run(stop_event)
+    assert promote_callbacks.called
+
+
+def test_retry_queue_backoff_and_dead_letter():
+    from payment.retries import RetryQueue, backoff
+    assert 4 <= backoff(4, base=1, cap=60) <= 8
+    assert 30 <= backoff(20, base=1, cap=60) <= 60
+
+    retries = RetryQueue('test-retries', max_attempts=2)
+    redis_conn.delete(retries.scheduled_key, retries.dead_key)
+    assert retries.schedule('a', 1)
+    assert not retries.schedule('b', 3)
+    assert retries.pop_due() == []  # not due yet
+
+    with mock.patch('time.time', return_value=time.time() + 10):
+        assert retries.pop_due() == [b'a']
+    assert retries.metrics() == {'retries': 0, 'dead': 1}
+
+
+def test_report_balance_debounced():
+    from payment.queue import enqueue_report_wallet_balance, report_balance
+    address = 'balance-%s' % time.time()
+    with mock.patch('payment.queue.q') as q:
+        for _ in range(10):
+            enqueue_report_wallet_balance(address)
+    assert q.enqueue.call_count == 1
+    assert q.enqueue.call_args[0] == (report_balance, address, [])
+
+
+def test_payment_ledger(client):
+    import json
+    from datetime import datetime
+    from kin import Keypair
+    app_id = 'ldg%s' % random.randint(0, 9)
+    payments = [Payment({'id': 'ledger-%s-%s' % (time.time(), i),
+                         'app_id': app_id,
+                         'transaction_id': '%064x' % random.getrandbits(256),
+                         'recipient_address': Keypair().public_address,
+                         'sender_address': get_root_wallet().root_address,
+                         'amount': i + 1,
+                         'timestamp': datetime.utcfromtimestamp(int(time.time()) - 10 + i)})
+                for i in range(3)]
+    for payment in payments:
+        payment.save()
+
+    assert Payment.get(payments[0].id).to_primitive() == payments[0].to_primitive()
+    exported = [p.id for p in Payment.export(app_id=app_id)]
+    assert exported == [p.id for p in payments]
+    assert [p.id for p in Payment.export(recipient_address=payments[1].recipient_address)] == [payments[1].id]
+
+    res = client.get('/payments/export?app_id=%s&since=%s' % (app_id, int(time.time()) - 9))
+    assert [json.loads(line)['id'] for line in res.data.decode('utf8').splitlines()] == [p.id for p in payments[1:]]
+
+    redis_conn.set('payment:legacy-payment', json.dumps(payments[0].to_primitive()))  # saved before the ledger
+    assert Payment.get('legacy-payment').amount == payments[0].amount
+
+    # a payment made by a worker is indexed at the time it was paid
+    request = PaymentRequest({'id': 'ledger-request-%s' % time.time(), 'app_id': app_id, 'amount': 1,
+                              'recipient_address': Keypair().public_address, 'callback': 'http://localhost/callback'})
+    since = int(time.time())
+    paid = Payment.from_payment_request(request, get_root_wallet().root_address, '%064x' % random.getrandbits(256))
+    paid.save()
+    assert abs((Payment.get(request.id).timestamp - datetime.utcnow()).total_seconds()) < 5
+    assert [p.id for p in Payment.export(since=since, app_id=app_id)] == [request.id]
+
+
+def test_payment_state(client):
+    from datetime import datetime
+    from payment.models import PaymentState
+    payment_id = 'state-%s' % time.time()
+    assert client.get('/payments/%s' % payment_id).status_code == 404
+
+    PaymentState.set(payment_id, PaymentState.QUEUED)
+    res = client.get('/payments/%s' % payment_id)
+    assert res.status_code == 202
+    assert res.json['state'] == PaymentState.QUEUED
+
+    PaymentState.set(payment_id, PaymentState.FAILED, 'no channel')
+    assert client.get('/payments/%s' % payment_id).json['reason'] == 'no channel'
+
+    payment = Payment({'id': 'state-paid-%s' % time.time(),
+                       'app_id': 'test',
+                       'transaction_id': '%064x' % random.getrandbits(256),
+                       'recipient_address': get_root_wallet().root_address,
+                       'sender_address': get_root_wallet().root_address,
+                       'amount': 1,
+                       'timestamp': datetime.utcnow()})
+    payment.save()
+    res = client.get('/payments/%s' % payment.id)
+    assert res.status_code == 200
+    assert res.json['state'] == PaymentState.CONFIRMED
+
+    res = client.post('/payments/status', json={'ids': [payment_id, payment.id, 'unknown']})
+    states = res.json['payments']
+    assert [s['state'] for s in states] == [PaymentState.FAILED, PaymentState.CONFIRMED, None]
+    assert states[1]['payment']['transaction_id'] == payment.transaction_id
+
+
+def test_payment_admission(client):
+    from rq import Queue
+    from payment.models import PaymentState
+    from payment.queue import pay_and_callback
+    test_q = Queue('test_admission', connection=redis_conn)
+    test_q.empty()
+    payment = {'id': 'admission-%s' % time.time(),
+               'app_id': 'test',
+               'amount': 1,
+               'recipient_address': get_root_wallet().root_address,
+               'callback': 'http://localhost/callback'}
+    with mock.patch('payment.queue.q', test_q):
+        assert client.post('/payments', json=payment).status_code == 201
+        assert client.post('/payments', json=payment).status_code == 409
+
+        jobs = test_q.jobs
+        assert len(jobs) == 1
+        assert jobs[0].func == pay_and_callback
+        assert jobs[0].args == (payment,)
+        assert PaymentState.get(payment['id'])['state'] == PaymentState.QUEUED
+
+        # a failed payment may be sent again
+        PaymentState.set(payment['id'], PaymentState.FAILED, 'failed')
+        assert client.post('/payments', json=payment).status_code == 201
+        assert test_q.count == 2
+
+        # and so may a payment whose job died on its way
+        PaymentState.set(payment['id'], PaymentState.SUBMITTED)
+        assert client.post('/payments', json=payment).status_code == 409
+        redis_conn.hset(PaymentState._key(payment['id']), 'updated_at', time.time() - jobs[0].timeout - 1)
+        assert client.post('/payments', json=payment).status_code == 201
+        assert test_q.count == 3
+
+
+def test_bulk_payments_and_wallets(client):
+    from rq import Queue
+    test_q = Queue('test_bulk', connection=redis_conn)
+    test_q.empty()
+    prefix = 'bulk-%s' % time.time()
+    payments = [{'id': '%s-%s' % (prefix, i),
+                 'app_id': 'test',
+                 'amount': 1,
+                 'recipient_address': get_root_wallet().root_address,
+                 'callback': 'http://localhost/callback'}
+                for i in range(3)]
+    with mock.patch('payment.queue.q', test_q):
+        res = client.post('/payments/bulk', json=payments + [payments[0], {'id': 'no-amount'}])
+        assert res.status_code == 201
+        results = res.json['results']
+        assert [r['result'] for r in results] == ['accepted'] * 3 + ['duplicate', 'invalid']
+        assert results[4]['id'] == 'no-amount'
+        assert test_q.count == 3
+
+        wallets = [{'id': '%s-wallet-%s' % (prefix, i),
+                    'app_id': 'test',
+                    'wallet_address': address,
+                    'callback': 'http://localhost/callback'}
+                   for i, address in enumerate(['address-1', 'address-2', 'address-1'])]
+        res = client.post('/wallets/bulk', json=wallets)
+        assert res.status_code == 202
+        assert [r['result'] for r in res.json['results']] == ['accepted', 'accepted', 'duplicate']
+        assert test_q.count == 5
+
+        res = client.post('/payments/bulk', json=[payments[0], {'id': 'no-amount'}])
+        assert res.status_code == 200
+        assert [r['result'] for r in res.json['results']] == ['duplicate', 'invalid']
+
+        assert client.post('/payments/bulk', json={'not': 'a list'}).status_code == 400
+
+
+def test_tx_cache():
+    import base64
+    from payment import tx_cache
+    tx_hash = '%064x' % random.getrandbits(256)
+    data = {'hash': tx_hash,
+            'created_at': '2018-11-12T06:45:40Z',
+            'envelope_xdr': base64.b64encode(b'envelope of %s' % tx_hash.encode()).decode()}
+    assert tx_cache.unpack(tx_hash, tx_cache.pack(data)) == data
+
+    fetch = mock.MagicMock(return_value=data)
+    with mock.patch('payment.tx_cache._simplify', tx_cache.unpack):
+        assert tx_cache.get_transaction(tx_hash, fetch) == data
+        assert tx_cache.get_transaction(tx_hash, fetch) == data  # from the local cache
+        tx_cache.local_cache.clear()
+        assert tx_cache.get_transaction(tx_hash, fetch) == data  # from redis
+        assert fetch.call_count == 1
+
+    # not found is cached for a short while
+    missing_hash = '%064x' % random.getrandbits(256)
+    fetch = mock.MagicMock(side_effect=KinErrors.ResourceNotFoundError())
+    for _ in range(2):
+        with pytest.raises(KinErrors.ResourceNotFoundError):
+            tx_cache.get_transaction(missing_hash, fetch)
+    assert fetch.call_count == 1
+    assert redis_conn.ttl('tx:%s' % missing_hash) <= config.TX_CACHE_NOT_FOUND_TTL_SECS
+
+    cache = tx_cache.LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+
+
+def test_wallet_cache(client):
+    from payment.models import WalletCache
+    from payment.transaction_flow import TransactionFlow
+    from payment.models import TransactionRecord
+    address = get_root_wallet().root_address
+    missing = 'GBNOTAWALLET%s' % int(time.time())
+    WalletCache.invalidate([address])
+
+    res = client.get('/wallets?addresses=%s,%s' % (address, missing))
+    assert res.status_code == 200
+    assert res.json['wallets'][missing] is None
+    balance = res.json['wallets'][address]['kin_balance']
+
+    with mock.patch('payment.blockchain.Blockchain.read_sdk.get_account_data') as get_account_data:
+        assert client.get('/wallets/%s' % address).json['kin_balance'] == balance
+        assert not get_account_data.called
+
+    record = mock.MagicMock(spec=TransactionRecord, from_address='GBSOMEONE', to_address=address)
+    TransactionFlow.invalidate_wallets([record])
+    assert WalletCache.get_many([address]) == {}
+
+
+def test_lazy_blockchain():
+    from payment import blockchain
+    with mock.patch.object(blockchain.Blockchain.read_sdk, 'get_minimum_fee', side_effect=[100, Exception('horizon is down')]) as get_fee, \
+            mock.patch.object(config, 'MINIMUM_FEE_REFRESH_SECS', 0):
+        blockchain._minimum_fee = None
+        assert blockchain.get_minimum_fee() == 100
+        assert blockchain.Blockchain.minimum_fee == 100  # the last fee is kept when a refresh fails
+        assert get_fee.call_count == 2
+    assert blockchain.root_wallet is blockchain.get_root_wallet()
+
+    blockchain.reset()
+    assert blockchain._root_wallet is None
+    assert blockchain.get_root_wallet().root_address == get_root_wallet().root_address
+
+
+def test_horizon_transport():
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from payment.horizon import HorizonTransport, TokenBucket
+
+    def fake_horizon(name, delay, busy=0):
+        replies = []
+
+        class FakeHorizon(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(delay)
+                replies.append(self.path)
+                if len(replies) <= busy:
+                    self.send_response(429)
+                    self.send_header('Retry-After', '0.2')
+                    self.end_headers()
+                    self.wfile.write(json.dumps({'status': 429}).encode())
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps({'server': name}).encode())
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('localhost', 0), FakeHorizon)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    slow, fast = fake_horizon('slow', 0.5), fake_horizon('fast', 0)
+    slow_uri, fast_uri = ['http://localhost:%s' % server.server_port for server in (slow, fast)]
+    try:
+        transport = HorizonTransport([slow_uri, fast_uri], pool_size=2, request_timeout=5,
+                                     rate_limiter=TokenBucket(0, 0), hedge_after_ms=50)
+        # the slow server is tried first, the hedged read to the fast one answers
+        assert transport.query('/ledgers/1') == {'server': 'fast'}
+        assert transport.by_latency()[0] == fast_uri
+        assert transport.query('/ledgers/1') == {'server': 'fast'}
+
+        # accounts are read from the pinned server only, however slow
+        transport.pinned = slow_uri
+        assert transport.query('/accounts/GABC') == {'server': 'slow'}
+        assert transport.pinned == slow_uri
+
+        # a primary that fails is hedged right away, and a pinned one that fails is unpinned
+        dead_uri = 'http://localhost:1'
+        transport = HorizonTransport([dead_uri, fast_uri], pool_size=2, request_timeout=5,
+                                     rate_limiter=TokenBucket(0, 0), hedge_after_ms=5000, num_retries=0)
+        start = time.time()
+        assert transport.query('/transactions/abc') == {'server': 'fast'}
+        assert time.time() - start < 1
+        transport.pinned = dead_uri
+        with pytest.raises(Exception):
+            transport.query('/accounts/GABC')
+        assert transport.pinned is None
+        assert transport.query('/accounts/GABC') == {'server': 'fast'}
+
+        # a busy reply reaches the transport, which pauses the token bucket before retrying
+        busy = fake_horizon('busy', 0, busy=1)
+        busy_uri = 'http://localhost:%s' % busy.server_port
+        try:
+            busy_transport = HorizonTransport([busy_uri], pool_size=2, request_timeout=5,
+                                              rate_limiter=TokenBucket(1000, 10))
+            busy_transport.backoff_factor = 0
+            start = time.time()
+            assert busy_transport.query('/accounts/GABC') == {'server': 'busy'}
+            assert time.time() - start >= 0.2
+        finally:
+            busy.shutdown()
+
+        # a forked child doesn't share the keep-alive connections of its parent
+        pools = transport._session.get_adapter(fast_uri).poolmanager.pools
+        assert len(pools) > 0
+        transport.after_fork()
+        assert len(pools) == 0
+        assert transport.query('/ledgers/1') == {'server': 'fast'}
+    finally:
+        slow.shutdown()
+        fast.shutdown()
+
+    bucket = TokenBucket(rate=100, burst=1)
+    start = time.time()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.time() - start >= 0.04
+    bucket.pause(0.1)
+    start = time.time()
+    bucket.acquire()
+    assert time.time() - start >= 0.09
+
+
 def _test_generate_channels():
     from payment.blockchain import Blockchain, get_sdk
     from payment import config
@@ -142,6 +805,45 @@ def test_watching():
         service.delete()
 
 
+def test_watched_addresses_index():
+    from payment.watcher import WatchedAddressesCache
+    cache = WatchedAddressesCache()
+    service = Service({
+        'service_id': 'my_service:%s' % random.random(),
+        'callback': 'my_callback',
+        'wallet_addresses': ['perm-1'],
+    })
+    service.save()
+    assert cache.get()['perm-1'][0].service_id == service.service_id
+
+    with mock.patch('payment.models.ADDRESS_EXP_SECS', 1):
+        service.watch_payment('temp-1', 'pay-1')
+        service.watch_payment('temp-1', 'pay-2')
+    assert 'temp-1' in cache.get()
+
+    service.unwatch_payment('temp-1', 'pay-1')
+    assert 'temp-1' in Service.get_all_watching_addresses()  # still watching pay-2
+    time.sleep(1.1)
+    assert 'temp-1' not in cache.get()  # expired locally, without a reload
+
+    service.wallet_addresses = ['perm-2']
+    service.save()
+    assert 'perm-1' not in cache.get()
+    assert 'perm-2' in cache.get()
+
+    service.delete()
+    assert service.service_id not in [s.service_id for services in cache.get().values() for s in services]
+
+    # a watch added between queueing the removal of a service and running it is removed too
+    from payment.models import WatchedAddresses
+    pipe = redis_conn.pipeline()
+    WatchedAddresses.remove_service(pipe, service.service_id)
+    service.watch_payment('temp-2', 'pay-3')
+    pipe.execute()
+    assert 'temp-2' not in WatchedAddresses.get_all()
+    assert not redis_conn.exists(WatchedAddresses._service_key(service.service_id))
+
+
 def test_safe_int():
     assert 1 == safe_int('blah', 1)
     assert 2 == safe_int(2, 1)
@@ -159,6 +861,169 @@ def test_old_new_watchers(client):
     assert set(['perm-1', 'perm-2', 'temp-1', 'temp-2']) - set(res.json['watchers'].keys()) == set()
 
 
+def test_transaction_flow_prefetch_order():
+    from payment.transaction_flow import TransactionFlow
+    from payment.models import TransactionRecord
+
+    def record(i, to_address):
+        return TransactionRecord({'to': to_address,
+                                  'from': 'sender',
+                                  'transaction_hash': 'tx-%s' % i,
+                                  'asset_type': 'native',
+                                  'paging_token': str(i),
+                                  'type': 'payment'})
+
+    pages = {0: [record(i, 'address-%s' % (i % 3)) for i in range(1, 51)],
+             '50': [record(i, 'address-1') for i in range(51, 61)]}
+
+    def get_transaction_data(tx_hash):
+        time.sleep(random.random() / 100)
+        return tx_hash
+
+    with mock.patch('payment.transaction_flow.Blockchain.get_all_records', lambda cursor, limit: pages.get(cursor, [])), \
+            mock.patch('payment.transaction_flow.Blockchain.get_transaction_data', get_transaction_data), \
+            mock.patch('payment.transaction_flow.Blockchain.try_parse_payment', lambda tx: tx):
+        flow = TransactionFlow(0)
+        results = list(flow.get_payments({'address-1', 'address-2'}))
+
+    paging_tokens = [int(paging_token) for _, _, paging_token in results]
+    assert paging_tokens == sorted(paging_tokens)
+    assert all(tx == 'tx-%s' % paging_token for _, tx, paging_token in results)
+    assert len(results) == len([i for i in range(1, 51) if i % 3]) + 10
+    assert flow.cursor == '60'
+
+
+def test_payment_from_joined_record():
+    from payment.models import TransactionRecord
+    from payment.transaction_flow import TransactionFlow
+    record = TransactionRecord({'to': 'recipient',
+                                'from': 'sender',
+                                'transaction_hash': 'tx-1',
+                                'asset_type': 'native',
+                                'paging_token': '1',
+                                'type': 'payment',
+                                'amount': '10.00000',
+                                'transaction': {'memo_type': 'text',
+                                                'memo': '1-test-pay-1',
+                                                'created_at': '2018-11-12T06:45:40Z'}}, strict=False)
+
+    with mock.patch('payment.transaction_flow.Blockchain.get_transaction_data') as get_transaction_data:
+        payment = TransactionFlow.get_record_payment(record)
+        assert not get_transaction_data.called
+
+    assert payment.id == 'pay-1'
+    assert payment.app_id == 'test'
+    assert payment.amount == 10
+    assert payment.sender_address == 'sender'
+    assert payment.recipient_address == 'recipient'
+    assert payment.transaction_id == 'tx-1'
+
+
+def test_payment_from_batch_record():
+    from payment.models import PaymentBatch, TransactionRecord
+    from payment.transaction_flow import TransactionFlow
+    batch_id = PaymentBatch.new_id()
+    payment_ids = ['batched-%s-%s' % (time.time(), i) for i in range(3)]
+    PaymentBatch.save(batch_id, payment_ids)
+
+    def record(op_index, transaction=None):
+        # an operation id (its paging token) is the ledger, the transaction and the operation index, from 1
+        paging_token = (1000 << 32) | (1 << 12) | (op_index + 1)
+        return TransactionRecord({'to': 'recipient',
+                                  'from': 'sender',
+                                  'transaction_hash': 'tx-1',
+                                  'asset_type': 'native',
+                                  'paging_token': str(paging_token),
+                                  'type': 'payment',
+                                  'amount': '10.00000',
+                                  'transaction': transaction}, strict=False)
+
+    embedded = {'memo_type': 'text', 'memo': '1-test-%s' % batch_id, 'created_at': '2018-11-12T06:45:40Z'}
+    assert TransactionFlow.get_record_payment(record(1, embedded)).id == payment_ids[1]
+
+    # without the transaction embedded, the multi operation transaction can't be simplified
+    with mock.patch('payment.transaction_flow.Blockchain.get_transaction_data',
+                    side_effect=KinErrors.CantSimplifyError('Cant simplify tx with 3 operations')), \
+            mock.patch('payment.transaction_flow.Blockchain.get_embedded_transaction', return_value=embedded):
+        payment = TransactionFlow.get_record_payment(record(2))
+    assert payment.id == payment_ids[2]
+    assert payment.app_id == 'test'
+    assert payment.amount == 10
+
+    unknown = dict(embedded, memo='1-test-%s' % PaymentBatch.new_id())
+    assert TransactionFlow.get_record_payment(record(0, unknown)).id == unknown['memo'].split('-')[2]
+
+
+def test_wallet_payments_history(client):
+    from payment.models import TransactionRecord
+    address = 'address-%s' % random.random()
+
+    def record(i):
+        return TransactionRecord({'to': address,
+                                  'from': 'sender',
+                                  'transaction_hash': 'tx-%s' % i,
+                                  'asset_type': 'native',
+                                  'paging_token': str(i),
+                                  'type': 'payment',
+                                  'amount': str(i),
+                                  'transaction': {'memo_type': 'text',
+                                                  'memo': '1-test-pay-%s' % i,
+                                                  'created_at': '2018-11-12T06:45:40Z'}}, strict=False)
+
+    pages = {0: [record(i) for i in range(1, 101)], '100': [record(i) for i in range(101, 151)]}
+    get_address_records = mock.Mock(side_effect=lambda address, cursor, limit: pages.get(cursor, []))
+    with mock.patch('payment.transaction_flow.Blockchain.get_address_records', get_address_records):
+        res = client.get('/wallets/%s/payments' % address)
+        assert [p['id'] for p in res.json['payments']] == ['pay-%s' % i for i in range(1, 151)]
+        assert res.json['next_cursor'] is None
+
+        calls = get_address_records.call_count
+        res = client.get('/wallets/%s/payments?cursor=120&limit=20' % address)
+        assert get_address_records.call_count == calls  # served from the history index
+        assert [p['amount'] for p in res.json['payments']] == list(range(121, 141))
+        assert res.json['next_cursor'] == '140'
+
+    assert client.get('/wallets/%s/payments?cursor=abc' % address).status_code == 400
+    assert client.get('/wallets/%s/payments?limit=-1' % address).status_code == 400
+
+
+def test_stream_records_from_fake_horizon():
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from payment.blockchain import Blockchain
+
+    class FakeHorizon(BaseHTTPRequestHandler):
+        """emits a few payment records as server sent events."""
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            self.wfile.write(b'retry: 10\nevent: open\ndata: "hello"\n\n')
+            for i in range(1, 4):
+                record = {'to': 'address-%s' % i,
+                          'from': 'sender',
+                          'transaction_hash': 'tx-%s' % i,
+                          'asset_type': 'native',
+                          'paging_token': str(i),
+                          'type': 'payment'}
+                self.wfile.write(('id: %s\ndata: %s\n\n' % (i, json.dumps(record))).encode())
+            self.wfile.flush()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('localhost', 0), FakeHorizon)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        uri = 'http://localhost:%s' % server.server_port
+        with mock.patch.multiple(Blockchain.read_sdk.horizon, horizon_uri=uri, horizon_uris=[uri]):
+            records = Blockchain.stream_all_records('0')
+            assert [next(records).paging_token for _ in range(3)] == ['1', '2', '3']
+    finally:
+        server.shutdown()
+
+
 def _test_payment_to_burnt():
     from generate_funding_address import generate
 
@@ -178,12 +1043,12 @@ def _test_payment_to_burnt():
 
 def test_bad_seq():
     from generate_funding_address import generate
-    from payment.blockchain import get_sdk, root_wallet
+    from payment.blockchain import get_sdk, get_root_wallet
 
     public, private = generate()
     config.STELLAR_BASE_SEED = private
 
-    builder = root_wallet.write_sdk.build_send_kin(public, 1, fee=root_wallet.minimum_fee, memo_text="blah")
+    builder = get_root_wallet().write_sdk.build_send_kin(public, 1, fee=get_root_wallet().minimum_fee, memo_text="blah")
     builder.set_channel(private)
     builder.sequence = "123456"  # wrong sequnece
     builder.sign(private)
@@ -191,10 +1056,10 @@ def test_bad_seq():
     print(xdr)
 
     try:
-        root_wallet.submit_transaction(xdr)
+        get_root_wallet().submit_transaction(xdr)
     except KinErrors.RequestError:
         pass
-   #  tx_id = root_wallet.write_sdk.submit_transaction(builder)
+   #  tx_id = get_root_wallet().write_sdk.submit_transaction(builder)
 
 
 @pytest.fixture
@@ -3,4 +3,4 @@ log = init_log()
 
 from payment import watcher
 
-watcher.worker(None)
+watcher.run(None)
@@ -1,15 +1,21 @@
-  #!/usr/bin/env python
+#!/usr/bin/env python
+import os
+import signal
 import sys
+from multiprocessing import Process
 from uuid import uuid4
-from rq import Connection, Worker
+from rq import Connection, Worker, SimpleWorker
 from rq.job import Job, JobStatus
 
 # Preload libraries
+from payment import config
 from payment.statsd import statsd
 from payment.log import get as get_log
 from payment.errors import PersistentError
 from payment.redis_conn import redis_conn
-from payment.queue import q
+from payment.queue import q, job_retries, promote
+from payment.retries import run_promoter
+from payment.blockchain import warm_up
 
 
 log = get_log()
@@ -19,19 +25,55 @@ def rq_error_handler(job: Job, exc_type, exc_value, traceback):
     statsd.increment('worker_error', tags=['job:%s' % job.func_name, 'error_type:%s' % exc_type, 'error:%s' % exc_value])
     log.error('worker error in job', func_name=job.func_name, args=job.args, exc_info=(exc_type, exc_value, traceback))
 
-    # reset job state and retry the job
+    # retry the job later, with a backoff
     if exc_type != PersistentError:
-        job.set_status(JobStatus.QUEUED)
+        attempt = job.meta.get('attempt', 0) + 1
+        job.meta['attempt'] = attempt
+        job.save_meta()
         job.exc_info = None
-        q.enqueue_job(job)
+        if job_retries.schedule(job.id, attempt):
+            job.set_status(JobStatus.DEFERRED)
+        else:
+            job.set_status(JobStatus.FAILED)
+            log.error('job failed too many times: not retrying', func_name=job.func_name, attempts=attempt)
     else:
         statsd.increment('worker_persistent_error', tags=['job:%s' % job.func_name, 'error_type:%s' % exc_type, 'error:%s' % exc_value])
         log.error('PersistentError: not retrying', e=exc_value)
 
 
+def work(queue_names, fork=True, burst=False):
+    """run a worker. without fork, jobs run in this process and reuse its sdk clients and connections."""
+    worker_class = Worker if fork else SimpleWorker
+    w = worker_class(queue_names, name=str(uuid4()), connection=redis_conn, exception_handlers=[rq_error_handler])
+    w.work(burst=burst)
+
+
+def run(processes, fork=True, queue_names=None, burst=False):
+    """run a worker in this process, or a pool of worker processes forked after the libraries are loaded."""
+    queue_names = queue_names or [q.name]
+    processes = processes or os.cpu_count()
+    warm_up()  # once, before forking - forked children open their own horizon connections
+    if not burst:
+        # a process rather than a thread - the workers fork, and a thread holding a lock would deadlock the child
+        Process(target=run_promoter, args=(promote,), daemon=True).start()
+    if processes == 1:
+        return work(queue_names, fork, burst)
+
+    children = [Process(target=work, args=(queue_names, fork, burst)) for _ in range(processes)]
+    for child in children:
+        child.start()
+
+    def stop(signum, frame):
+        for child in children:
+            if child.is_alive():
+                os.kill(child.pid, signum)
+    signal.signal(signal.SIGTERM, stop)
+
+    log.info('started worker pool', processes=processes, fork=fork)
+    for child in children:
+        child.join()
+
+
 if __name__ == '__main__':
     with Connection():
-        queue_names = [q.name]
-        worker_name = str(uuid4())
-        w = Worker(queue_names, name=worker_name, connection=redis_conn, exception_handlers=[rq_error_handler])
-        w.work()
+        run(config.WORKER_PROCESSES, fork=config.WORKER_FORK)